@@ -0,0 +1,291 @@
+import argparse
+import getpass
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import session_format as sf
+import timing
+from acquisition_manager import AcquisitionManager
+from probe_simulator import ProbeSimulator
+from session_recorder import SessionRecorder
+from shared_buffer import SharedBufferReader, unlink_segment
+from stream_filters import FilterBank, RunningMedian
+
+
+# Commands are sent to the daemon as JSON over a local multiprocessing connection: a Unix
+# socket in a directory only the user can open (a named pipe on Windows), authenticated
+# with a key the daemon generates on every start and leaves in a file only the user can
+# read. Nothing received is unpickled.
+FAMILY = "AF_PIPE" if os.name == "nt" else "AF_UNIX"
+
+
+def shared_name(name: str) -> str:
+    """ Name of the shared memory segment the daemon publishes a probe's buffer under"""
+    return f"cervical_{name}"
+
+
+def runtime_dir() -> str:
+    """ The user's private directory for daemon sockets and keys, created if needed"""
+    if os.name == "nt":
+        path = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "cervical_probe")
+        os.makedirs(path, exist_ok = True)
+        return path
+    path = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"cervical_probe_{os.getuid()}")
+    os.makedirs(path, mode = 0o700, exist_ok = True)
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(f"{path} must be private to the user running the daemon")
+    return path
+
+
+def command_address(name: str) -> str:
+    """ Address the daemon acquiring probe name takes commands on"""
+    if os.name == "nt":
+        return rf"\\.\pipe\cervical_probe_{getpass.getuser()}_{name}"
+    return os.path.join(runtime_dir(), f"{name}.sock")
+
+
+def key_path(name: str) -> str:
+    """ File holding the authentication key of the daemon acquiring probe name"""
+    return os.path.join(runtime_dir(), f"{name}.key")
+
+
+def read_authkey(name: str, timeout: float = 5.0) -> bytes:
+    """ Reads the daemon's key, waiting up to timeout seconds for it to start"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with open(key_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def daemon_running(name: str) -> bool:
+    """ True if a daemon is acquiring probe name and answering on its command address"""
+    try:
+        conn = Client(command_address(name), family = FAMILY, authkey = read_authkey(name, timeout = 0))
+    except (OSError, EOFError, AuthenticationError):
+        # No key, nothing listening on a stale socket, or a key from an older run
+        return False
+    conn.close()
+    return True
+
+
+def send_message(conn, message):
+    conn.send_bytes(json.dumps(message, default = float).encode())
+
+
+def recv_message(conn):
+    return json.loads(conn.recv_bytes())
+
+
+class AcquisitionDaemon:
+    """
+    Headless acquisition process for one probe: the serial engine, filter bank and
+    calibrated ring buffer of an AcquisitionManager, with the buffer published in shared
+    memory (shared_buffer.SharedProbeBuffer). Nothing here renders or analyses, so the
+    GUI, recorders and analysis tools attach from their own processes as readers and
+    cannot slow acquisition down.
+
+    Commands ("extend", "retract") arrive at command_address(name) and are written by the
+    engine between reads. "stats" returns the acquisition metrics and "shutdown" stops
+    the daemon.
+    """
+
+    def __init__(self, name: str = "probe_1", port = "COM3", baudrate: int = 115200, protocol: str = "ascii",
+                 num_channels: int = 2, fs: int = 80, probe_id: str = "default", poll_interval: float = 0.005,
+                 filter_bank: FilterBank | None = None):
+        self.name = name
+        self.address = command_address(name)
+        self.poll_interval = poll_interval
+        if daemon_running(name):
+            raise RuntimeError(f"A daemon is already acquiring {name}")
+        # A daemon that was killed leaves its segment behind, and creating it again fails
+        if unlink_segment(shared_name(name)):
+            print(f"Removed the stale shared memory segment {shared_name(name)}")
+        self.manager = AcquisitionManager()
+        self.channel = self.manager.add_probe(name, port = port, baudrate = baudrate, protocol = protocol,
+                                              num_channels = num_channels, fs = fs, probe_id = probe_id,
+                                              filter_bank = filter_bank, shared_name = shared_name(name))
+        self.running = False
+
+    def run(self):
+        """ Acquires until shutdown is requested or the process is interrupted"""
+        self.running = True
+        authkey = secrets.token_bytes(32)
+        if FAMILY == "AF_UNIX" and os.path.exists(self.address):
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(self.address)
+        self.listener = Listener(self.address, family = FAMILY, authkey = authkey)
+        fd = os.open(key_path(self.name), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+        threading.Thread(target = self._accept, daemon = True).start()
+        self.manager.start()
+        print(f"Acquiring {self.name} into shared memory {shared_name(self.name)}, commands on {self.address}")
+        try:
+            while self.running:
+                time.sleep(self.poll_interval)
+                self.manager.poll()
+                self.channel.buffer.set_dropped(self.channel.queue.dropped + self.channel.probe.rate.dropped)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.listener.close()
+            for path in (key_path(self.name), self.address):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.manager.stop()
+            self.manager.close()
+            print("Acquisition daemon stopped")
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                # A client without the key; refuse it and keep serving
+                continue
+            except OSError:
+                return
+            threading.Thread(target = self._serve, args = (conn,), daemon = True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while self.running:
+                try:
+                    command = recv_message(conn)
+                except (EOFError, OSError, ValueError):
+                    return
+                if command == "stats":
+                    send_message(conn, self.channel.metrics())
+                elif command == "shutdown":
+                    self.running = False
+                    send_message(conn, "ok")
+                elif command in ("extend", "retract"):
+                    self.channel.probe.send_command(command)
+                    send_message(conn, "ok")
+                else:
+                    send_message(conn, f"unknown command {command!r}")
+
+
+class DaemonProbe:
+    """
+    Stands in for CervicalProbe in a process attached to a daemon: commands are
+    forwarded to the daemon, and rate is measured from the samples read from shared
+    memory. Streaming is the daemon's business, so the stream methods do nothing.
+    """
+
+    def __init__(self, name: str = "probe_1", nominal_fs: float | None = None):
+        self.name = name
+        self.engine = None
+        self.rate = timing.RateEstimator(nominal_fs)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _request(self, message):
+        with self._lock:
+            if self._conn is None:
+                self._conn = Client(command_address(self.name), family = FAMILY, authkey = read_authkey(self.name))
+            send_message(self._conn, message)
+            return recv_message(self._conn)
+
+    def send_command(self, command: str):
+        self._request(command)
+
+    def daemon_stats(self) -> dict:
+        return self._request("stats")
+
+    def shutdown_daemon(self):
+        self._request("shutdown")
+
+    def handle_stream(self, queue):
+        pass
+
+    def stop_stream(self):
+        pass
+
+    def disconnect(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def attach(manager: AcquisitionManager, name: str = "probe_1", timeout: float = 5.0):
+    """ Attaches manager to the daemon acquiring probe name, waiting up to timeout
+    seconds for it to start. Returns the channel"""
+    reader = SharedBufferReader(shared_name(name), timeout = timeout)
+    return manager.attach_probe(name, DaemonProbe(name, reader.fs), reader)
+
+
+def record(name: str, path: str, duration: float):
+    """ Records a running daemon's probe to a .cps session from this process"""
+    manager = AcquisitionManager()
+    channel = attach(manager, name)
+    recorder = SessionRecorder(path, sf.make_header(channel.buffer.fs, calibration = channel.buffer.calibration.to_dict(),
+                                                    probe = {"probe_id": channel.buffer.probe_id}))
+    recorder.start()
+
+    def write(blocks):
+        for timestamp, name, block, times in blocks:
+            recorder.write(block)
+
+    manager.subscribe(write)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        manager.poll()
+    recorder.stop()
+    recorder.wait()
+    print(f"Recorded {recorder.num_samples} samples to {path}, {channel.metrics()['dropped_samples']} dropped")
+    manager.stop()
+    manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Headless probe acquisition into shared memory")
+    sub = parser.add_subparsers(dest = "action", required = True)
+    serve = sub.add_parser("serve", help = "acquire a probe and publish its buffer")
+    serve.add_argument("--name", default = "probe_1")
+    serve.add_argument("--port", default = "COM3")
+    serve.add_argument("--baudrate", type = int, default = 115200)
+    serve.add_argument("--protocol", choices = ["ascii", "binary"], default = "ascii")
+    serve.add_argument("--num-channels", type = int, default = 2)
+    serve.add_argument("--fs", type = int, default = 80)
+    serve.add_argument("--probe-id", default = "default")
+    serve.add_argument("--simulate", action = "store_true", help = "acquire from probe_simulator instead of the port")
+    rec = sub.add_parser("record", help = "record a running daemon's probe to a session file")
+    rec.add_argument("path")
+    rec.add_argument("--name", default = "probe_1")
+    rec.add_argument("--duration", type = float, default = 10.0)
+    stop = sub.add_parser("shutdown", help = "stop a running daemon")
+    stop.add_argument("--name", default = "probe_1")
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        port = args.port
+        if args.simulate:
+            port = ProbeSimulator(fs = args.fs, protocol = args.protocol, num_channels = args.num_channels)
+        # Same live filtering as the GUI: a running median on position
+        bank = FilterBank(args.num_channels)
+        bank.add(RunningMedian(5), channels = [0])
+        AcquisitionDaemon(args.name, port, args.baudrate, args.protocol, args.num_channels, args.fs,
+                          args.probe_id, filter_bank = bank).run()
+    elif args.action == "record":
+        record(args.name, args.path, args.duration)
+    else:
+        DaemonProbe(args.name).shutdown_daemon()
+
+
+if __name__ == '__main__':
+    main()
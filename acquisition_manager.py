@@ -0,0 +1,178 @@
+import probe_client as pc
+import probe_buffer as pb
+import timing
+from sample_queue import SampleBlockQueue
+from shared_buffer import SharedProbeBuffer
+from stream_filters import FilterBank
+
+
+class ProbeChannel:
+    """
+    Everything one probe needs: its client (with its own serial engine and port), the
+    queue the engine streams into, an optional filter bank, and a buffer calibrated with
+    the probe's own entry in the calibration store.
+
+    A channel attached to a probe acquired by another process has no queue; its buffer
+    is a shared_buffer.SharedBufferReader and read_count is how far it has been read.
+    """
+
+    def __init__(self, name: str, probe: pc.CervicalProbe, buffer: pb.ProbeBuffer, filter_bank: FilterBank | None = None,
+                 attached: bool = False):
+        self.name = name
+        self.probe = probe
+        self.buffer = buffer
+        self.filter_bank = filter_bank
+        self.queue = None if attached else SampleBlockQueue(buffer.num_channels, buffer.bufsize)
+        self.read_count = buffer.total_written
+        # Samples the acquisition process overwrote before this process read them
+        self.missed = 0
+        # Seconds between the oldest sample of the last poll being read and being consumed
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.queue_depth = 0
+
+    def metrics(self) -> dict:
+        """ Rate, jitter and drop figures for the probe, and how far behind the consumer is"""
+        if self.queue is None:
+            dropped, capacity = self.buffer.dropped + self.missed, self.buffer.bufsize
+        else:
+            dropped, capacity = self.queue.dropped, self.queue.capacity
+        return {
+            **self.probe.rate.stats(),
+            "dropped_samples": dropped,
+            "queue_depth": self.queue_depth,
+            "queue_fill": self.queue_depth / capacity,
+            "latency_ms": 1e3 * self.latency,
+            "max_latency_ms": 1e3 * self.max_latency,
+        }
+
+
+class AcquisitionManager:
+    """
+    Runs several probes at once from one process.
+
+    Each probe streams on its own I/O thread (which releases the GIL while it waits on the
+    port and decodes whole chunks of bytes at once), and the filtering and calibration in
+    poll() work on whole blocks, so the probes do not compete for the interpreter. poll() drains every probe, filters and
+    calibrates the blocks into the probe buffers, and passes the merged, timestamped
+    blocks to the subscribers. A subscriber can listen to any subset of the probes:
+
+        manager.subscribe(callback, probes=["station_1"])
+        callback(blocks)  # list of (timestamp, probe name, calibrated block, sample times)
+
+    The timestamp is the host time (timing.now()) of the newest sample in the block, and
+    the sample times spread the block stamps over the samples at the measured rate. The
+    list is sorted oldest first. The blocks are views into the probe buffers, valid until
+    the next poll(); subscribers that keep them must copy them.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self._subscribers = {}
+        self._next_token = 0
+
+    def add_probe(self, name: str, port, baudrate: int = 115200, protocol: str = "ascii", num_channels: int = 2,
+                  fs: int = 80, probe_id: str | None = None, calibration = None, filter_bank: FilterBank | None = None,
+                  mode: str = "ring", shared_name: str | None = None) -> ProbeChannel:
+        """ Adds a probe on its own port. The buffer's calibration is taken from the store
+        under probe_id (the probe name if not given) unless one is passed in. With
+        shared_name, the buffer is published in shared memory under that name for other
+        processes to read"""
+        if name in self.channels:
+            raise ValueError(f"Probe {name} already added")
+        probe = pc.CervicalProbe(protocol = protocol, num_channels = num_channels, port = port, baudrate = baudrate,
+                                 use_engine = True)
+        probe.rate.nominal_fs = fs
+        if shared_name is not None:
+            buffer = SharedProbeBuffer(shared_name, num_channels, fs, calibration = calibration,
+                                       probe_id = probe_id or name)
+        else:
+            buffer = pb.ProbeBuffer(num_channels, fs, mode = mode, calibration = calibration,
+                                    probe_id = probe_id or name)
+        channel = ProbeChannel(name, probe, buffer, filter_bank)
+        self.channels[name] = channel
+        return channel
+
+    def attach_probe(self, name: str, probe, reader) -> ProbeChannel:
+        """ Adds a probe that another process acquires (see acquisition_daemon.py). reader
+        is a SharedBufferReader on its buffer and probe forwards commands to it. poll()
+        passes on the samples written since the last poll, already filtered and calibrated"""
+        if name in self.channels:
+            raise ValueError(f"Probe {name} already added")
+        channel = ProbeChannel(name, probe, reader, attached = True)
+        self.channels[name] = channel
+        return channel
+
+    def start(self):
+        for channel in self.channels.values():
+            channel.probe.handle_stream(channel.queue)
+
+    def stop(self):
+        for channel in self.channels.values():
+            channel.probe.stop_stream()
+            channel.probe.disconnect()
+
+    def subscribe(self, callback, probes: list | None = None) -> int:
+        """ Registers callback for the probes named (all probes if None). Returns a token
+        for unsubscribe"""
+        token = self._next_token
+        self._next_token += 1
+        self._subscribers[token] = (callback, None if probes is None else set(probes))
+        return token
+
+    def unsubscribe(self, token: int):
+        self._subscribers.pop(token, None)
+
+    def poll(self) -> list:
+        """ Drains every probe into its buffer and notifies the subscribers. Returns the
+        merged list of (timestamp, probe name, calibrated block)"""
+        merged = []
+        for name, channel in self.channels.items():
+            if channel.queue is None:
+                self._poll_attached(name, channel, merged)
+                continue
+            channel.queue_depth = channel.queue.qsize()
+            block, stamps, _ = channel.queue.get_all_stamped()
+            if len(block) == 0:
+                continue
+            channel.latency = timing.now() - stamps[0]
+            channel.max_latency = max(channel.max_latency, channel.latency)
+            times = timing.sample_times(stamps, channel.probe.rate.fs or channel.buffer.fs)
+            if channel.filter_bank is not None:
+                block = channel.filter_bank.process(block)
+            channel.buffer.add_data(block, times)
+            # The newest samples in the buffer are the calibrated block
+            n = len(block)
+            merged.append((times[-1], name, channel.buffer.latest(n), channel.buffer.latest_times(n)))
+        merged.sort(key = lambda item: item[0])
+        if merged:
+            for callback, probes in list(self._subscribers.values()):
+                selected = merged if probes is None else [item for item in merged if item[1] in probes]
+                if selected:
+                    callback(selected)
+        return merged
+
+    def _poll_attached(self, name: str, channel: ProbeChannel, merged: list):
+        channel.queue_depth = channel.buffer.total_written - channel.read_count
+        block, times, channel.read_count, missed = channel.buffer.read_since(channel.read_count)
+        channel.missed += missed
+        if len(block) == 0:
+            return
+        # The host clock is system wide, so the other process's sample times compare
+        channel.latency = timing.now() - times[0]
+        channel.max_latency = max(channel.max_latency, channel.latency)
+        channel.probe.rate.update(len(block), times[-1])
+        merged.append((times[-1], name, block, times))
+
+    def stats(self) -> dict:
+        return {name: channel.probe.engine.stats() for name, channel in self.channels.items()
+                if channel.probe.engine is not None and channel.probe.engine.io_thread is not None}
+
+    def close(self):
+        """ Releases the shared memory of the published buffers and attached readers"""
+        for channel in self.channels.values():
+            if hasattr(channel.buffer, "close"):
+                channel.buffer.close()
+
+    def metrics(self) -> dict:
+        return {name: channel.metrics() for name, channel in self.channels.items()}
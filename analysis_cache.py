@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import session_format as sf
+import stiffness_analysis as sa
+
+
+# Persistent cache of stiffness analysis results, addressed by the content of the data and
+# the analysis parameters, so selecting a session again or re-running a batch does not
+# repeat the change point detection. Any change to the data or to a parameter gives a new
+# key; stale entries are never read and age out of the LRU. Bump ANALYSIS_VERSION when
+# stiffness_analysis changes what it computes.
+
+ANALYSIS_VERSION = 1
+# Next to the sessions in the repository's data directory, wherever the tools are run from
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "analysis_cache")
+MAX_FILE_HASHES = 4096
+ARRAY_KEYS = ("fi", "fi_ind", "ff", "ff_ind", "E")
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """ BLAKE2b digest of the file contents"""
+    digest = hashlib.blake2b(digest_size = 20)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_hash(data: np.ndarray) -> str:
+    """ BLAKE2b digest of an array's shape, dtype and values"""
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(f"{data.dtype.str}{data.shape}".encode(), digest_size = 20)
+    digest.update(data.data)
+    return digest.hexdigest()
+
+
+def _canonical_params(params: dict) -> dict:
+    """ The full parameter set analyze_force will use, DEFAULT_PARAMS filled in"""
+    p = dict(sa.DEFAULT_PARAMS)
+    p.update(params)
+    canonical = {}
+    for key, value in p.items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        # Numbers take the type of their default, so trial_start=350.0 and h=1 give the
+        # same key as 350 and 1.0
+        default = sa.DEFAULT_PARAMS.get(key)
+        if type(default) is int and isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif type(default) is float and type(value) is int:
+            value = float(value)
+        canonical[key] = value
+    return canonical
+
+
+def _encode(result: dict) -> dict:
+    return {key: np.asarray(value).tolist() if key in ARRAY_KEYS else value for key, value in result.items()}
+
+
+def _decode(entry: dict) -> dict:
+    return {key: np.asarray(value) if key in ARRAY_KEYS else value for key, value in entry.items()}
+
+
+class AnalysisCache:
+    """
+    Two level LRU cache of sa.analyze_force results. The newest max_entries results are
+    kept in memory, and every result is written to a JSON file in directory, whose total
+    size is held under max_bytes by deleting the least recently used files (hits refresh
+    a file's mtime). Files are replaced atomically, so processes can share a directory.
+    directory None keeps the cache in memory only.
+    """
+
+    def __init__(self, directory: str | None = DEFAULT_CACHE_DIR, max_bytes: int = 32 * 1024 * 1024,
+                 max_entries: int = 256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        # Content hashes of files already read, by (path, mtime, size), least recently
+        # used first and at most MAX_FILE_HASHES of them
+        self._file_hashes = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+            self._disk_bytes = sum(size for _, _, size in self._entries())
+
+    def key(self, content_hash: str, params: dict) -> str:
+        """ Cache key of the data with content_hash analysed with params"""
+        text = json.dumps({"version": ANALYSIS_VERSION, "data": content_hash, "params": _canonical_params(params)},
+                          sort_keys = True)
+        return hashlib.blake2b(text.encode(), digest_size = 20).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None and self.directory is not None:
+            path = self._path(key)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                os.utime(path)
+            except (OSError, ValueError):
+                # Missing, evicted by another process, or half written by one that died
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Fresh arrays every time, so callers cannot modify the cached result
+        return _decode(entry)
+
+    def put(self, key: str, result: dict):
+        entry = _encode(result)
+        self._remember(key, entry)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp, path)
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path)
+            over = self._disk_bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def analyze_force(self, force: np.ndarray, **params) -> dict:
+        """ sa.analyze_force, answered from the cache when this force trace was analysed
+        with the same params before. The result also holds num_samples, the length of the
+        trace"""
+        return self._analyze(array_hash(force), params, lambda: force)
+
+    def analyze_file(self, path: str, column: int = 1, **params) -> dict:
+        """ Analyses the force column of a session file. The key is the file's content
+        hash, which is only computed again when its mtime or size change, so a hit does
+        not load the session at all"""
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        with self._lock:
+            content_hash = self._file_hashes.get(stamp)
+            if content_hash is not None:
+                self._file_hashes.move_to_end(stamp)
+        if content_hash is None:
+            # Hashed outside the lock; two threads hashing the same file agree anyway
+            content_hash = file_hash(path)
+            with self._lock:
+                self._file_hashes[stamp] = content_hash
+                while len(self._file_hashes) > MAX_FILE_HASHES:
+                    self._file_hashes.popitem(last = False)
+        return self._analyze(f"{content_hash}:{column}", params, lambda: sf.load_session(path).data[:, column])
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        for path, _, _ in self._entries():
+            self._remove(path)
+        self._disk_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+        }
+
+    def _analyze(self, content_hash: str, params: dict, load) -> dict:
+        key = self.key(content_hash, params)
+        result = self.get(key)
+        if result is None:
+            force = load()
+            result = sa.analyze_force(force, **params)
+            result["num_samples"] = len(force)
+            self.put(key, result)
+            result = _decode(_encode(result))
+        return result
+
+    def _remember(self, key: str, entry: dict):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last = False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _entries(self):
+        """ (path, mtime, size) of every cache file"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _evict(self):
+        """ Deletes the least recently used files until the cache is under 90% of
+        max_bytes, leaving room for a few writes before the next scan"""
+        entries = sorted(self._entries(), key = lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_default = None
+
+
+def default_cache() -> AnalysisCache:
+    """ The process wide cache in DEFAULT_CACHE_DIR"""
+    global _default
+    if _default is None:
+        _default = AnalysisCache()
+    return _default
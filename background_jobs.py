@@ -0,0 +1,95 @@
+import threading
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """ Raised by a job function that noticed its cancel event was set"""
+
+
+class _Job(QRunnable):
+    def __init__(self, runner, kind: str, generation: int, fn, args, cancel: threading.Event):
+        super().__init__()
+        self.runner = runner
+        self.kind = kind
+        self.generation = generation
+        self.fn = fn
+        self.args = args
+        self.cancel = cancel
+
+    def run(self):
+        if self.cancel.is_set():
+            return
+        try:
+            result = self.fn(*self.args, cancel = self.cancel)
+        except JobCancelled:
+            return
+        except Exception as e:
+            self.runner._failed.emit(self.kind, self.generation, f"{type(e).__name__}: {e}")
+            return
+        self.runner._finished.emit(self.kind, self.generation, result)
+
+
+class JobRunner(QObject):
+    """
+    Runs slow work (loading and analysing sessions) on a QThreadPool so the GUI thread
+    and its timers keep their cadence.
+
+    Jobs are submitted under a kind, and a new job of a kind supersedes the previous
+    one: the old job is removed from the pool if it has not started, its cancel event is
+    set so it can stop early, and its result is dropped if it finishes anyway. Job
+    functions are called as fn(*args, cancel=event) and may raise JobCancelled. Results
+    come back on the GUI thread through the finished(kind, result) and
+    failed(kind, message) signals.
+    """
+
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+    # Emitted from the worker threads, and delivered to the GUI thread
+    _finished = pyqtSignal(str, int, object)
+    _failed = pyqtSignal(str, int, str)
+
+    def __init__(self, max_threads: int = 2):
+        super().__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self._current = {}
+        self._generation = 0
+        self._finished.connect(self._on_finished)
+        self._failed.connect(self._on_failed)
+
+    def submit(self, kind: str, fn, *args):
+        self.cancel(kind)
+        self._generation += 1
+        job = _Job(self, kind, self._generation, fn, args, threading.Event())
+        # The pool must not delete the job while it is still tracked here
+        job.setAutoDelete(False)
+        self._current[kind] = job
+        self.pool.start(job)
+
+    def cancel(self, kind: str):
+        job = self._current.pop(kind, None)
+        if job is not None:
+            job.cancel.set()
+            self.pool.tryTake(job)
+
+    def busy(self, kind: str) -> bool:
+        return kind in self._current
+
+    def shutdown(self, timeout_ms: int = 2000):
+        for kind in list(self._current):
+            self.cancel(kind)
+        self.pool.waitForDone(timeout_ms)
+
+    def _is_current(self, kind: str, generation: int) -> bool:
+        job = self._current.get(kind)
+        return job is not None and job.generation == generation
+
+    def _on_finished(self, kind: str, generation: int, result):
+        if self._is_current(kind, generation):
+            del self._current[kind]
+            self.finished.emit(kind, result)
+
+    def _on_failed(self, kind: str, generation: int, message: str):
+        if self._is_current(kind, generation):
+            del self._current[kind]
+            self.failed.emit(kind, message)
@@ -0,0 +1,100 @@
+import argparse
+import csv
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import stiffness_analysis as sa
+import session_format as sf
+from analysis_cache import default_cache
+
+
+# Batch stiffness analysis: runs change point detection and the Hertz model on every session
+# in a directory, in parallel, and writes one summary row per file.
+#
+#   python batch_stiffness.py data --output stiffness_summary.csv --workers 8
+
+
+def find_sessions(data_dir: str, patterns = ("*.cps", "*.csv", "*.npy"), recursive: bool = False) -> list:
+    paths = []
+    for pattern in patterns:
+        if recursive:
+            pattern = os.path.join("**", pattern)
+        paths.extend(glob.glob(os.path.join(data_dir, pattern), recursive=recursive))
+    return sorted(set(paths))
+
+
+def analyze_file(path: str, params: dict) -> dict:
+    """ Worker: loads one session and analyzes it. Never raises, errors go in the row"""
+    row = {"file": path}
+    try:
+        # Geometry recorded with the session is used unless given on the command line,
+        # and anything still missing comes from sa.DEFAULT_PARAMS. Only .cps sessions
+        # have a header, which is read without loading the samples
+        probe = sf.read_header(path)[0].get("probe", {}) if path.endswith(sf.EXTENSION) else {}
+        file_params = {key: probe[key] for key in ("h", "R", "v") if key in probe}
+        file_params.update(params)
+        # Sessions analysed before with the same params are answered from the cache
+        result = default_cache().analyze_file(path, **file_params)
+        for rep, E in enumerate(result["E"]):
+            row[f"E_rep{rep + 1}"] = float(E)
+        row["E_mean"] = result["E_mean"]
+        row["E_std"] = result["E_std"]
+        row["num_samples"] = result["num_samples"]
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    return row
+
+
+def write_summary(rows: list, output: str, num_reps: int):
+    fields = ["file"] + [f"E_rep{rep + 1}" for rep in range(num_reps)] + ["E_mean", "E_std", "num_samples", "error"]
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute per-rep stiffness for every session in a directory")
+    parser.add_argument("data_dir")
+    parser.add_argument("--output", default="stiffness_summary.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--recursive", action="store_true")
+    parser.add_argument("--trial-start", type=int, default=sa.DEFAULT_PARAMS["trial_start"])
+    parser.add_argument("--lag", type=int, default=sa.DEFAULT_PARAMS["lag"])
+    parser.add_argument("--num-reps", type=int, default=sa.DEFAULT_PARAMS["num_reps"])
+    parser.add_argument("--model", default=sa.DEFAULT_PARAMS["model"])
+    parser.add_argument("--friction", type=float, default=sa.DEFAULT_PARAMS["friction"])
+    parser.add_argument("--h", type=float, help="indentation in meters (overrides the session header)")
+    parser.add_argument("--R", type=float, help="radius of the probe in meters (overrides the session header)")
+    parser.add_argument("--v", type=float, help="Poisson's ratio (overrides the session header)")
+    args = parser.parse_args()
+
+    params = {
+        "trial_start": args.trial_start, "lag": args.lag, "num_reps": args.num_reps,
+        "model": args.model, "friction": args.friction,
+    }
+    for key in ("h", "R", "v"):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    paths = find_sessions(args.data_dir, recursive=args.recursive)
+    print(f"Analyzing {len(paths)} sessions with {args.workers} workers...")
+    t0 = time.perf_counter()
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(analyze_file, path, params) for path in paths]
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            if "error" in row:
+                print(f"  {row['file']}: {row['error']}")
+    rows.sort(key=lambda row: row["file"])
+    write_summary(rows, args.output, args.num_reps)
+    failed = sum("error" in row for row in rows)
+    print(f"Done in {time.perf_counter() - t0:.1f} s, {failed} failed. Summary written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
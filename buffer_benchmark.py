@@ -0,0 +1,29 @@
+import time
+import numpy as np
+import probe_buffer as pb
+
+
+# Microbenchmark comparing the shifting buffer against the ring buffer.
+# Each GUI tick (33 ms) adds a small block of samples, so the block size is fs * 0.033.
+
+def time_appends(mode, fs, num_channels = 2, ticks = 200):
+    buf = pb.ProbeBuffer(num_channels, fs, mode = mode)
+    block_len = max(1, int(fs * 0.033))
+    block = np.random.uniform(-1e5, 1e5, (block_len, num_channels))
+    # Fill the buffer once so both modes are in steady state
+    for _ in range(buf.bufsize // block_len + 1):
+        buf.add_data(block)
+    t0 = time.perf_counter()
+    for _ in range(ticks):
+        buf.add_data(block)
+        buf.latest(block_len)
+    elapsed = time.perf_counter() - t0
+    return elapsed / ticks
+
+
+if __name__ == '__main__':
+    print(f"{'fs':>8} {'bufsize':>10} {'shift (us)':>12} {'ring (us)':>12} {'speedup':>8}")
+    for fs in [80, 1000, 5000, 20000, 100000]:
+        t_shift = time_appends("shift", fs)
+        t_ring = time_appends("ring", fs)
+        print(f"{fs:>8} {10 * fs:>10} {t_shift * 1e6:>12.1f} {t_ring * 1e6:>12.1f} {t_shift / t_ring:>8.1f}")
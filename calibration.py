@@ -0,0 +1,287 @@
+import json
+import os
+import datetime
+import numpy as np
+import session_format as sf
+
+
+# Load cell fit from load_cell_calibration.py (newtons per raw reading, and offset)
+DEFAULT_FORCE_SLOPE = -0.0000084
+DEFAULT_FORCE_INTERCEPT = -0.5655986
+
+# Versioned coefficient store shared by every probe on this machine
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibrations.json")
+STORE_FORMAT_VERSION = 1
+
+
+class Calibration:
+    """
+    Per-channel polynomial calibration, applied in place to (n, num_channels) blocks.
+
+    coefficients has shape (order + 1, num_channels), highest power first (the np.polyval
+    convention), so a linear calibration is [[gain, ...], [offset, ...]]. Applying it does
+    not allocate once the scratch space has grown to the largest block seen.
+    """
+
+    def __init__(self, coefficients):
+        coefficients = np.atleast_2d(np.asarray(coefficients, dtype=np.float64))
+        self.coefficients = coefficients
+        self.num_channels = coefficients.shape[1]
+        self.order = coefficients.shape[0] - 1
+        # Coefficients cast to each block dtype, and Horner scratch space for each dtype
+        self._coef_cache = {}
+        self._scratch = {}
+
+    @classmethod
+    def linear(cls, gains, offsets):
+        return cls([gains, offsets])
+
+    @classmethod
+    def identity(cls, num_channels: int):
+        return cls.linear(np.ones(num_channels), np.zeros(num_channels))
+
+    @classmethod
+    def from_dict(cls, config: dict):
+        """ Builds a calibration from {"coefficients": [[c_n, ..., c_0] per channel]}"""
+        per_channel = config["coefficients"]
+        order = max(len(c) for c in per_channel) - 1
+        coefficients = np.zeros((order + 1, len(per_channel)))
+        for ch, c in enumerate(per_channel):
+            # Shorter polynomials are padded with zero high order terms
+            coefficients[order + 1 - len(c):, ch] = c
+        return cls(coefficients)
+
+    @classmethod
+    def from_file(cls, path: str):
+        """ Loads a calibration from a JSON file written by to_file"""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self) -> dict:
+        return {"coefficients": self.coefficients.T.tolist()}
+
+    def to_file(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def _coefs(self, dtype):
+        coefs = self._coef_cache.get(dtype)
+        if coefs is None:
+            coefs = self.coefficients.astype(dtype)
+            self._coef_cache[dtype] = coefs
+        return coefs
+
+    def apply(self, block: np.ndarray) -> np.ndarray:
+        """ Calibrates a float32/float64 block in place and returns it"""
+        if len(block) == 0:
+            return block
+        coefs = self._coefs(block.dtype)
+        if self.order == 1:
+            block *= coefs[0]
+            block += coefs[1]
+            return block
+        # Horner's method in the scratch buffer, then copy back
+        n = len(block)
+        scratch = self._scratch.get(block.dtype)
+        if scratch is None or len(scratch) < n:
+            scratch = np.empty((n, self.num_channels), dtype=block.dtype)
+            self._scratch[block.dtype] = scratch
+        acc = scratch[:n]
+        acc[:] = coefs[0]
+        for c in coefs[1:]:
+            acc *= block
+            acc += c
+        block[:] = acc
+        return block
+
+    def invert(self, values: np.ndarray, channel: int) -> np.ndarray:
+        """ Raw readings that calibrate to values on channel. Exact for a linear
+        calibration; higher orders are solved by Newton's method from the linear terms,
+        which assumes the polynomial is monotonic over the readings"""
+        values = np.asarray(values, dtype=np.float64)
+        c = self.coefficients[:, channel]
+        if self.order == 0:
+            raise ValueError("A constant calibration cannot be inverted")
+        raw = (values - c[-1]) / c[-2] if c[-2] != 0 else np.zeros_like(values)
+        if self.order == 1:
+            return raw
+        derivative = np.polyder(c)
+        for _ in range(50):
+            step = (np.polyval(c, raw) - values) / np.polyval(derivative, raw)
+            raw = raw - step
+            if np.all(np.abs(step) <= 1e-12 * np.maximum(1.0, np.abs(raw))):
+                break
+        return raw
+
+
+def default_calibration(num_channels: int = 2) -> Calibration:
+    """ Position is passed through unchanged, force (channel 1) uses the default load cell fit"""
+    gains = np.ones(num_channels)
+    offsets = np.zeros(num_channels)
+    gains[1] = DEFAULT_FORCE_SLOPE
+    offsets[1] = DEFAULT_FORCE_INTERCEPT
+    return Calibration.linear(gains, offsets)
+
+
+class CalibrationFit:
+    """
+    Result of fitting a calibration polynomial to (reading, load) pairs
+    """
+
+    def __init__(self, coefficients, readings, loads, weights):
+        self.coefficients = coefficients
+        self.readings = readings
+        self.loads = loads
+        self.weights = weights
+        self.predicted = np.polyval(coefficients, readings)
+        self.residuals = loads - self.predicted
+        # Weighted coefficient of determination
+        mean = np.average(loads, weights=weights)
+        ss_res = np.sum(weights * self.residuals**2)
+        ss_tot = np.sum(weights * (loads - mean)**2)
+        self.r_squared = 1 - ss_res / ss_tot if ss_tot > 0 else 1.0
+
+    def summary(self) -> dict:
+        return {
+            "coefficients": self.coefficients.tolist(),
+            "r_squared": float(self.r_squared),
+            "max_abs_residual": float(np.max(np.abs(self.residuals))),
+            "num_points": int(len(self.loads)),
+        }
+
+
+def fit_polynomial(readings, loads, order: int = 1, weights=None) -> CalibrationFit:
+    """ Weighted least squares fit of load (newtons) against raw reading.
+    weights are inverse variances of the loads; omit them for an unweighted fit."""
+    readings = np.asarray(readings, dtype=np.float64)
+    loads = np.asarray(loads, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(loads))
+    weights = np.asarray(weights, dtype=np.float64)
+    # np.polyfit weights multiply the residuals, so pass the square root of the inverse variance
+    coefficients = np.polyfit(readings, loads, order, w=np.sqrt(weights))
+    return CalibrationFit(coefficients, readings, loads, weights)
+
+
+def static_load_reading(path: str, channel: int = 1, trim: float = 0.2, raw: bool = False):
+    """ Returns the mean raw reading of a recorded static-load session and the variance of
+    that mean. The first and last trim fraction of the samples are dropped so that placing
+    and removing the weight do not bias the result.
+
+    Recorded samples are calibrated, so a .cps session is taken back to raw readings with
+    the inverse of the calibration in its header. A session without one (CSV, .npy) cannot
+    be told apart from a calibrated one and is refused, unless raw says that it holds raw
+    readings."""
+    session = sf.load_session(path)
+    column = np.asarray(session.data[:, channel], dtype=np.float64)
+    calibration = session.header.get("calibration")
+    if calibration is not None:
+        column = Calibration.from_dict(calibration).invert(column, channel)
+    elif not raw:
+        raise ValueError(f"{path} has no calibration in its header, so its raw readings cannot be "
+                         "recovered. Record it as a .cps session, or pass raw=True if it holds raw readings")
+    start = int(len(column) * trim)
+    stop = len(column) - start
+    column = column[start:stop]
+    variance = np.var(column, ddof=1) / len(column) if len(column) > 1 else 1.0
+    return float(np.mean(column)), float(variance)
+
+
+def fit_from_sessions(session_loads: dict, channel: int = 1, order: int = 1, trim: float = 0.2,
+                      raw: bool = False) -> CalibrationFit:
+    """ Fits a calibration from {session path: applied load in newtons}, weighting each
+    session by the inverse variance of its mean reading. raw is passed to
+    static_load_reading for sessions without a calibration in their header"""
+    readings = []
+    loads = []
+    weights = []
+    for path, load in session_loads.items():
+        mean, variance = static_load_reading(path, channel, trim, raw)
+        readings.append(mean)
+        loads.append(load)
+        weights.append(1 / variance if variance > 0 else 1.0)
+    return fit_polynomial(readings, loads, order, np.array(weights) / np.max(weights))
+
+
+class CalibrationStore:
+    """
+    Versioned JSON store of calibrations, one list of revisions per probe:
+
+        {"format_version": 1,
+         "probes": {"<probe id>": [{"revision": 1, "created": "...",
+                                    "coefficients": [[...] per channel], ...}]}}
+
+    Adding a calibration appends a new revision, so earlier ones stay available.
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        self.path = path
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {"format_version": STORE_FORMAT_VERSION, "probes": {}}
+        with open(self.path) as f:
+            store = json.load(f)
+        if store.get("format_version", 0) > STORE_FORMAT_VERSION:
+            raise ValueError(f"Calibration store {self.path} is from a newer version")
+        return store
+
+    def probes(self) -> list:
+        return sorted(self._read()["probes"])
+
+    def revisions(self, probe_id: str) -> list:
+        return self._read()["probes"].get(probe_id, [])
+
+    def add(self, probe_id: str, calibration: Calibration, fit: CalibrationFit | None = None, notes: str = "") -> int:
+        """ Stores a new revision for the probe and returns its revision number"""
+        store = self._read()
+        history = store["probes"].setdefault(probe_id, [])
+        entry = calibration.to_dict()
+        entry["revision"] = history[-1]["revision"] + 1 if history else 1
+        entry["created"] = datetime.datetime.now().isoformat(timespec="seconds")
+        entry["notes"] = notes
+        if fit is not None:
+            entry["fit"] = fit.summary()
+        history.append(entry)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(store, f, indent=2)
+        os.replace(tmp_path, self.path)
+        return entry["revision"]
+
+    def get(self, probe_id: str, revision: int | None = None) -> Calibration:
+        """ Returns a revision of the probe's calibration, the latest if revision is None"""
+        history = self.revisions(probe_id)
+        if not history:
+            raise KeyError(f"No calibration stored for probe {probe_id}")
+        if revision is None:
+            return Calibration.from_dict(history[-1])
+        for entry in history:
+            if entry["revision"] == revision:
+                return Calibration.from_dict(entry)
+        raise KeyError(f"Probe {probe_id} has no calibration revision {revision}")
+
+
+# Calibrations already loaded, keyed on (store path, store mtime, probe id, revision)
+_calibration_cache = {}
+
+
+def load_calibration(probe_id: str = "default", num_channels: int = 2, path: str = DEFAULT_STORE_PATH, revision: int | None = None) -> Calibration:
+    """ Loads a probe's calibration from the store, reusing the cached copy unless the store
+    file has changed. Falls back to the default calibration if the probe is not in the store."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    key = (os.path.abspath(path), mtime, probe_id, revision)
+    calibration = _calibration_cache.get(key)
+    if calibration is None:
+        try:
+            calibration = CalibrationStore(path).get(probe_id, revision)
+        except KeyError:
+            print(f"No stored calibration for probe {probe_id}, using the default.")
+            calibration = default_calibration(num_channels)
+        if calibration.num_channels != num_channels:
+            raise ValueError(f"Calibration for probe {probe_id} has {calibration.num_channels} channels, expected {num_channels}")
+        _calibration_cache[key] = calibration
+    return calibration
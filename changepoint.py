@@ -0,0 +1,114 @@
+import numpy as np
+
+
+# Change point backends for rep onset detection. Every detector returns breakpoints the
+# way ruptures does: sorted indices where a new segment starts, followed by len(signal).
+
+
+class NotEnoughChangePoints(ValueError):
+    """ The signal has fewer distinct change points than were asked for"""
+
+
+class RupturesKernelCPD:
+    """ Exact kernel change point detection (ruptures.KernelCPD), O(n^2) in the signal length"""
+
+    def __init__(self, kernel: str = "linear", min_size: int = 2, jump: int = 1):
+        self.kernel = kernel
+        self.min_size = min_size
+        self.jump = jump
+
+    def detect(self, signal: np.ndarray, n_bkps: int) -> np.ndarray:
+        import ruptures as rpt
+        algo = rpt.KernelCPD(kernel=self.kernel, min_size=self.min_size, jump=self.jump).fit(signal)
+        return np.array(algo.predict(n_bkps=n_bkps))
+
+
+class RupturesBinseg:
+    """ Binary segmentation (ruptures.Binseg)"""
+
+    def __init__(self, model: str = "rbf", min_size: int = 3, jump: int = 5):
+        self.model = model
+        self.min_size = min_size
+        self.jump = jump
+
+    def detect(self, signal: np.ndarray, n_bkps: int) -> np.ndarray:
+        import ruptures as rpt
+        algo = rpt.Binseg(model=self.model, min_size=self.min_size, jump=self.jump).fit(signal)
+        return np.array(algo.predict(n_bkps=n_bkps))
+
+
+class WindowCusumDetector:
+    """
+    Fast detector for step-shaped reps. A cumulative sum of the signal is computed once,
+    giving in O(n) the difference between the mean of the window samples after and before
+    every index. Rising steps are the largest positive peaks of that score and falling
+    steps the largest negative ones, at least min_distance apart. With an even n_bkps the
+    result alternates onset/offset like the indentation reps do.
+    """
+
+    def __init__(self, window: int = 8, min_distance: int | None = None):
+        self.window = window
+        self.min_distance = min_distance if min_distance is not None else 2 * window
+
+    def score(self, signal: np.ndarray) -> np.ndarray:
+        """ mean(x[t:t + w]) - mean(x[t - w:t]) for every t, zero where the windows do not fit"""
+        x = np.asarray(signal, dtype=np.float64)
+        n = len(x)
+        w = self.window
+        score = np.zeros(n)
+        if n < 2 * w:
+            return score
+        c = np.concatenate(([0.0], np.cumsum(x)))
+        t = np.arange(w, n - w + 1)
+        score[t] = ((c[t + w] - c[t]) - (c[t] - c[t - w])) / w
+        return score
+
+    def _select(self, strength: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+        """ The k strongest candidates, at least min_distance apart, sorted by index"""
+        candidates = candidates[np.argsort(strength[candidates], kind="stable")[::-1]]
+        chosen = []
+        for idx in candidates:
+            if len(chosen) == k:
+                break
+            if all(abs(idx - c) >= self.min_distance for c in chosen):
+                chosen.append(idx)
+        return np.sort(np.array(chosen, dtype=int))
+
+    def _peaks(self, score: np.ndarray, k: int) -> np.ndarray:
+        """ Indices of the k largest local maxima of score, at least min_distance apart"""
+        if k == 0:
+            return np.zeros(0, dtype=int)
+        interior = (score[1:-1] >= score[:-2]) & (score[1:-1] > score[2:]) & (score[1:-1] > 0)
+        return self._select(score, np.flatnonzero(interior) + 1, k)
+
+    def detect(self, signal: np.ndarray, n_bkps: int) -> np.ndarray:
+        score = self.score(signal)
+        n_rise = (n_bkps + 1) // 2
+        rises = self._peaks(score, n_rise)
+        falls = self._peaks(-score, n_bkps - n_rise)
+        bkps = np.sort(np.concatenate((rises, falls)))
+        if len(bkps) < n_bkps:
+            # Not enough steps of each sign, merge them with the strongest steps of either
+            # sign and keep the largest in magnitude
+            magnitude = np.abs(score)
+            strongest = self._peaks(magnitude, n_bkps)
+            bkps = self._select(magnitude, np.union1d(bkps, strongest), n_bkps)
+        if len(bkps) < n_bkps:
+            raise NotEnoughChangePoints(f"Found {len(bkps)} of {n_bkps} change points at least "
+                                        f"{self.min_distance} samples apart")
+        return np.append(bkps, len(signal)).astype(int)
+
+
+BACKENDS = {
+    "kernel_linear": lambda **kw: RupturesKernelCPD(kernel="linear", **kw),
+    "binseg_rbf": lambda **kw: RupturesBinseg(model="rbf", **kw),
+    "window_cusum": lambda **kw: WindowCusumDetector(**kw),
+}
+
+
+def get_detector(name: str, **kwargs):
+    """ Returns a change point detector by name, see BACKENDS"""
+    try:
+        return BACKENDS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown change point model: {name}") from None
@@ -0,0 +1,59 @@
+import time
+import numpy as np
+import changepoint as cp
+import stiffness_analysis as sa
+
+
+# Benchmark and accuracy comparison of the change point backends on synthetic 3-rep
+# indentation traces (80 Hz, like the recorded sessions).
+
+def synthetic_trace(rng, n = 1200, num_reps = 3, fs = 80, noise = 0.01):
+    """ Returns a force trace and the true (onset, offset) index of each rep. Each rep ramps
+    up over ~60 ms, relaxes slightly while held for ~1 s, and ramps back down."""
+    force = np.full(n, 0.05)
+    first = rng.integers(60, 120)
+    spacing = int(1.6 * fs)
+    truth = []
+    for rep in range(num_reps):
+        onset = first + rep * spacing + rng.integers(-5, 6)
+        hold = int(fs * rng.uniform(0.9, 1.1))
+        offset = onset + hold
+        peak = rng.uniform(0.8, 2.0)
+        ramp = 5
+        t = np.arange(hold)
+        force[onset:offset] += peak * np.minimum(1, (t + 1) / ramp) * (1 - 0.1 * t / hold)
+        truth.append((onset, offset))
+    force += rng.normal(0, noise, n)
+    return force, np.array(truth)
+
+
+def run(backend, traces, num_reps = 3):
+    detector = cp.get_detector(backend)
+    errors = []
+    t0 = time.perf_counter()
+    for force, truth in traces:
+        bkps = detector.detect(force, 2 * num_reps)[:-1]
+        errors.append(np.abs(bkps - truth.ravel()))
+    elapsed = time.perf_counter() - t0
+    return elapsed / len(traces), np.concatenate(errors)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    traces = [synthetic_trace(rng) for _ in range(20)]
+    print(f"{'backend':>14} {'ms/trace':>10} {'mean err':>9} {'max err':>8} {'exact %':>8}")
+    for backend in ["window_cusum", "binseg_rbf", "kernel_linear"]:
+        per_trace, errors = run(backend, traces)
+        print(f"{backend:>14} {per_trace * 1e3:>10.2f} {errors.mean():>9.2f} {errors.max():>8d} {100 * np.mean(errors <= 1):>8.1f}")
+
+    # Stiffness agreement with the default ruptures backend, on traces with a deadzone
+    print()
+    print("Modulus difference vs kernel_linear (same lag and trial_start):")
+    for backend in ["window_cusum", "binseg_rbf"]:
+        diffs = []
+        for force, _ in traces[:10]:
+            padded = np.concatenate((np.full(350, force[0]), force))
+            ref = sa.analyze_force(padded, model = "kernel_linear")["E"]
+            E = sa.analyze_force(padded, model = backend)["E"]
+            diffs.append(np.abs(E - ref) / np.abs(ref))
+        print(f"{backend:>14} mean {100 * np.mean(diffs):.2f} %, max {100 * np.max(diffs):.2f} %")
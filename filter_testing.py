@@ -3,6 +3,7 @@ from scipy.ndimage import median_filter
 import scipy.signal as sps
 import matplotlib.pyplot as plt
 import ruptures as rpt
+import session_format as sf
 
 
 # This is a testing script for filtering the positional and force data 
@@ -10,7 +11,8 @@ import ruptures as rpt
 
 file_path = "C:\\Users\\rdkee\\Documents\\Github\\Cervical_Probe_Client\\data\\forearm_newtons_test.csv"
 
-loaded_data = np.loadtxt(file_path, delimiter=",")
+# Works for .cps (memory-mapped) as well as the original CSV sessions
+loaded_data = sf.load_session(file_path).data
 y_force = loaded_data[:,1] 
 y_pos = loaded_data[:,0]
 
@@ -1,21 +1,68 @@
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import stats
+import calibration as cal
 
 
-# Enter in the observed values from the calibration data
+# Fits the load cell calibration and stores it for a probe, so ProbeBuffer picks it up at startup.
+#
+# Without sessions, fits the reference readings below:
+#   python load_cell_calibration.py --probe default --save
+# With recorded static-load .cps sessions (raw readings are recovered from the calibration
+# in their header), give each file and its load in newtons:
+#   python load_cell_calibration.py --probe probe_2 --session data/cal_0N.cps 0 --session data/cal_1N.cps 1 --save
+# Sessions without a header (CSV) are refused, since the GUI saved them calibrated. Pass
+# --raw only if they were recorded with raw readings:
+#   python load_cell_calibration.py --probe probe_2 --raw --session data/cal_0N.csv 0 --session data/cal_1N.csv 1
+
+# Observed values from the reference calibration data
 newtons = np.array([0, 0.1, 0.2, 0.5, 1, 2])
 mv_readings = np.array([-67700, -78800,-90600,-125950,-185900,-304400])
 
-# Run a linear regression to find the slope and intercept
-res = stats.linregress(mv_readings, newtons)
 
-print(f"R-squared: {res.rvalue**2:.6f}")
-print(f"Slope: {res.slope:.6f}")
-print(f"Intercept: {res.intercept:.6f}")
+def main():
+    parser = argparse.ArgumentParser(description="Fit and store the load cell calibration")
+    parser.add_argument("--probe", default="default", help="probe id to store the calibration under")
+    parser.add_argument("--session", nargs=2, action="append", metavar=("PATH", "NEWTONS"),
+                        help="static-load session file and the load applied during it")
+    parser.add_argument("--raw", action="store_true",
+                        help="sessions without a calibration in their header hold raw readings")
+    parser.add_argument("--order", type=int, default=1, help="polynomial order of the fit")
+    parser.add_argument("--num-channels", type=int, default=2)
+    parser.add_argument("--store", default=cal.DEFAULT_STORE_PATH)
+    parser.add_argument("--save", action="store_true", help="add the fit to the calibration store")
+    parser.add_argument("--no-plot", action="store_true")
+    args = parser.parse_args()
+
+    if args.session:
+        try:
+            fit = cal.fit_from_sessions({path: float(load) for path, load in args.session}, order=args.order,
+                                         raw=args.raw)
+        except ValueError as e:
+            print(e)
+            return
+    else:
+        fit = cal.fit_polynomial(mv_readings, newtons, order=args.order)
+
+    print(f"R-squared: {fit.r_squared:.6f}")
+    print(f"Coefficients (highest power first): {fit.coefficients}")
+    print(f"Residuals (N): {np.round(fit.residuals, 4)}")
+
+    if args.save:
+        # Position passes through unchanged, the force channel gets the fitted polynomial
+        per_channel = [[1.0, 0.0] for _ in range(args.num_channels)]
+        per_channel[1] = fit.coefficients.tolist()
+        calibration = cal.Calibration.from_dict({"coefficients": per_channel})
+        revision = cal.CalibrationStore(args.store).add(args.probe, calibration, fit)
+        print(f"Stored calibration revision {revision} for probe {args.probe}")
+
+    if not args.no_plot:
+        order = np.argsort(fit.readings)
+        plt.plot(fit.readings, fit.loads, 'o', label='original data')
+        plt.plot(fit.readings[order], fit.predicted[order], 'r', label='fitted line')
+        plt.legend()
+        plt.show()
 
-plt.plot(mv_readings, newtons, 'o', label='original data')
-plt.plot(mv_readings, res.intercept + res.slope*mv_readings, 'r', label='fitted line')
-plt.legend()
-plt.show()
 
+if __name__ == '__main__':
+    main()
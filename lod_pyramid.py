@@ -0,0 +1,164 @@
+import math
+import os
+import numpy as np
+import session_format as sf
+
+
+# Level of detail pyramid for drawing long sessions. Level k holds the min and max of every
+# bin of FIRST_BIN * BASE**(k - 1) samples, for every channel, so any sample range can be
+# drawn at about a pixel per bin by reading only the bins in view from the right level.
+# Levels are stored one after another in a single (bins, 2 * num_channels) table, each
+# row being the bin's mins followed by its maxs, and cached next to the session as
+# <session>.lod in the .cps layout, where it is memory-mapped like the session itself.
+
+FIRST_BIN = 8
+BASE = 4
+MIN_BINS = 256
+LOD_VERSION = 1
+LOD_SUFFIX = ".lod"
+
+
+def _reduce(mins: np.ndarray, maxs: np.ndarray, factor: int):
+    """ Min of every factor rows of mins and max of every factor rows of maxs. Rows left
+    over after the last full bin make a bin of their own"""
+    full = len(mins) // factor
+    shape = (full, factor) + mins.shape[1:]
+    out_min = np.empty((math.ceil(len(mins) / factor),) + mins.shape[1:], dtype=mins.dtype)
+    out_max = np.empty_like(out_min)
+    out_min[:full] = mins[:full * factor].reshape(shape).min(axis=1)
+    out_max[:full] = maxs[:full * factor].reshape(shape).max(axis=1)
+    if len(mins) > full * factor:
+        out_min[full] = mins[full * factor:].min(axis=0)
+        out_max[full] = maxs[full * factor:].max(axis=0)
+    return out_min, out_max
+
+
+def bin_sizes(n: int, first_bin: int = FIRST_BIN, base: int = BASE, min_bins: int = MIN_BINS) -> list:
+    """ Samples per bin of each level above the raw samples. The coarsest level still
+    has at least min_bins bins, and a short session has no levels at all"""
+    sizes = []
+    size = first_bin
+    while n / size >= min_bins:
+        sizes.append(size)
+        size *= base
+    return sizes
+
+
+class MinMaxPyramid:
+    """
+    Min/max envelopes of an (n, num_channels) session at every level of detail. view()
+    returns what to draw for a sample range: the raw samples when the range is narrow
+    enough, otherwise a min and max per bin from the coarsest level that still has a bin
+    per pixel, so a frame costs the same however long the session is.
+    """
+
+    def __init__(self, data: np.ndarray, table: np.ndarray, sizes: list):
+        self.data = data
+        self.table = table
+        self.sizes = sizes
+        self.num_channels = data.shape[1]
+        self.offsets = np.concatenate(([0], np.cumsum([math.ceil(len(data) / size) for size in sizes]))).astype(int)
+
+    @classmethod
+    def build(cls, data: np.ndarray, first_bin: int = FIRST_BIN, base: int = BASE, min_bins: int = MIN_BINS,
+              chunk_bins: int = 1 << 16, check = None):
+        """ Builds the pyramid in one pass over data, chunk_bins first level bins at a
+        time so a memory-mapped session is never copied whole. check, if given, is called
+        between chunks and may raise to abandon the build"""
+        n, num_channels = data.shape
+        sizes = bin_sizes(n, first_bin, base, min_bins)
+        table = np.empty((sum(math.ceil(n / size) for size in sizes), 2 * num_channels), dtype=np.float32)
+        pyramid = cls(data, table, sizes)
+        if not sizes:
+            return pyramid
+        chunk = chunk_bins * first_bin
+        for start in range(0, n, chunk):
+            if check is not None:
+                check()
+            block = np.asarray(data[start:start + chunk])
+            mins, maxs = _reduce(block, block, first_bin)
+            rows = table[start // first_bin:start // first_bin + len(mins)]
+            rows[:, :num_channels] = mins
+            rows[:, num_channels:] = maxs
+        for level in range(1, len(sizes)):
+            below = pyramid.level(level - 1)
+            mins, maxs = _reduce(below[:, :num_channels], below[:, num_channels:], base)
+            pyramid.level(level)[:] = np.hstack((mins, maxs))
+        return pyramid
+
+    def level(self, k: int) -> np.ndarray:
+        """ Rows of level k, counting from 0 for bins of sizes[0] samples"""
+        return self.table[self.offsets[k]:self.offsets[k + 1]]
+
+    def view(self, channel: int, start: float, stop: float, pixels: int):
+        """ Returns (x, y) to draw samples start to stop of channel on a plot pixels wide,
+        with x in samples. Bins are drawn as vertical segments from their min to their
+        max, as in plot_decimation.MinMaxDecimator"""
+        target = (stop - start) / max(1, int(pixels))
+        start = max(0, int(math.floor(start)))
+        stop = min(len(self.data), int(math.ceil(stop)))
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+        # The coarsest level whose bins are no wider than a pixel
+        k = -1
+        while k + 1 < len(self.sizes) and self.sizes[k + 1] <= target:
+            k += 1
+        if k < 0:
+            return np.arange(start, stop, dtype=np.float64), np.asarray(self.data[start:stop, channel])
+        size = self.sizes[k]
+        first, last = start // size, math.ceil(stop / size)
+        rows = self.level(k)[first:last]
+        y = np.empty(2 * len(rows), dtype=np.float64)
+        y[0::2] = rows[:, channel]
+        y[1::2] = rows[:, self.num_channels + channel]
+        x = np.repeat(np.arange(first, last, dtype=np.float64) * size, 2)
+        return x, y
+
+    def save(self, path: str, source: str):
+        """ Writes the table to path, stamped with the source session's size and mtime
+        so a stale pyramid is never loaded"""
+        stat = os.stat(source)
+        header = sf.make_header(None, [f"min_{i}" for i in range(self.num_channels)] +
+                                [f"max_{i}" for i in range(self.num_channels)], self.table.dtype,
+                                lod = {"version": LOD_VERSION, "sizes": self.sizes, "num_samples": len(self.data),
+                                       "source_size": stat.st_size, "source_mtime": stat.st_mtime})
+        temp = f"{path}.{os.getpid()}.tmp"
+        sf.save_session(temp, self.table, header)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path: str, source: str, data: np.ndarray):
+        """ Memory-maps the pyramid saved at path for data, the samples of source, or
+        returns None if it is missing or was built from other data"""
+        try:
+            lod_file = sf.open_session(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        lod = lod_file.header.get("lod", {})
+        stat = os.stat(source)
+        current = {"version": LOD_VERSION, "num_samples": len(data), "source_size": stat.st_size,
+                   "source_mtime": stat.st_mtime}
+        if any(lod.get(key) != value for key, value in current.items()):
+            return None
+        pyramid = cls(data, lod_file.data, lod["sizes"])
+        if pyramid.offsets[-1] != len(lod_file.data):
+            return None
+        return pyramid
+
+
+def load_or_build(source: str, data: np.ndarray, check = None) -> MinMaxPyramid:
+    """ The pyramid of the session file source, whose samples are data. It is read from
+    <source>.lod when that is up to date, and otherwise built and saved there. A session
+    short enough to be drawn from its samples alone has no levels, and no file. check is
+    passed to MinMaxPyramid.build"""
+    if not bin_sizes(len(data)):
+        return MinMaxPyramid.build(data)
+    path = source + LOD_SUFFIX
+    pyramid = MinMaxPyramid.load(path, source, data)
+    if pyramid is None:
+        pyramid = MinMaxPyramid.build(data, check = check)
+        try:
+            pyramid.save(path, source)
+        except OSError as e:
+            print("Could not cache the level of detail pyramid:", e)
+    return pyramid
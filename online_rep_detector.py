@@ -0,0 +1,113 @@
+import numpy as np
+import scipy.signal as sps
+
+
+class RepEvent:
+    """ An onset or peak event. index counts samples since the detector was created"""
+
+    def __init__(self, kind: str, rep: int, index: int, force: float):
+        self.kind = kind
+        self.rep = rep
+        self.index = index
+        self.force = force
+
+    def __repr__(self):
+        return f"RepEvent({self.kind}, rep={self.rep}, index={self.index}, force={self.force:.4f})"
+
+
+class OnlineRepDetector:
+    """
+    Detects indentation reps on the live force stream, one block at a time.
+
+    While idle it tracks the force baseline with an exponential moving average. A rep
+    starts when the force rises more than rise_threshold newtons above the baseline with a
+    positive slope, and an "onset" event carries the baseline force just before it (fi). The
+    running maximum is tracked until the force falls back below release_threshold above the
+    baseline (the hysteresis keeps noise from ending the rep early), then a "peak" event
+    carries the maximum (ff). The state is a handful of numbers carried from block to block,
+    so nothing is ever reprocessed.
+    """
+
+    def __init__(self, rise_threshold: float = 0.2, release_threshold: float = 0.1, baseline_alpha: float = 0.05,
+                 slope_alpha: float = 0.5, min_samples: int = 5):
+        self.rise_threshold = rise_threshold
+        self.release_threshold = release_threshold
+        self.baseline_alpha = baseline_alpha
+        self.slope_alpha = slope_alpha
+        # Reps shorter than this many samples are treated as noise
+        self.min_samples = min_samples
+        self.reset()
+
+    def reset(self):
+        self.index = 0
+        self.baseline = None
+        self.slope = 0.0
+        self.prev = None
+        self.in_rep = False
+        self.rep = 0
+        self.onset_force = 0.0
+        self.onset_index = 0
+        self.peak_force = -np.inf
+        self.peak_index = 0
+
+    def process(self, force: np.ndarray) -> list:
+        """ Feeds a block of calibrated force samples and returns the events it completed.
+        The moving averages are run over the block with lfilter and the threshold
+        crossings found with array searches, so the Python work is per event, not per
+        sample, and the result is the same as stepping through the samples one by one"""
+        force = np.asarray(force, dtype=np.float64).ravel()
+        n = len(force)
+        if n == 0:
+            return []
+        if self.baseline is None:
+            self.baseline = force[0]
+            self.prev = force[0]
+        # The slope follows every sample whatever the state
+        a = self.slope_alpha
+        diff = np.diff(force, prepend=self.prev)
+        slope, _ = sps.lfilter([a], [1, a - 1], diff, zi=[(1 - a) * self.slope])
+        self.slope = slope[-1]
+        self.prev = force[-1]
+        events = []
+        i = 0
+        while i < n:
+            if not self.in_rep:
+                # Baseline seen by each sample, before it is updated with that sample
+                b = self.baseline_alpha
+                updated, _ = sps.lfilter([b], [1, b - 1], force[i:], zi=[(1 - b) * self.baseline])
+                baseline = np.concatenate(([self.baseline], updated[:-1]))
+                rising = np.flatnonzero((force[i:] - baseline > self.rise_threshold) & (slope[i:] > 0))
+                if len(rising) == 0:
+                    self.baseline = updated[-1]
+                    break
+                i += rising[0]
+                self.baseline = baseline[rising[0]]
+                self.in_rep = True
+                self.onset_force = self.baseline
+                self.onset_index = self.index + i
+                self.peak_force = force[i]
+                self.peak_index = self.index + i
+                events.append(RepEvent("onset", self.rep, self.index + i, self.baseline))
+                i += 1
+            else:
+                released = np.flatnonzero(force[i:] - self.onset_force < self.release_threshold)
+                end = n if len(released) == 0 else i + released[0] + 1
+                if end > i:
+                    peak = i + np.argmax(force[i:end])
+                    if force[peak] > self.peak_force:
+                        self.peak_force = force[peak]
+                        self.peak_index = self.index + peak
+                if len(released) == 0:
+                    break
+                i = end - 1
+                self.in_rep = False
+                if self.index + i - self.onset_index >= self.min_samples:
+                    events.append(RepEvent("peak", self.rep, self.peak_index, self.peak_force))
+                    self.rep += 1
+                else:
+                    # Too short to be a rep, forget the onset
+                    events.append(RepEvent("cancel", self.rep, self.index + i, force[i]))
+                self.baseline = force[i]
+                i += 1
+        self.index += n
+        return events
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from queue import Queue
+import numpy as np
+import probe_buffer as pb
+import probe_client as pc
+import timing
+from calibration import default_calibration
+from plot_decimation import MinMaxDecimator
+from probe_simulator import ProbeSimulator
+from acquisition_manager import AcquisitionManager
+from probe_gui import draw_live, drain_sample_queue
+from stream_filters import FilterBank, RunningMedian
+
+
+# End-to-end benchmark of the acquisition path the GUI runs: a simulated probe streams at
+# fs through an AcquisitionManager, polled on a tick like the GUI timer, and every tick
+# draws and renders a frame of the GUI's live plots on an offscreen Qt platform. The
+# "legacy" path runs the original per-sample client worker and Queue, drained like the
+# GUI's per-sample path. Stages: "drain" is the poll (drain, filter, calibrate, buffer),
+# "queue_wait" how long the oldest sample waited for it, "frame" decimating and painting
+# the plots, and "end_to_end" the oldest sample's read to its frame being painted.
+# Results are saved as JSON; pass --compare with an earlier file to see regressions.
+
+STAGES = ["drain", "queue_wait", "frame", "end_to_end"]
+_app = None
+
+
+def percentiles(values) -> dict:
+    if len(values) == 0:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ms = 1e3 * np.asarray(values)
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(ms.max())}
+
+
+def live_plots(pixels: int):
+    """ The GUI's two live plots, pixels wide, shown on an offscreen Qt platform unless
+    another one is set, so frames are really rendered without a display"""
+    global _app
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    import pyqtgraph as pg
+    _app = QApplication.instance() or QApplication([])
+    lines = []
+    for channel, pen in ((1, "red"), (0, "green")):
+        plot = pg.PlotWidget()
+        plot.resize(pixels, 300)
+        plot.show()
+        lines.append((plot, plot.plot([], [], pen = pen), channel))
+    return lines
+
+
+def render(lines):
+    """ Draws the live plots now, as the event loop would after the GUI timer's tick"""
+    for plot, curve, channel in lines:
+        plot.repaint()
+
+
+def run_engine(fs, num_channels, protocol, duration, tick, pixels):
+    """ Simulator -> AcquisitionManager (serial engine, SampleBlockQueue, filter bank,
+    ProbeBuffer), polled as by MainWindow.queue_to_buffer -> probe_gui.draw_live frame"""
+    sim = ProbeSimulator(fs = fs, protocol = protocol, num_channels = num_channels, seed = 0)
+    bank = FilterBank(num_channels)
+    bank.add(RunningMedian(5), channels = [0])
+    manager = AcquisitionManager()
+    channel = manager.add_probe("bench", port = sim, protocol = protocol, num_channels = num_channels, fs = int(fs),
+                                calibration = default_calibration(num_channels), filter_bank = bank)
+    channel.probe.engine.poll_interval = 0.005
+    received = []
+    manager.subscribe(lambda blocks: received.extend(len(block) for _, _, block, _ in blocks))
+    decimator = MinMaxDecimator()
+    lines = live_plots(pixels)
+    timings = {stage: [] for stage in STAGES}
+    depths = []
+    consumed = 0
+    manager.start()
+    start = timing.now()
+    deadline = start + duration
+    while timing.now() < deadline:
+        time.sleep(tick)
+        depths.append(channel.queue.qsize())
+        received.clear()
+        t0 = timing.now()
+        manager.poll()
+        t1 = timing.now()
+        if not received:
+            continue
+        draw_live(channel.buffer, decimator, lines)
+        render(lines)
+        t2 = timing.now()
+        consumed += sum(received)
+        timings["drain"].append(t1 - t0)
+        # How long the oldest sample waited for the poll, measured inside it
+        timings["queue_wait"].append(channel.latency)
+        timings["frame"].append(t2 - t1)
+        timings["end_to_end"].append(channel.latency + (t2 - t0))
+    elapsed = timing.now() - start
+    stats = channel.probe.engine.stats()
+    manager.stop()
+    return {
+        "samples": consumed,
+        "samples_per_s": consumed / elapsed,
+        "offered_per_s": fs,
+        "dropped": channel.queue.dropped + stats["device_dropped"],
+        "bad_frames": stats["bad_frames"],
+        "jitter_ms": stats["jitter_ms"],
+        "queue_depth": {"mean": float(np.mean(depths)), "max": int(np.max(depths)), "capacity": channel.queue.capacity},
+        "latency_ms": {stage: percentiles(values) for stage, values in timings.items()},
+    }
+
+
+def run_legacy(fs, num_channels, protocol, duration, tick, pixels):
+    """ Simulator -> CervicalProbe.stream_worker -> Queue of lists, drained as by
+    MainWindow.queue_to_buffer_list (probe_gui.drain_sample_queue) -> draw_live frame"""
+    sim = ProbeSimulator(fs = fs, protocol = protocol, num_channels = num_channels, seed = 0)
+    probe = pc.CervicalProbe(protocol = protocol, num_channels = num_channels, port = sim)
+    buffer = pb.ProbeBuffer(num_channels, int(fs), mode = "ring", calibration = default_calibration(num_channels))
+    bank = FilterBank(num_channels)
+    bank.add(RunningMedian(5), channels = [0])
+    q = Queue()
+    decimator = MinMaxDecimator()
+    lines = live_plots(pixels)
+    timings = {stage: [] for stage in STAGES}
+    depths = []
+    consumed = 0
+    probe.handle_stream(q)
+    start = timing.now()
+    deadline = start + duration
+    while timing.now() < deadline:
+        time.sleep(tick)
+        depths.append(q.qsize())
+        t0 = timing.now()
+        block = drain_sample_queue(q, bank, buffer)
+        t1 = timing.now()
+        if not len(block):
+            continue
+        draw_live(buffer, decimator, lines)
+        render(lines)
+        t2 = timing.now()
+        consumed += len(block)
+        # The per-sample queue carries no timestamps, so only the consumer stages are timed
+        timings["drain"].append(t1 - t0)
+        timings["frame"].append(t2 - t1)
+    elapsed = timing.now() - start
+    probe.stop_stream()
+    return {
+        "samples": consumed,
+        "samples_per_s": consumed / elapsed,
+        "offered_per_s": fs,
+        "dropped": None,
+        "bad_frames": probe.decoder.bad_frames if protocol == "binary" else None,
+        "jitter_ms": None,
+        "queue_depth": {"mean": float(np.mean(depths)), "max": int(np.max(depths)), "capacity": None},
+        "latency_ms": {stage: percentiles(values) for stage, values in timings.items()},
+    }
+
+
+def run(path, fs, num_channels, protocol, duration = 2.0, tick = 0.033, pixels = 800) -> dict:
+    """ Runs one configuration and returns its results, including the peak memory
+    allocated while it ran. tracemalloc slows every allocation, so the timings come from
+    an untraced run and the peak memory from a second, traced run of the same length"""
+    runner = run_engine if path == "engine" else run_legacy
+    result = runner(fs, num_channels, protocol, duration, tick, pixels)
+    tracemalloc.start()
+    try:
+        runner(fs, num_channels, protocol, duration, tick, pixels)
+        result["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+    return {"path": path, "fs": fs, "num_channels": num_channels, "protocol": protocol, **result}
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                                  check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "revision": revision,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+    }
+
+
+def key(result):
+    return (result["path"], result["fs"], result["num_channels"], result["protocol"])
+
+
+def print_result(result, baseline = None):
+    e2e = result["latency_ms"]["end_to_end"]["p95"]
+    frame = result["latency_ms"]["frame"]["p95"]
+    line = (f"{result['path']:>7} {result['protocol']:>6} {result['num_channels']:>3} {result['fs']:>7.0f} "
+            f"{result['samples_per_s']:>10.0f} {'-' if e2e is None else f'{e2e:.1f}':>8} "
+            f"{'-' if frame is None else f'{frame:.2f}':>8} "
+            f"{result['queue_depth']['max']:>7} {'-' if result['dropped'] is None else result['dropped']:>6} "
+            f"{result['peak_memory_kb']:>9.0f}")
+    if baseline is not None:
+        line += f"  rate {100 * (result['samples_per_s'] / baseline['samples_per_s'] - 1):+.1f}%"
+        old = baseline["latency_ms"]["frame"]["p95"]
+        if old and frame is not None:
+            line += f", frame p95 {100 * (frame / old - 1):+.1f}%"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "End-to-end acquisition throughput and latency benchmark")
+    parser.add_argument("--rates", type = float, nargs = "+", default = [80, 1000, 5000, 20000])
+    parser.add_argument("--channels", type = int, nargs = "+", default = [2, 8])
+    parser.add_argument("--protocols", nargs = "+", choices = ["ascii", "binary"], default = ["binary", "ascii"])
+    parser.add_argument("--paths", nargs = "+", choices = ["engine", "legacy"], default = ["engine"])
+    parser.add_argument("--duration", type = float, default = 2.0, help = "seconds per configuration")
+    parser.add_argument("--out", default = None, help = "results file (default pipeline_benchmark_<date>.json)")
+    parser.add_argument("--compare", default = None, help = "earlier results file to compare against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {key(result): result for result in json.load(f)["results"]}
+
+    print(f"{'path':>7} {'proto':>6} {'ch':>3} {'fs':>7} {'samples/s':>10} {'e2e p95':>8} {'frame p95':>8} "
+          f"{'q max':>7} {'drops':>6} {'peak kB':>9}")
+    results = []
+    for path in args.paths:
+        for protocol in args.protocols:
+            for num_channels in args.channels:
+                for fs in args.rates:
+                    result = run(path, fs, num_channels, protocol, args.duration)
+                    results.append(result)
+                    print_result(result, baseline.get(key(result)))
+
+    out = args.out or time.strftime("pipeline_benchmark_%Y%m%d_%H%M%S.json")
+    with open(out, "w") as f:
+        json.dump({"environment": environment(), "duration": args.duration, "results": results}, f, indent = 2)
+    print("Saved", out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def minmax_envelope(y: np.ndarray, n_bins: int):
+    """ Splits y into n_bins equal bins and returns the (mins, maxs) of each bin.
+    Samples left over after the last full bin are folded into it."""
+    bin_size = len(y) // n_bins
+    full = y[:bin_size * n_bins].reshape(n_bins, bin_size)
+    mins = full.min(axis=1)
+    maxs = full.max(axis=1)
+    if len(y) > bin_size * n_bins:
+        tail = y[bin_size * n_bins:]
+        mins[-1] = min(mins[-1], tail.min())
+        maxs[-1] = max(maxs[-1], tail.max())
+    return mins, maxs
+
+
+class MinMaxDecimator:
+    """
+    Reduces a trace to a min/max envelope with about two points per pixel for plotting.
+    Each bin is drawn as a vertical segment from its min to its max, so peaks survive
+    decimation. The x arrays are cached per (trace length, pixel width), so redrawing the
+    same sized buffer does not rebuild them.
+
+    By default x is the sample index. Given the time of every sample, x is the time of
+    the first sample of each bin instead.
+    """
+
+    def __init__(self):
+        self._x_cache = {}
+
+    def sample_index(self, n: int, n_bins: int) -> np.ndarray:
+        """ Index of the sample each plotted point is drawn at"""
+        key = (n, n_bins)
+        index = self._x_cache.get(key)
+        if index is None:
+            if 2 * n_bins >= n:
+                index = np.arange(n)
+            else:
+                starts = np.arange(n_bins) * (n // n_bins)
+                index = np.repeat(starts, 2)
+            self._x_cache[key] = index
+        return index
+
+    def x_axis(self, n: int, n_bins: int) -> np.ndarray:
+        return self.sample_index(n, n_bins).astype(np.float64)
+
+    def decimate(self, y: np.ndarray, pixels: int, t: np.ndarray | None = None):
+        """ Returns (x, y) to plot, with at most 2 * pixels points. x is taken from t,
+        the time of each sample, when given"""
+        n = len(y)
+        n_bins = max(1, int(pixels))
+        index = self.sample_index(n, n_bins)
+        x = index.astype(np.float64) if t is None else t[index]
+        if 2 * n_bins >= n:
+            # The envelope would have as many points as the trace itself
+            return x, y
+        mins, maxs = minmax_envelope(y, n_bins)
+        env = np.empty(2 * n_bins, dtype=y.dtype)
+        env[0::2] = mins
+        env[1::2] = maxs
+        return x, env
@@ -1,24 +1,128 @@
 import numpy as np
+import timing
+from calibration import Calibration, load_calibration
 
 class ProbeBuffer:
     """
     Manages all the data streams for the cervical probe
+
+    In "shift" mode the whole buffer is moved on every append, as before. In "ring" mode
+    the samples are written at a moving index into a doubled (mirrored) array, so appends
+    cost O(n) in the number of new samples and the ordered contents are always available
+    as one contiguous, zero-copy view.
+
+    Raw samples are copied into the buffer and calibrated in place there, so adding data
+    allocates nothing. If no calibration is given, the latest revision for probe_id is
+    loaded from the calibration store (the default load cell fit if there is none).
+
+    Alongside the samples the buffer keeps each sample's host time (timing.now() clock,
+    in seconds), so the contents can be plotted and analysed on a real time axis. Blocks
+    added without times are placed 1 / fs after the previous sample.
     """
 
-    def __init__(self, num_channels: int, fs: int):
+    def __init__(self, num_channels: int, fs: int, mode: str = "shift", calibration: Calibration | None = None, probe_id: str = "default"):
+        if mode not in ("shift", "ring"):
+            raise ValueError(f"Unknown buffer mode: {mode}")
         self.fs = fs
+        self.mode = mode
+        self.num_channels = num_channels
         self.bufsize = 10 * fs
-        self.bufdata: np.ndarray = np.zeros((self.bufsize, num_channels))
-        self.cal_slope = -0.0000084
-        self.cal_intercept = -0.5655986
-    
-    def add_data(self, data: np.ndarray):
+        # Total number of samples ever added, used by consumers to detect new data
+        self.total_written = 0
+        # Until real samples arrive the buffer is taken to end now, sampled at fs
+        start_times = timing.now() - np.arange(self.bufsize, 0, -1) / fs
+        if mode == "ring":
+            # Every sample is written twice, at idx and idx + bufsize, so that
+            # _ring[idx:idx + bufsize] is always the ordered buffer.
+            self._ring: np.ndarray = np.zeros((2 * self.bufsize, num_channels))
+            self._time_ring: np.ndarray = np.tile(start_times, 2)
+            self._idx = 0
+        else:
+            self._bufdata: np.ndarray = np.zeros((self.bufsize, num_channels))
+            self._times: np.ndarray = start_times
+        if calibration is None:
+            calibration = load_calibration(probe_id, num_channels)
+        self.probe_id = probe_id
+        self.calibration = calibration
+
+    @property
+    def bufdata(self) -> np.ndarray:
+        """ The buffer contents, oldest sample first"""
+        if self.mode == "ring":
+            return self.ordered()
+        return self._bufdata
+
+    def add_data(self, data: np.ndarray, times: np.ndarray | None = None):
+        """ Adds a block of raw samples, with the host time of each sample if known"""
         n = len(data)
-        self.bufdata[:-n] = self.bufdata[n:]
-        data = self.convert_to_newtons(data)
-        self.bufdata[-n:] = data
+        if n == 0:
+            return
+        if times is None:
+            times = self.times()[-1] + np.arange(1, n + 1) / self.fs
+        if self.mode == "ring":
+            self._add_ring(data, times)
+        else:
+            self._bufdata[:-n] = self._bufdata[n:]
+            self._bufdata[-n:] = data
+            self.convert_to_newtons(self._bufdata[-n:])
+            self._times[:-n] = self._times[n:]
+            self._times[-n:] = times[-self.bufsize:]
+        self.total_written += n
+
+    def _add_ring(self, data: np.ndarray, times: np.ndarray):
+        """ Writes a block at the write index, wrapping around the end of the ring"""
+        n = len(data)
+        size = self.bufsize
+        if n >= size:
+            # Only the newest bufsize samples survive
+            data = data[-size:]
+            times = times[-size:]
+            self._idx = (self._idx + n - size) % size
+            n = size
+        i = self._idx
+        first = min(n, size - i)
+        head = self._ring[i:i + first]
+        head[:] = data[:first]
+        self.convert_to_newtons(head)
+        self._ring[i + size:i + size + first] = head
+        self._time_ring[i:i + first] = times[:first]
+        self._time_ring[i + size:i + size + first] = times[:first]
+        rest = n - first
+        if rest:
+            tail = self._ring[:rest]
+            tail[:] = data[first:]
+            self.convert_to_newtons(tail)
+            self._ring[size:size + rest] = tail
+            self._time_ring[:rest] = times[first:]
+            self._time_ring[size:size + rest] = times[first:]
+        self._idx = (i + n) % size
+
+    def ordered(self) -> np.ndarray:
+        """ Returns the buffer, oldest sample first. In ring mode this is a view, not a copy"""
+        if self.mode == "ring":
+            return self._ring[self._idx:self._idx + self.bufsize]
+        return self._bufdata
+
+    def latest(self, n: int) -> np.ndarray:
+        """ Returns a view of the newest n samples, oldest first"""
+        n = min(n, self.bufsize)
+        if n <= 0:
+            return self.ordered()[:0]
+        return self.ordered()[-n:]
+
+    def times(self) -> np.ndarray:
+        """ Host time of every sample in ordered(), oldest first"""
+        if self.mode == "ring":
+            return self._time_ring[self._idx:self._idx + self.bufsize]
+        return self._times
+
+    def latest_times(self, n: int) -> np.ndarray:
+        """ Host times of the newest n samples, matching latest(n)"""
+        n = min(n, self.bufsize)
+        if n <= 0:
+            return self.times()[:0]
+        return self.times()[-n:]
 
     def convert_to_newtons(self, data: np.ndarray):
-        data_array = np.array(data)
-        data_array[:,1] = 1 * (data_array[:,1] * self.cal_slope + self.cal_intercept)
-        return data_array.tolist()
\ No newline at end of file
+        """ Calibrates a float block of raw samples in place and returns it"""
+        return self.calibration.apply(data)
@@ -1,24 +1,56 @@
 import serial
 import time
-import random
 import threading
 from queue import Queue
+import numpy as np
+import probe_protocol as pp
+import timing
+from sample_queue import SampleBlockQueue
+from serial_engine import SerialEngine
+from probe_simulator import ProbeSimulator
 
 
 
 class CervicalProbe:
     """
     Interfaces with the Cervical probe. Handles data streaming and sending commands
+
+    protocol selects the wire format of the data stream: "ascii" reads one CSV line per
+    sample (the fallback), "binary" reads fixed-size frames in bulk and decodes them into
+    whole arrays. The probe firmware must be streaming the matching format.
+
+    With use_engine, the port is owned by a SerialEngine instead of a blocking read loop:
+    it reconnects on its own, stops immediately, and interleaves commands with the reads.
+    The engine streams into a SampleBlockQueue.
     """
 
-    def __init__(self):
+    def __init__(self, protocol: str = "ascii", num_channels: int = 2, port: str = 'COM3', baudrate: int = 115200,
+                 use_engine: bool = False):
+        if protocol not in ("ascii", "binary"):
+            raise ValueError(f"Unknown protocol: {protocol}")
+        self.protocol = protocol
+        self.num_channels = num_channels
+        self.port = port
+        self.baudrate = baudrate
+        self.decoder = pp.BinaryFrameDecoder(num_channels)
+        self.engine = None
         self.connected = False
-        self.connect()
+        if use_engine:
+            # The engine opens the port itself once streaming starts
+            self.engine = SerialEngine(port, baudrate, protocol, num_channels)
+            self.rate = self.engine.rate
+        else:
+            self.rate = timing.RateEstimator()
+            self.connect()
         
     def connect(self):
         if not self.connected:
             try:
-                self.ser = serial.Serial('COM3', 115200, timeout = 1)
+                if isinstance(self.port, str):
+                    self.ser = serial.Serial(self.port, self.baudrate, timeout = 1)
+                else:
+                    # A probe_simulator.ProbeSimulator
+                    self.ser = self.port.open(timeout = 1)
                 self.connected = True
             except:
                 print("Failed to connect")
@@ -26,6 +58,10 @@ class CervicalProbe:
             print("Already connected")
 
     def disconnect(self):
+        if self.engine is not None:
+            self.engine.stop()
+            print("Disconnected")
+            return
         try:
             self.ser.close()
             self.connected = False
@@ -34,6 +70,10 @@ class CervicalProbe:
             print("Failed to disconnect")
 
     def send_command(self,command):
+        if self.engine is not None:
+            # Written by the engine's I/O thread between reads
+            self.engine.send_command(command)
+            return
         # encodes the string to bytes
         self.ser.write(command.encode('utf-8') + b'\n')
 
@@ -43,44 +83,101 @@ class CervicalProbe:
         data = self.ser.readline().decode('utf-8').rstrip().split(",") 
         data = [float(i) for i in data]
         return data
+
+    def receive_block(self):
+        # Reads everything waiting on the port (at least one frame, or until the timeout)
+        # and decodes all the complete frames at once
+        size = max(self.ser.in_waiting, self.decoder.frame_size)
+        chunk = self.ser.read(size)
+        return self.decoder.feed(chunk)
     
-    def handle_stream(self, queue: Queue[list[float]]):
+    def handle_stream(self, queue: Queue[list[float]] | SampleBlockQueue):
+        if self.engine is not None:
+            self.start_stream()
+            self.engine.start(queue)
+            return
         assert self.connected
         self.start_stream()
+        # A SampleBlockQueue gets whole blocks, a plain Queue gets one list per sample
+        if isinstance(queue, SampleBlockQueue):
+            target = self.stream_worker_batched
+        else:
+            target = self.stream_worker
         self.worker_thread = threading.Thread(
-            target = self.stream_worker, args = (queue,))
+            target = target, args = (queue,))
         self.worker_thread.start()
         # Make the thread a daemon
         self.worker_thread.deamon = True
     
     def stream_worker(self, queue: Queue[list[float]]):
+        if self.protocol == "binary":
+            while self.streaming == True:
+                block = self.receive_block()
+                for data in block.tolist():
+                    queue.put(data)
+            return
         while self.streaming == True:
             data = self.receive_data()
             queue.put(data)
-        
+
+    def stream_worker_batched(self, queue: SampleBlockQueue, batch_size: int = 32, max_wait: float = 0.01):
+        """ Hands samples to the queue in NumPy blocks rather than one list per sample"""
+        if self.protocol == "binary":
+            while self.streaming == True:
+                block = self.receive_block()
+                if len(block):
+                    timestamp = timing.now()
+                    self.rate.update(len(block), timestamp, self.decoder.last_seq)
+                    queue.put(block, timestamp, self.decoder.last_seq)
+            return
+        # ASCII lines arrive one at a time, so gather them into a block and flush it
+        # when it is full or when max_wait seconds have passed since the last flush
+        block = np.zeros((batch_size, self.num_channels))
+        n = 0
+        last_flush = time.monotonic()
+        while self.streaming == True:
+            try:
+                block[n] = self.receive_data()
+                n += 1
+            except ValueError:
+                # Empty line on timeout, or a malformed line
+                pass
+            if n == batch_size or (n and time.monotonic() - last_flush >= max_wait):
+                timestamp = timing.now()
+                self.rate.update(n, timestamp)
+                queue.put(block[:n], timestamp)
+                n = 0
+                last_flush = time.monotonic()
+        if n:
+            queue.put(block[:n])
+
     def start_stream(self):
         #assert self.connected
         self.streaming = True
 
     def stop_stream(self):
         self.streaming = False
+        if self.engine is not None and self.engine.running:
+            self.engine.stop()
+            print("Serial engine stopped!")
+            return
         try:
             self.worker_thread.join()
             print("Streaming thread joined!")
         except:
             print("Unable to close streaming thread")
 
-    def handle_stream_spoof(self, queue: Queue[list[float]]):
-        self.start_stream()
-        self.worker_thread = threading.Thread(
-            target = self.stream_worker_spoof, args = (queue,))
-        self.worker_thread.start()
-        # Make the thread a daemon
-        self.worker_thread.deamon = True
-
-    def stream_worker_spoof(self, queue: Queue[list[float]]):
-        while self.streaming == True:
-            data = [random.randint(10, 20), random.randint(1, 5)]
-            time.sleep(.0125)
-            queue.put(data)
+    def handle_stream_spoof(self, queue: Queue[list[float]] | SampleBlockQueue, simulator: ProbeSimulator | None = None):
+        """ Streams from a simulated probe instead of the serial port. The simulator answers
+        extend and retract like the real probe; by default it runs at 80 Hz in this
+        client's protocol"""
+        if simulator is None:
+            simulator = ProbeSimulator(protocol = self.protocol, num_channels = self.num_channels)
+        self.simulator = simulator
+        if self.engine is not None:
+            self.engine.port = simulator
+        else:
+            self.ser = simulator.open()
+            self.connected = True
+        self.handle_stream(queue)
         
\ No newline at end of file
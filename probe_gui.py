@@ -1,20 +1,108 @@
 import numpy as np
 import probe_client as pc
 import time
-from queue import Queue
+from queue import Queue, Empty
 import probe_buffer as pb
+from acquisition_manager import AcquisitionManager
+import acquisition_daemon
+from plot_decimation import MinMaxDecimator
+from lod_pyramid import MinMaxPyramid, load_or_build
+from session_recorder import SessionRecorder
+import session_format as sf
+import stiffness_analysis as sa
+from online_rep_detector import OnlineRepDetector
+from stream_filters import FilterBank, RunningMedian
+from range_max import SparseTableMax
+from background_jobs import JobRunner, JobCancelled
+import stiffness_protocol as sp
+from probe_simulator import ProbeSimulator
+from calibration import load_calibration
+from session_catalog import SessionCatalog, DEFAULT_CATALOG_NAME
+from analysis_cache import default_cache
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QTreeView, QFileSystemModel, QRadioButton, QLineEdit, QLabel
-from PyQt5.QtCore import QTimer, QDir
+from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QTableWidget, QTableWidgetItem, QAbstractItemView, QRadioButton, QLineEdit, QLabel
+from PyQt5.QtCore import QTimer, Qt, pyqtSignal
 from pyqtgraph import PlotWidget
 import pyqtgraph as pg
 import os
 import random
-import threading
-import copy
+from functools import partial
+
+
+# Change point detection grows quadratically with the session length and holds the
+# interpreter while it runs, so longer sessions (long recordings rather than stiffness
+# trials) are not analysed automatically
+AUTO_ANALYSIS_MAX_SAMPLES = 5000
+
+
+def prepare_recall(source, cancel = None):
+    """ Loads a session (when source is a path), builds the range max index over its
+    force, and the level of detail pyramid the recall plots are drawn from, which is cached
+    next to a session file. Runs on the worker pool, off the GUI thread. Returns
+    (data, index, pyramid)"""
+
+    def check():
+        # Called between chunks of the builds, so a superseded job stops early
+        if cancel is not None and cancel.is_set():
+            raise JobCancelled
+
+    data = sf.load_session(source).data if isinstance(source, str) else source
+    check()
+    # Reading the force column pages a memory-mapped session in
+    index = SparseTableMax(data[:,1], check = check)
+    if isinstance(source, str):
+        pyramid = load_or_build(source, data, check)
+    else:
+        pyramid = MinMaxPyramid.build(data, check = check)
+    return data, index, pyramid
+
+
+def drain_sample_queue(q, filter_bank, buffer):
+    """ The per-sample path's consumer: pulls the sample lists waiting on q item by item,
+    filters them as one block and adds it to buffer. Returns the calibrated block as
+    buffered, empty when nothing arrived"""
+    items = []
+    while not q.empty():
+        try:
+            items.append(q.get_nowait())
+        except Empty:
+            break
+    if not items:
+        return buffer.latest(0)
+    block = filter_bank.process(np.asarray(items, dtype=np.float64))
+    buffer.add_data(block)
+    # The newest samples in the buffer are the calibrated block
+    return buffer.latest(len(block))
+
+
+def draw_live(buffer, decimator, lines):
+    """ Draws the buffer on the live plots. lines holds (plot widget, curve, channel);
+    each curve gets a min/max envelope sized to the width of its plot, against seconds
+    before the newest sample"""
+    # Zero-copy view of the ring buffer, oldest sample first
+    window = buffer.ordered()
+    # Seconds before the newest sample, from the host time stamped on each block
+    t = buffer.times() - buffer.times()[-1]
+    for plot, curve, channel in lines:
+        x, y = decimator.decimate(window[:, channel], plot.width(), t)
+        curve.setData(x, y)
+
+
+def detect_session_reps(path, params, cancel = None):
+    """ Detects the reps of a session file on the worker pool, separately from loading it
+    so a long session is shown before it is analysed. The analysis cache answers it when
+    the file was analysed with the same params before. Returns None for a session longer
+    than AUTO_ANALYSIS_MAX_SAMPLES"""
+    if sf.num_samples(path) > AUTO_ANALYSIS_MAX_SAMPLES:
+        return None
+    return default_cache().analyze_file(path, **params)
 
 
 class MainWindow(QMainWindow):
+    SESSION_COLUMNS = ["Session", "Modified", "Samples", "Duration (s)", "E mean", "E std", "E per rep"]
+    # Emitted from the recorder's writer thread once it has closed the session file
+    recording_finished = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
 
@@ -35,13 +123,21 @@ class MainWindow(QMainWindow):
         # This is the callback graph for a previous reading force
         self.recall_force = pg.PlotWidget()
 
-        # Create an instance of the probe
-        self.probe = pc.CervicalProbe()
-        # Create the data queue to pass to the probe client
-        self.data_q = Queue()
-        # Initialize data session list to be saved
+        # Initialize probe parameters
+        self.num_channels = 2
+        self.fs = 80 # Sampling frequency
+        self.h = 0.004 # indentation in meters
+        self.v = 0.5 # What is this?
+        self.R = 0.0024052 # radius of the probe in meters
+        self.probe_name = "probe_1" # Name of the displayed probe in the acquisition manager
+        self.probe_id = "default" # Calibration store entry for this probe
+
+        # Initialize data session list to be saved, and the streaming recorder (None when idle)
+        self.recorder = None
         self.data_session = []
         self.loaded_data = []
+        # Detection windows placed at the reps found in the loaded session, if any
+        self.loaded_windows = None
 
         # Initialize the probe state estimation
         # Idea! Use a kalman filter to estimate the state of the probe.
@@ -49,18 +145,52 @@ class MainWindow(QMainWindow):
         # When the probe is not moving AND there is no command in the queue,
         # then self.Busy = False.
 
-
-        # Initialize probe parameters
-        self.num_channels = 2
-        self.fs = 80 # Sampling frequency
-        self.h = 0.004 # indentation in meters
-        self.v = 0.5 # What is this?
-        self.R = 0.0024052 # radius of the probe in meters
-
-        # Create the data buffer to hold the data
-        self.data_buffer = pb.ProbeBuffer(self.num_channels, self.fs)
-        # Initialize the stream
-        self.probe.handle_stream(self.data_q)
+        # Initialize the live filter bank, applied to each block between the queue and the
+        # buffer. Position gets the running median tried in filter_testing.py; for a
+        # smoother state estimate use stream_filters.KalmanSmoother, or SosLowpass for force.
+        self.filter_bank = FilterBank(self.num_channels)
+        self.filter_bank.add(RunningMedian(5), channels = [0])
+
+        # Initialize the online rep detector, which reports each rep's forces as it happens
+        self.rep_detector = OnlineRepDetector()
+        self.live_fi = 0
+        self.live_stiffness = []
+
+        # Create the probe, its data queue and its buffer. The batched path runs the probe
+        # through the acquisition manager, which hands over one contiguous array per tick
+        # (more probes can be added with self.acquisition.add_probe). Set batched to False
+        # for the original per-sample Queue.
+        # Set simulate to True to stream from a simulated probe and tissue instead of COM3.
+        # Set attach to True to read the probe from a running acquisition daemon
+        # (python acquisition_daemon.py serve --name probe_1) through shared memory, so
+        # rendering in this process cannot cause dropped samples.
+        self.batched = True
+        self.simulate = False
+        self.attach = False
+        if self.batched:
+            self.acquisition = AcquisitionManager()
+            if self.attach:
+                channel = acquisition_daemon.attach(self.acquisition, self.probe_name)
+            else:
+                port = 'COM3'
+                if self.simulate:
+                    port = ProbeSimulator(fs = self.fs, h = self.h, R = self.R, v = self.v,
+                                          calibration = load_calibration(self.probe_id, self.num_channels))
+                # The serial engine keeps retrying the port, so the GUI starts even when the
+                # probe is unplugged and picks it up once it appears
+                channel = self.acquisition.add_probe(self.probe_name, port = port, baudrate = 115200, fs = self.fs,
+                                                     probe_id = self.probe_id, filter_bank = self.filter_bank)
+            self.probe = channel.probe
+            self.data_q = channel.queue
+            self.data_buffer = channel.buffer
+            self.acquisition.subscribe(self.on_samples, probes = [self.probe_name])
+            # Initialize the stream
+            self.acquisition.start()
+        else:
+            self.probe = pc.CervicalProbe()
+            self.data_q = Queue()
+            self.data_buffer = pb.ProbeBuffer(self.num_channels, self.fs, mode = "ring", probe_id = self.probe_id)
+            self.probe.handle_stream(self.data_q)
 
         # This is where we plot the data
         # Real time feed
@@ -70,6 +200,11 @@ class MainWindow(QMainWindow):
         # Callback feed
         self.recall_force_line = self.recall_pos.plot([], [], pen = 'red')
         self.recall_pos_line  = self.recall_force.plot([], [], pen = 'green')
+        # Each recall plot with its line and data channel. Only the part of the session in
+        # view is drawn, at the level of detail matching the plot width
+        self.recall_plots = [(self.recall_pos, self.recall_force_line, 1), (self.recall_force, self.recall_pos_line, 0)]
+        for plot, line, channel in self.recall_plots:
+            plot.sigXRangeChanged.connect(self.draw_recall)
 
         # Initialize plot detection windows
         num_reps = 3 # Number of repetitions in a single trial
@@ -100,43 +235,94 @@ class MainWindow(QMainWindow):
                     line.addMarker('<|')
                 else:
                     line.addMarker('|')
+                line.sigPositionChanged.connect(self.line_moving)
                 line.sigPositionChangeFinished.connect(self.line_pos)
                 self.recall_pos.addItem(line)
                 #self.recall_force.addItem(line)
                 self.detection_windows[rep].insert(i,line)
 
 
+        # Range max index over each recall trace, built once per session so that any
+        # detection window max is answered in O(1). Maps the mode to (data, index).
+        self.range_index = {}
+        # The session each mode's job in flight is preparing
+        self.preparing = {}
+        # The level of detail pyramid of each mode's session, (data, pyramid)
+        self.recall_lod = {}
+        # Sessions are loaded and indexed on a worker pool so the live plot keeps its
+        # cadence. A new job for a mode cancels the one still running for it
+        self.jobs = JobRunner()
+        self.jobs.finished.connect(self.on_job_finished)
+        self.jobs.failed.connect(self.on_job_failed)
+        # Index of the sessions in the data directory, with their stiffness precomputed,
+        # that the file browser lists, searches and sorts without opening the files
+        os.makedirs(self.data_path, exist_ok = True)
+        self.catalog = SessionCatalog(os.path.join(self.data_path, DEFAULT_CATALOG_NAME))
+        # Debounce the force/stiffness label refresh while detection lines are dragged
+        self.window_refresh_timer = QTimer()
+        self.window_refresh_timer.setSingleShot(True)
+        self.window_refresh_timer.setInterval(50)  # Interval in milliseconds
+        self.window_refresh_timer.timeout.connect(self.refresh_windows)
+        # Debounce the session search, so the catalog is queried once typing pauses
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(250)  # Interval in milliseconds
+        self.search_timer.timeout.connect(self.populate_sessions)
+        self.recording_finished.connect(self.on_recording_finished)
+
         self.init_ui()
+        self.populate_sessions()
+        self.rescan_sessions()
 
-        # Initialize the timer to record all the data in the buffer
-        self.record_timer = QTimer()
-        self.record_timer.setSingleShot(True)
-        self.record_timer.setInterval(7000)  # Interval in milliseconds
-        self.record_timer.timeout.connect(self.record_buffer)
+        # Initialize the stiffness test protocol. The scheduler issues its commands from
+        # protocol_timer against the monotonic clock, and the session is recorded when the
+        # last step ends
+        self.protocol = sp.StiffnessProtocol(num_reps = num_reps, depth = self.h)
+        self.scheduler = None
+        self.protocol_timer = QTimer()
+        self.protocol_timer.setInterval(5)  # Interval in milliseconds
+        self.protocol_timer.timeout.connect(self.protocol_tick)
 
 
+        # Initialize the live plot decimation, and the sample count at the last redraw
+        self.decimator = MinMaxDecimator()
+        self.last_plotted = -1
+
         # Initialize the timer to update the live plot
         self.timer = QTimer()
         self.timer.setInterval(33)  # Interval in milliseconds
         self.timer.timeout.connect(self.update_plot_data)
         self.timer.start()
 
+        # Initialize the timer to refresh the acquisition metrics
+        self.metrics_timer = QTimer()
+        self.metrics_timer.setInterval(1000)  # Interval in milliseconds
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start()
+
     def init_ui(self):
         """ Initializes the user interface. Defines the button and graph layout"""
 
         # Main Layout ()
         main_layout = QHBoxLayout()
 
-        # Sets up file system model
-        self.model = QFileSystemModel()
-        self.model.setRootPath(self.data_path)
+        # Sets up the session browser, listing the session catalog
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search sessions")
+        self.search_edit.textChanged.connect(self.search_timer.start)
+
+        self.rescan_btn = QPushButton('Rescan')
+        self.rescan_btn.clicked.connect(self.rescan_sessions)
 
-        self.tree = QTreeView()
-        self.tree.setModel(self.model)
-        self.tree.setRootIndex(self.model.index(self.data_path))
+        self.tree = QTableWidget(0, len(self.SESSION_COLUMNS))
+        self.tree.setHorizontalHeaderLabels(self.SESSION_COLUMNS)
         self.tree.setColumnWidth(0, 250)
+        self.tree.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.tree.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.tree.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.tree.verticalHeader().setVisible(False)
         self.tree.setSortingEnabled(True)
-        self.tree.selectionModel().selectionChanged.connect(self.onSelectionChanged)
+        self.tree.itemSelectionChanged.connect(self.onSelectionChanged)
 
         
         # File Explorer Layout (column 1)
@@ -155,6 +341,10 @@ class MainWindow(QMainWindow):
         # Add the tree view for the file explorer
         col1.addWidget(self.radio1)
         col1.addWidget(self.radio2)
+        search_layout = QHBoxLayout()
+        search_layout.addWidget(self.search_edit)
+        search_layout.addWidget(self.rescan_btn)
+        col1.addLayout(search_layout)
         col1.addWidget(self.tree)
         
         # Callback Plot Layout (column 2)
@@ -200,9 +390,19 @@ class MainWindow(QMainWindow):
 
         # Real Time Plot Layout (column 3)
         layout = QVBoxLayout()
+        self.graphWidget1.setLabel('bottom', 'Time (s)')
+        self.graphWidget2.setLabel('bottom', 'Time (s)')
         layout.addWidget(self.graphWidget1)
         layout.addWidget(self.graphWidget2)
 
+        # Per-rep stiffness computed live by the online rep detector
+        self.live_label = QLabel("Live Stiffness: waiting for reps")
+        layout.addWidget(self.live_label)
+
+        # Measured sample rate, drops and how far the display is behind the probe
+        self.metrics_label = QLabel("Rate: waiting for samples")
+        layout.addWidget(self.metrics_label)
+
         # Lower Sublayout (Holds buttons)
         sublay2 = QHBoxLayout()
 
@@ -233,6 +433,10 @@ class MainWindow(QMainWindow):
         save_btn = QPushButton('Save Data', self)
         save_btn.clicked.connect(self.save_data)  # Connect to a function
         sublay2.addWidget(save_btn)
+        # Record Button, streams the session to disk until pressed again
+        self.rec_btn = QPushButton('Start Recording', self)
+        self.rec_btn.clicked.connect(self.toggle_recording)  # Connect to a function
+        sublay2.addWidget(self.rec_btn)
 
 
 
@@ -258,27 +462,63 @@ class MainWindow(QMainWindow):
             except:
                 print("No data to display.")
         elif self.radio2.isChecked():
+            if self.loaded_windows is not None:
+                self.set_detection_windows(self.loaded_windows)
             try:
                 print("Displaying Loaded Session Data.")
                 self.update_callback_plot()
             except:
                 print("No data to display.")
 
-    def onSelectionChanged(self, selected, deselected):
-        # Get the model index of the first selected item
-        index = self.tree.selectionModel().currentIndex()
-        # Check if the index is valid
-        if index.isValid():
-            # Get the file path from the model index
-            self.filePath = self.model.filePath(index)
+    def onSelectionChanged(self):
+        # Get the session of the selected row
+        items = self.tree.selectedItems()
+        if items:
+            self.filePath = self.tree.item(items[0].row(), 0).data(Qt.UserRole)
             print("Selected file:", self.filePath)
+            # Displayed by on_job_finished once it has loaded
             self.load_data()
-            if self.radio2.isChecked():
-                try:
-                    print("Displaying Loaded Session Data.")
-                    self.update_callback_plot()
-                except:
-                    print("No data to display.")
+
+    def rescan_sessions(self):
+        """ Indexes new and changed sessions on the worker pool. The browser is
+        repopulated when the catalog is up to date"""
+        refresh = partial(self.catalog.refresh, max_samples = AUTO_ANALYSIS_MAX_SAMPLES)
+        self.jobs.submit("catalog", refresh, self.data_path)
+
+    def populate_sessions(self):
+        """ Lists the catalog sessions matching the search text, keeping the selected
+        session selected if it is still listed"""
+        rows = self.catalog.query(self.search_edit.text())
+        items = self.tree.selectedItems()
+        selected = self.tree.item(items[0].row(), 0).data(Qt.UserRole) if items else None
+        # Rebuilding the table is not a new selection, so the session is not reloaded
+        self.tree.blockSignals(True)
+        self.tree.setSortingEnabled(False)
+        self.tree.clearContents()
+        self.tree.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            values = [
+                row["name"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(row["mtime"])),
+                row["num_samples"],
+                row["duration"],
+                row["E_mean"],
+                row["E_std"],
+                ", ".join(f"{E:.0f}" for E in row["stiffness"]) or row["error"],
+            ]
+            for j, value in enumerate(values):
+                item = QTableWidgetItem()
+                # Numbers are stored as numbers so the columns sort numerically
+                item.setData(Qt.DisplayRole, round(value, 2) if isinstance(value, float) else value)
+                self.tree.setItem(i, j, item)
+            self.tree.item(i, 0).setData(Qt.UserRole, row["path"])
+        self.tree.setSortingEnabled(True)
+        # Sorting moved the rows, so look the selected session up afterwards
+        for i in range(self.tree.rowCount()):
+            if selected is not None and self.tree.item(i, 0).data(Qt.UserRole) == selected:
+                self.tree.selectRow(i)
+                break
+        self.tree.blockSignals(False)
     
     def closeEvent(self, event):
         """ This function is called when the window is closing"""
@@ -288,20 +528,46 @@ class MainWindow(QMainWindow):
     def cleanup(self):
         """ Stops the probe stream and disconnects from the serial connection on closure"""
         print("Joining threads...")
-        self.probe.stop_stream()
-        print("Terminating serial connection...")
-        self.probe.disconnect()
+        self.jobs.shutdown()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.protocol_timer.stop()
+        if self.batched:
+            self.acquisition.stop()
+            self.acquisition.close()
+        else:
+            self.probe.stop_stream()
+            print("Terminating serial connection...")
+            self.probe.disconnect()
+        if self.recorder is not None:
+            # The window is closing, so wait for the file to be written out
+            recorder = self.recorder
+            self.stop_recording()
+            recorder.wait()
 
     def update_plot_data(self):
         """ Graphs data from the probe data buffer"""
         self.queue_to_buffer()
-        y_force = self.data_buffer.bufdata[:,1] 
-        y_pos = self.data_buffer.bufdata[:,0]
-        x = list(range(len(y_force)))
-        
-        #self.graphWidget2.setOpts(height=new_height)
-        self.force_line.setData(x, y_force)  # Update the data
-        self.pos_line.setData(x, y_pos)
+        # Skip the redraw if no new samples arrived since the last frame
+        if self.data_buffer.total_written == self.last_plotted:
+            return
+        self.last_plotted = self.data_buffer.total_written
+        # Push only a min/max envelope sized to the width of each plot
+        draw_live(self.data_buffer, self.decimator, [(self.graphWidget1, self.force_line, 1),
+                                                     (self.graphWidget2, self.pos_line, 0)])
+
+    def update_metrics(self):
+        """ Shows the measured sample rate and whether acquisition is keeping up"""
+        if not self.batched:
+            stats = self.probe.rate.stats()
+            self.metrics_label.setText(f"Rate: {stats['fs'] or 0:.1f} Hz, jitter {stats['jitter_ms']:.2f} ms")
+            return
+        m = self.acquisition.metrics()[self.probe_name]
+        self.metrics_label.setText(
+            f"Rate: {m['fs'] or 0:.1f} Hz, jitter {m['jitter_ms']:.2f} ms, "
+            f"dropped {m['device_dropped'] + m['dropped_samples']}, "
+            f"latency {m['latency_ms']:.0f} ms (max {m['max_latency_ms']:.0f}), "
+            f"queue {100 * m['queue_fill']:.0f}%")
 
     def line_pos(self, obj):
         """ This function is called when the detection lines are moved. It updates the self.det_current_bound attribute
@@ -328,83 +594,147 @@ class MainWindow(QMainWindow):
         self.detection_windows[keyIdx][1].setValue(m_upper) # The line object itself
         self.detection_windows[keyIdx][2].setValue(h_lower)  # The line object itself
         self.detection_windows[keyIdx][3].setValue(h_upper) # The line object itself
+        self.window_refresh_timer.start()
+
+    def line_moving(self, obj):
+        """ Called continuously while a detection line is dragged. Records the position and
+        schedules a label refresh, which runs once the line has been still for 50 ms"""
+        self.det_current_bound[obj.name()[0]][obj.name()[1]] = obj.value()
+        self.window_refresh_timer.start()
+
+    def range_index_for(self, mode, data):
+        """ Returns the range max index over the force of data, or None if it has not
+        been built for this session yet"""
+        cached = self.range_index.get(mode)
+        if cached is None or cached[0] is not data:
+            return None
+        return cached[1]
+
+    def on_job_finished(self, mode, result):
+        """ Receives a loaded and indexed session from the worker pool"""
+        if mode == "catalog":
+            print("Session catalog:", ", ".join(f"{n} {what}" for what, n in result.items()))
+            self.populate_sessions()
+            return
+        if mode == "reps":
+            if result is None:
+                return
+            # Windows picking out each detected rep's onset force and its peak
+            self.loaded_windows = [[fi, fi + 1, fi, ff + 1] for fi, ff in zip(result["fi_ind"].tolist(), result["ff_ind"].tolist())]
+            if self.radio2.isChecked():
+                self.set_detection_windows(self.loaded_windows)
+            return
+        data, index, pyramid = result
+        self.range_index[mode] = (data, index)
+        self.recall_lod[mode] = (data, pyramid)
+        if mode == "loaded":
+            self.loaded_data = data
+            print("Data loaded.")
+        if (mode == "current") == self.radio1.isChecked():
+            self.update_callback_plot()
+
+    def on_job_failed(self, mode, message):
+        if mode == "catalog":
+            print("Could not index the sessions.", message)
+        elif mode == "reps":
+            # Too short, or no reps to find: the windows are left for the user to place
+            print("Could not detect the reps.", message)
+        elif mode == "loaded":
+            print("Failed to load data. Check if file is in the correct format.", message)
+        else:
+            print("Could not analyse the current session.", message)
+
+    def refresh_windows(self):
+        """ Recomputes the window forces and stiffness from the cached range max index"""
+        if self.radio1.isChecked():
+            mode, data = "current", self.data_session
+        else:
+            mode, data = "loaded", self.loaded_data
+        if len(data) == 0:
+            return
+        index = self.range_index_for(mode, data)
+        if index is None:
+            # Prepares the session on the worker pool, which refreshes the labels when done
+            self.update_callback_plot()
+            return
+        self.calculate_force(data[:,1], index)
+        self.calculate_stiffness()
 
-    def calculate_force(self,input_force):
+    def calculate_force(self,input_force, range_index = None):
         """ Calculates/updates the force values from the detection windows"""
-        # Unpack the detection windows
-        r1_f0_start = self.det_current_bound[0][0]
-        r1_f0_end = self.det_current_bound[0][1]
-        r1_ff_start = self.det_current_bound[0][2]
-        r1_ff_end = self.det_current_bound[0][3]
-        r2_f0_start = self.det_current_bound[1][0]
-        r2_f0_end = self.det_current_bound[1][1]
-        r2_ff_start = self.det_current_bound[1][2]
-        r2_ff_end = self.det_current_bound[1][3]
-        r3_f0_start = self.det_current_bound[2][0]
-        r3_f0_end = self.det_current_bound[2][1]
-        r3_ff_start = self.det_current_bound[2][2]
-        r3_ff_end = self.det_current_bound[2][3]
-        # Get the force values from the detection windows
-        force = input_force[:]
-        ff = np.zeros((3))
-        fi = np.zeros((3))
-        ff[0], ff[1], ff[2] = np.max(force[r1_ff_start:r1_ff_end]), np.max(force[r2_ff_start:r2_ff_end]), np.max(force[r3_ff_start:r3_ff_end])
-        fi[0], fi[1], fi[2] = np.max(force[r1_f0_start:r1_f0_end]), np.max(force[r2_f0_start:r2_f0_end]), np.max(force[r3_f0_start:r3_f0_end])
+        # All the window maxima in one vectorized pass, rows are [f0_start, f0_end, ff_start, ff_end].
+        # Bounds are sorted pairwise here too, since lines may be mid-drag.
+        bounds = np.array(self.det_current_bound, dtype=int)
+        bounds[:, 0:2].sort(axis=1)
+        bounds[:, 2:4].sort(axis=1)
+        self.f0_val, self.ff_val = sa.rep_forces(input_force, bounds, range_index)
         # Update the force labels
-        self.f0_val = fi
-        self.ff_val = ff
-        self.f1_0.setText(f"Rep 1 Initial Force: {round(self.f0_val[0],3)}")
-        self.f1_f.setText(f"Rep 1 Final Force: {round(self.ff_val[0],3)}")
-        self.f2_0.setText(f"Rep 2 Initial Force: {round(self.f0_val[1],3)}")
-        self.f2_f.setText(f"Rep 2 Final Force: {round(self.ff_val[1],3)}")
-        self.f3_0.setText(f"Rep 3 Initial Force: {round(self.f0_val[2],3)}")
-        self.f3_f.setText(f"Rep 3 Final Force: {round(self.ff_val[2],3)}")
+        f0_labels = [self.f1_0, self.f2_0, self.f3_0]
+        ff_labels = [self.f1_f, self.f2_f, self.f3_f]
+        for rep in range(len(f0_labels)):
+            f0_labels[rep].setText(f"Rep {rep + 1} Initial Force: {round(self.f0_val[rep],3)}")
+            ff_labels[rep].setText(f"Rep {rep + 1} Final Force: {round(self.ff_val[rep],3)}")
 
     def calculate_stiffness(self):
         """ Takes the initial and force values and calculates the stiffness"""
-        P1 = self.ff_val[0] - self.f0_val[0] # force in newtons
-        P2 = self.ff_val[1] - self.f0_val[1] # force in newtons
-        P3 = self.ff_val[2] - self.f0_val[2] # force in newtons
-
-        self.stiffness[0] = (0.75 * P1 * (1 - self.v**2)) / (self.R**0.5 * self.h**(3/2))
-        self.stiffness[1] = (0.75 * P2 * (1 - self.v**2)) / (self.R**0.5 * self.h**(3/2))
-        self.stiffness[2] = (0.75 * P3 * (1 - self.v**2)) / (self.R**0.5 * self.h**(3/2))
-        self.stiffness_ave = np.mean(self.stiffness)
-        self.stiffness_dev = np.std(self.stiffness)
+        result = sa.stiffness_from_forces(self.f0_val, self.ff_val, self.h, self.R, self.v)
+        self.stiffness = result["E"]
+        self.stiffness_ave = result["E_mean"]
+        self.stiffness_dev = result["E_std"]
         # Update the stiffness labels
-        self.r1s.setText(f"Rep 1 Stiffness: {round(self.stiffness[0],3)}")
-        self.r2s.setText(f"Rep 2 Stiffness: {round(self.stiffness[1],3)}")
-        self.r3s.setText(f"Rep 3 Stiffness: {round(self.stiffness[2],3)}")
+        stiffness_labels = [self.r1s, self.r2s, self.r3s]
+        for rep in range(len(stiffness_labels)):
+            stiffness_labels[rep].setText(f"Rep {rep + 1} Stiffness: {round(self.stiffness[rep],3)}")
         self.s_ave.setText(f"Average Stiffness: {round(self.stiffness_ave,3)}")
         self.s_dev.setText(f"Stiffness Deviation: {round(self.stiffness_dev,3)}")
 
     def update_callback_plot(self):
-        """ Graphs data from the probe data buffer"""
+        """ Graphs the recalled session and updates its forces and stiffness. The session
+        is loaded, indexed and decimated on the worker pool the first time, and shown once
+        it is ready"""
         if self.radio1.isChecked():
-            try:
-                y_force = self.data_session[:,1] 
-                y_pos = self.data_session[:,0]
-                x = list(range(len(y_force)))
-                #self.graphWidget2.setOpts(height=new_height)
-                self.recall_force_line.setData(x, y_force)
-                self.recall_pos_line.setData(x, y_pos)
-                self.calculate_force(y_force)
-                self.calculate_stiffness()
-            except:
-                print("Could not display current data.")
+            mode, data = "current", self.data_session
         elif self.radio2.isChecked():
-            try:
-                y_force = self.loaded_data[:,1] 
-                y_pos = self.loaded_data[:,0]
-                x = list(range(len(y_force)))
-                #self.graphWidget2.setOpts(height=new_height)
-                self.recall_force_line.setData(x, y_force)
-                self.recall_pos_line.setData(x, y_pos)
-                self.calculate_force(y_force)
-                self.calculate_stiffness()
-            except:
-                print("Could not display loaded data.")
-    
+            mode, data = "loaded", self.loaded_data
+        else:
+            return
+        if len(data) == 0:
+            print(f"No {mode} data to display.")
+            return
+        index = self.range_index_for(mode, data)
+        if index is None:
+            # A session already being prepared is shown when its job finishes. Restarting
+            # the job would only throw its work away (a loaded file is always prepared by
+            # the job load_data started)
+            if self.jobs.busy(mode) and (mode == "loaded" or self.preparing.get(mode) is data):
+                return
+            self.preparing[mode] = data
+            self.jobs.submit(mode, prepare_recall, data)
+            return
+        # Show the whole session, then follow the view as it is zoomed and panned
+        pyramid = self.recall_lod[mode][1]
+        for plot, line, channel in self.recall_plots:
+            line.setData(*pyramid.view(channel, 0, len(data), plot.width()))
+            plot.enableAutoRange(axis = 'x')
+        self.calculate_force(data[:,1], index)
+        self.calculate_stiffness()
+
+    def draw_recall(self, viewbox, x_range):
+        """ Redraws a recall plot whose view changed, from the shown session's pyramid"""
+        mode = "current" if self.radio1.isChecked() else "loaded"
+        if mode not in self.recall_lod:
+            return
+        data, pyramid = self.recall_lod[mode]
+        if data is not (self.data_session if mode == "current" else self.loaded_data):
+            # The new session is still being prepared
+            return
+        for plot, line, channel in self.recall_plots:
+            if plot.getViewBox() is viewbox:
+                lo, hi = x_range
+                # Half a view either side, so a short pan does not reveal an empty edge
+                margin = (hi - lo) / 2
+                line.setData(*pyramid.view(channel, lo - margin, hi + margin, 2 * plot.width()))
+
     def save_data(self):
         """Writes all the data to the specified filename"""
         filename = self.lineEdit.text()
@@ -415,40 +745,116 @@ class MainWindow(QMainWindow):
         # Write the data to the specified file
         final_path = os.path.join(self.data_path, filename)
 
-        np.savetxt(final_path + ".csv", self.data_session, delimiter=",")
-        #np.save(final_path, self.data_session)
-
-    def record_buffer(self):
-        """ Records the data in the buffer to a file"""
+        sf.save_session(final_path + sf.EXTENSION, self.data_session, self.session_header())
+        self.rescan_sessions()
+        #np.savetxt(final_path + ".csv", self.data_session, delimiter=",")
+
+    def session_header(self):
+        """ Metadata written at the start of every session file"""
+        return sf.make_header(
+            self.fs,
+            calibration = self.data_buffer.calibration.to_dict(),
+            probe = {"h": self.h, "R": self.R, "v": self.v, "probe_id": self.probe_id},
+            fs_measured = self.probe.rate.fs,
+        )
+
+    def toggle_recording(self):
+        """ Starts or stops streaming the session to disk"""
+        if self.recorder is None:
+            self.start_recording()
+        else:
+            self.stop_recording()
+
+    def start_recording(self):
+        """ Starts writing every new sample block to data/<filename>.cps"""
+        filename = self.lineEdit.text()
+        if filename == "":
+            filename = time.strftime("session_%Y%m%d_%H%M%S")
+        final_path = os.path.join(self.data_path, filename + sf.EXTENSION)
+        print("Recording session to", final_path)
+        self.recorder = SessionRecorder(final_path, self.session_header())
+        self.recorder.start()
+        self.rec_btn.setText('Stop Recording')
+
+    def stop_recording(self):
+        """ Ends the recording. The recorder closes the file on its writer thread and
+        on_recording_finished follows once it is done, so the event loop never waits"""
+        self.recorder.stop(self.recording_finished.emit)
+        self.recorder = None
+        self.rec_btn.setText('Start Recording')
+
+    def on_recording_finished(self, recorder):
+        print(f"Recorded {recorder.num_samples} samples to {recorder.path}")
+        self.rescan_sessions()
+
+    def record_buffer(self, length = None, skip = 0):
+        """ Records the data in the buffer to a file. With length, records only that many
+        samples, ending skip samples before the newest"""
         print("Recording data...")
-        self.data_session = copy.deepcopy(self.data_buffer.bufdata)
+        if self.attach:
+            # The daemon writes the shared ring while we read it, so take a copy no write
+            # overlapped
+            window, _, _ = self.data_buffer.snapshot()
+        else:
+            window = self.data_buffer.ordered()
+        if length is not None:
+            window = window[len(window) - skip - length:len(window) - skip]
+        # The ordered view aliases the ring buffer, so take a copy of it
+        self.data_session = window.copy()
         self.update_callback_plot()
         print("Data recorded.")
 
     def load_data(self):
-        """ Loads the data from the specified file"""
-        try:
-            print("Loading data...")
-            self.loaded_data = np.loadtxt(self.filePath, delimiter=",")
-            print("Data loaded.")
-        except:
-            print("Failed to load data. Check if file is in the correct format.")
+        """ Loads the data from the specified file and detects its reps on the worker pool.
+        Selecting another file before they are done cancels both"""
+        print("Loading data...")
+        self.jobs.submit("loaded", prepare_recall, self.filePath)
+        self.loaded_windows = None
+        params = {"h": self.h, "R": self.R, "v": self.v, "friction": 0.0}
+        self.jobs.submit("reps", detect_session_reps, self.filePath, params)
     
     def queue_to_buffer(self):
         """ Pulls data from the queue and adds it to the buffer"""
-        items = []
-        while not self.data_q.empty():
-            try:
-                item = self.data_q.get_nowait()  # Or q.get(timeout=0.1)
-                items.append(item)
-            except self.data_q.Empty:
-                # This exception is thrown if the queue was empty. Break the loop.
-                break
+        if not self.batched:
+            self.queue_to_buffer_list()
+            return
+        # Everything that arrived since the last tick, as one array per probe. The
+        # acquisition manager filters and buffers it, then calls on_samples
+        self.acquisition.poll()
+
+    def on_samples(self, blocks):
+        """ Receives the calibrated blocks of the displayed probe from the acquisition manager"""
+        for timestamp, name, calibrated, times in blocks:
+            self.consume_block(calibrated)
+
+    def consume_block(self, calibrated):
+        """ Records a filtered, calibrated block that was just buffered and feeds it to the
+        online rep detector. Both the batched and the per-sample paths end here"""
+        if self.recorder is not None:
+            self.recorder.write(calibrated)
+        self.update_live_stiffness(self.rep_detector.process(calibrated[:,1]))
+
+    def update_live_stiffness(self, events):
+        """ Computes each rep's stiffness as soon as the online detector reports its peak"""
+        for event in events:
+            if event.kind == "onset":
+                self.live_fi = event.force
+            elif event.kind == "peak":
+                E = sa.hertz_modulus(event.force - self.live_fi, self.h, self.R, self.v)
+                self.live_stiffness.append(float(E))
+                values = ", ".join(f"{E:.1f}" for E in self.live_stiffness)
+                self.live_label.setText(f"Live Stiffness: {values} (mean {np.mean(self.live_stiffness):.1f})")
+
+    def queue_to_buffer_list(self):
+        """ Pulls data from a per-sample Queue item by item, filters it and adds it to the
+        buffer, as the acquisition manager does on the batched path"""
         # attempt to add to the buffer
         try:
-            self.data_buffer.add_data(items)
+            calibrated = drain_sample_queue(self.data_q, self.filter_bank, self.data_buffer)
         except:
-            pass
+            return
+        if len(calibrated):
+            self.consume_block(calibrated)
 
     def interp_state():
         print("Current State:")
@@ -468,37 +874,59 @@ class MainWindow(QMainWindow):
             print("Failed to send command")
 
     def test_stiffness(self):
-        """Creates a thread to call the stiffness test function"""
-        self.record_timer.start() 
-        self.worker_thread = threading.Thread(
-            target = self.test_stiffness_thread)
-        self.worker_thread.start()
-        # Make the thread a daemon
-        self.worker_thread.deamon = True
-
-
-    def test_stiffness_thread(self):
+        """ Runs the stiffness test protocol"""
+        if self.scheduler is not None and self.scheduler.running:
+            print("Stiffness test already running")
+            return
+        self.live_stiffness = []
+        self.live_label.setText("Live Stiffness: waiting for reps")
+        print("Testing Stiffness...")
+        self.scheduler = sp.ProtocolScheduler(self.protocol, self.send_protocol_command, self.acquired_samples,
+                                              on_finished = self.finish_protocol)
+        self.scheduler.start()
+        self.protocol_timer.start()
+
+    def send_protocol_command(self, command):
         try:
-            print("Testing Stiffness...")
-            print("Trial One...")
-            self.probe.send_command("retract")
-            time.sleep(0.5)
-            self.probe.send_command("extend")
-            time.sleep(1)
-            self.probe.send_command("retract")
-            print("Trial Two...")
-            time.sleep(1)
-            self.probe.send_command("extend")
-            time.sleep(1)
-            self.probe.send_command("retract")
-            print("Trial Three...")
-            time.sleep(1)
-            self.probe.send_command("extend")
-            time.sleep(1)
-            self.probe.send_command("retract")
+            self.probe.send_command(command)
         except:
             print("Failed to send command")
 
+    def acquired_samples(self):
+        """ Number of samples received so far, including those still waiting in the queue"""
+        if self.data_q is None:
+            # Attached to a daemon, whose buffer already holds every sample acquired
+            return self.data_buffer.total_written
+        return self.data_buffer.total_written + self.data_q.qsize()
+
+    def protocol_tick(self):
+        for record in self.scheduler.tick():
+            if record.step.command == "extend":
+                print(f"Trial {record.step.rep + 1}...")
+
+    def finish_protocol(self, scheduler):
+        """ Records exactly the samples acquired while the protocol ran, and places the
+        detection windows around each rep's commands"""
+        self.protocol_timer.stop()
+        # Drain the queue so the buffer holds every sample up to the end of the protocol
+        self.queue_to_buffer()
+        windows = scheduler.windows(self.fs)
+        # Samples that arrived after the protocol ended, and the part of the protocol that
+        # no longer fits in the buffer
+        after = self.data_buffer.total_written - scheduler.end_index
+        length = min(scheduler.end_index - scheduler.start_index, self.data_buffer.bufsize - after)
+        windows -= (scheduler.end_index - scheduler.start_index) - length
+        self.set_detection_windows(windows.tolist())
+        self.record_buffer(length, after)
+
+    def set_detection_windows(self, windows):
+        """ Moves the detection lines to windows, rows of [f0_start, f0_end, ff_start, ff_end]"""
+        for rep, bounds in enumerate(windows[:len(self.det_current_bound)]):
+            self.det_current_bound[rep] = list(bounds)
+            for i, line in enumerate(self.detection_windows[rep]):
+                line.setValue(bounds[i])
+
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+# Wire formats for the probe data stream.
+#
+# ASCII: one "pos,force\n" line per sample (the original format).
+# Binary: fixed-size little-endian frames,
+#   sync     uint16  0xA55A
+#   seq      uint16  device sample counter, wraps at 65536
+#   data     float32 x num_channels
+#   checksum uint16  sum of the seq and data bytes, mod 65536
+
+FRAME_SYNC = 0xA55A
+SYNC_BYTES = FRAME_SYNC.to_bytes(2, "little")
+
+
+def frame_dtype(num_channels: int) -> np.dtype:
+    """ Returns the structured dtype of one binary frame"""
+    return np.dtype([
+        ("sync", "<u2"),
+        ("seq", "<u2"),
+        ("data", "<f4", (num_channels,)),
+        ("checksum", "<u2"),
+    ])
+
+
+def encode_frames(samples, seq_start: int = 0) -> bytes:
+    """ Packs an (n, num_channels) array of samples into binary frames"""
+    samples = np.atleast_2d(np.asarray(samples, dtype=np.float32))
+    n, num_channels = samples.shape
+    dtype = frame_dtype(num_channels)
+    frames = np.zeros(n, dtype=dtype)
+    frames["sync"] = FRAME_SYNC
+    frames["seq"] = (np.arange(n) + seq_start) % 65536
+    frames["data"] = samples
+    raw = frames.view(np.uint8).reshape(n, dtype.itemsize)
+    frames["checksum"] = raw[:, 2:-2].sum(axis=1, dtype=np.uint32) & 0xFFFF
+    return frames.tobytes()
+
+
+class BinaryFrameDecoder:
+    """
+    Decodes a byte stream of binary frames into whole sample arrays. Bytes can be fed
+    in arbitrary chunks; partial frames are kept until the rest arrives. Frames with a
+    bad sync word or checksum are dropped and the decoder resyncs on the next sync word.
+    """
+
+    def __init__(self, num_channels: int):
+        self.num_channels = num_channels
+        self.dtype = frame_dtype(num_channels)
+        self.frame_size = self.dtype.itemsize
+        self._pending = b""
+        # Sequence numbers of the frames returned by the last call to feed()
+        self.last_seq = np.zeros(0, dtype=np.uint16)
+        self.bad_frames = 0
+
+    def feed(self, chunk: bytes) -> np.ndarray:
+        """ Adds a chunk of bytes and returns the (n, num_channels) samples completed by it"""
+        buf = self._pending + bytes(chunk)
+        size = self.frame_size
+        blocks = []
+        seqs = []
+        pos = 0
+        while True:
+            idx = buf.find(SYNC_BYTES, pos)
+            if idx < 0:
+                # Keep the last byte in case it is the first half of a sync word
+                pos = max(pos, len(buf) - 1)
+                break
+            n = (len(buf) - idx) // size
+            if n == 0:
+                pos = idx
+                break
+            frames = np.frombuffer(buf, dtype=self.dtype, count=n, offset=idx)
+            raw = np.frombuffer(buf, dtype=np.uint8, count=n * size, offset=idx).reshape(n, size)
+            checksum = raw[:, 2:-2].sum(axis=1, dtype=np.uint32) & 0xFFFF
+            ok = (frames["sync"] == FRAME_SYNC) & (checksum == frames["checksum"])
+            bad = np.flatnonzero(~ok)
+            good = n if bad.size == 0 else bad[0]
+            if good:
+                blocks.append(frames["data"][:good])
+                seqs.append(frames["seq"][:good])
+            if bad.size == 0:
+                pos = idx + n * size
+            else:
+                # Skip past the bad frame's sync word and search again
+                self.bad_frames += 1
+                pos = idx + good * size + 1
+        self._pending = buf[pos:]
+        if not blocks:
+            self.last_seq = np.zeros(0, dtype=np.uint16)
+            return np.zeros((0, self.num_channels))
+        self.last_seq = np.concatenate(seqs)
+        return np.concatenate(blocks).astype(np.float64)
+
+
+class AsciiLineDecoder:
+    """
+    Decodes the original comma separated text stream, with the same results as
+    CervicalProbe.receive_data's line by line parsing, but fed arbitrary chunks of bytes.
+    The completed lines of a chunk are parsed together as one array; only a chunk with a
+    malformed line is parsed line by line to drop it.
+    """
+
+    def __init__(self, num_channels: int):
+        self.num_channels = num_channels
+        self._pending = b""
+        self.bad_frames = 0
+
+    def feed(self, chunk: bytes) -> np.ndarray:
+        """ Adds a chunk of bytes and returns the samples of every completed line"""
+        buf = self._pending + bytes(chunk)
+        end = buf.rfind(b"\n")
+        if end < 0:
+            self._pending = buf
+            return np.zeros((0, self.num_channels))
+        text = buf[:end]
+        self._pending = buf[end + 1:]
+        # Every line must have num_channels fields for the block to be parsed at once
+        raw = np.frombuffer(text, dtype=np.uint8)
+        line = np.cumsum(raw == ord("\n"))
+        num_lines = int(line[-1]) + 1 if len(line) else 1
+        commas = np.bincount(line[raw == ord(",")], minlength=num_lines)
+        if np.all(commas == self.num_channels - 1):
+            try:
+                values = np.array(text.replace(b"\n", b",").split(b",")).astype(np.float64)
+                return values.reshape(num_lines, self.num_channels)
+            except ValueError:
+                pass
+        return self._parse_lines(text.split(b"\n"))
+
+    def _parse_lines(self, lines: list) -> np.ndarray:
+        rows = []
+        for line in lines:
+            try:
+                row = [float(i) for i in line.decode("utf-8").rstrip().split(",")]
+            except ValueError:
+                self.bad_frames += 1
+                continue
+            if len(row) == self.num_channels:
+                rows.append(row)
+            else:
+                self.bad_frames += 1
+        if not rows:
+            return np.zeros((0, self.num_channels))
+        return np.array(rows)
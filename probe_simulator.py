@@ -0,0 +1,225 @@
+import threading
+import time
+import numpy as np
+import probe_protocol as pp
+import timing
+from calibration import Calibration, default_calibration
+
+
+class ProbeSimulator:
+    """
+    A model of the probe pressed against tissue, for running the whole acquisition and
+    analysis pipeline without hardware.
+
+    "extend" drives the tip towards the indentation depth h and "retract" back to zero,
+    at h / travel_time meters per second. The force is the preload plus the Hertz force
+    of a sphere of radius R indenting tissue of modulus E (in Pa) and Poisson ratio v,
+    plus Gaussian noise, so a rep's force change gives back E through
+    stiffness_analysis.hertz_modulus. Samples are produced in real time at fs (several
+    kHz is fine), as position in millimeters and force in newtons converted back to raw
+    counts through the inverse of calibration, so the client's own calibration recovers
+    them. They are encoded in the probe's ASCII or binary wire format.
+
+    open() returns a serial-like transport to the simulator, which SerialEngine accepts
+    in place of a port name.
+    """
+
+    def __init__(self, fs: float = 80, protocol: str = "ascii", num_channels: int = 2, E: float = 5000.0,
+                 h: float = 0.004, R: float = 0.0024052, v: float = 0.5, preload: float = 0.5,
+                 travel_time: float = 0.1, noise: float = 0.005, calibration: Calibration | None = None,
+                 seed: int | None = None, clock = timing.now):
+        if protocol not in ("ascii", "binary"):
+            raise ValueError(f"Unknown protocol: {protocol}")
+        self.fs = fs
+        self.protocol = protocol
+        self.num_channels = num_channels
+        self.E = E
+        self.h = h
+        self.R = R
+        self.v = v
+        self.preload = preload
+        self.speed = h / travel_time
+        self.noise = noise
+        if calibration is None:
+            calibration = default_calibration(num_channels)
+        if calibration.order != 1:
+            raise ValueError("The simulator can only invert a linear calibration")
+        self.calibration = calibration
+        self.rng = np.random.default_rng(seed)
+        self.clock = clock
+        self.position = 0.0
+        self.target = 0.0
+        self.seq = 0
+        # Samples produced so far, and the sample index at which each command arrived
+        self.produced = 0
+        self.commands = []
+        self._out = bytearray()
+        self._lock = threading.Lock()
+        self.start_time = clock()
+
+    def __repr__(self):
+        return f"ProbeSimulator(fs={self.fs}, protocol={self.protocol}, E={self.E})"
+
+    def hertz_force(self, depth):
+        """ Force in newtons for an indentation depth in meters"""
+        depth = np.maximum(depth, 0.0)
+        return self.E * self.R**0.5 * depth**1.5 / (0.75 * (1 - self.v**2))
+
+    def samples(self, n: int) -> np.ndarray:
+        """ The next n samples in physical units (position in mm, force in newtons)"""
+        # The tip moves at most speed / fs towards the target every sample
+        step = self.speed / self.fs * np.arange(1, n + 1)
+        distance = self.target - self.position
+        position = self.position + np.sign(distance) * np.minimum(step, abs(distance))
+        if n:
+            self.position = position[-1]
+        out = self.rng.normal(0.0, self.noise, (n, self.num_channels))
+        out[:, 0] = 1e3 * position
+        out[:, 1] += self.preload + self.hertz_force(position)
+        return out
+
+    def raw(self, n: int) -> np.ndarray:
+        """ The next n samples as raw counts, i.e. before the client's calibration"""
+        gains, offsets = self.calibration.coefficients
+        return (self.samples(n) - offsets) / gains
+
+    def encode(self, raw: np.ndarray) -> bytes:
+        if self.protocol == "binary":
+            data = pp.encode_frames(raw, self.seq)
+        else:
+            data = (("%.6g," * (self.num_channels - 1) + "%.6g\n") * len(raw) % tuple(raw.ravel())).encode()
+        self.seq = (self.seq + len(raw)) % timing.SEQ_MODULUS
+        return data
+
+    def advance(self):
+        """ Produces every sample due by now into the output stream"""
+        due = int((self.clock() - self.start_time) * self.fs)
+        n = due - self.produced
+        if n > 0:
+            self._out += self.encode(self.raw(n))
+            self.produced = due
+
+    def command(self, command: str):
+        """ Applies a command from the client, after the samples already due"""
+        with self._lock:
+            self.advance()
+            self.commands.append((self.produced, command))
+            if command == "extend":
+                self.target = self.h
+            elif command == "retract":
+                self.target = 0.0
+
+    def read_bytes(self, size: int) -> bytes:
+        with self._lock:
+            self.advance()
+            data = bytes(self._out[:size])
+            del self._out[:size]
+        return data
+
+    def waiting(self) -> int:
+        with self._lock:
+            self.advance()
+            return len(self._out)
+
+    def open(self, timeout: float | None = 1.0):
+        """ Connects to the simulator. Like a real port, nothing sent before is received"""
+        with self._lock:
+            self.advance()
+            self._out.clear()
+        return SimulatedSerial(self, timeout)
+
+
+class SimulatedSerial:
+    """
+    The subset of the pyserial interface the client and the serial engine use, backed
+    by a ProbeSimulator instead of a port. It has no file descriptor, so the engine polls
+    it with its read timeout. Lines written to it are passed to the simulator as commands.
+    """
+
+    def __init__(self, simulator: ProbeSimulator, timeout: float | None = 1.0):
+        self.simulator = simulator
+        self.timeout = timeout
+        self.is_open = True
+        self._command = b""
+
+    @property
+    def in_waiting(self) -> int:
+        return self.simulator.waiting()
+
+    def read(self, size: int = 1) -> bytes:
+        """ Returns size bytes, or fewer once the timeout has passed"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = self.simulator.read_bytes(size)
+        while len(data) < size and self.is_open:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            # Wait about one sample period for more data
+            time.sleep(min(1 / self.simulator.fs, remaining if remaining is not None else 1.0))
+            data += self.simulator.read_bytes(size - len(data))
+        return data
+
+    def readline(self) -> bytes:
+        line = b""
+        while not line.endswith(b"\n"):
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+        return line
+
+    def write(self, data: bytes) -> int:
+        if not self.is_open:
+            raise OSError("simulated port is closed")
+        *lines, self._command = (self._command + data).split(b"\n")
+        for line in lines:
+            self.simulator.command(line.decode("utf-8").strip())
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+
+if __name__ == '__main__':
+    # Runs the full client -> engine -> queue -> buffer -> analysis path against the
+    # simulator at a high rate and compares the measured stiffness with the true modulus
+    import argparse
+    import probe_buffer as pb
+    import stiffness_analysis as sa
+    import stiffness_protocol as sp
+    from sample_queue import SampleBlockQueue
+    from serial_engine import SerialEngine
+
+    parser = argparse.ArgumentParser(description = "Load test the acquisition pipeline against a simulated probe")
+    parser.add_argument("--fs", type = float, default = 2000)
+    parser.add_argument("--protocol", choices = ["ascii", "binary"], default = "binary")
+    parser.add_argument("--E", type = float, default = 5000.0, help = "true tissue modulus in Pa")
+    parser.add_argument("--noise", type = float, default = 0.005, help = "force noise in newtons")
+    args = parser.parse_args()
+
+    sim = ProbeSimulator(fs = args.fs, protocol = args.protocol, E = args.E, noise = args.noise, seed = 0)
+    engine = SerialEngine(sim, protocol = args.protocol, poll_interval = 0.005, nominal_fs = args.fs)
+    buffer = pb.ProbeBuffer(2, int(args.fs), mode = "ring", calibration = default_calibration(2))
+    q = SampleBlockQueue(2, buffer.bufsize)
+    engine.start(q)
+    scheduler = sp.ProtocolScheduler(sp.StiffnessProtocol(depth = sim.h), engine.send_command,
+                                     lambda: buffer.total_written + q.qsize())
+    scheduler.start()
+    while not scheduler.finished:
+        time.sleep(0.005)
+        data, stamps, _ = q.get_all_stamped()
+        buffer.add_data(data, timing.sample_times(stamps, engine.rate.fs or args.fs))
+        scheduler.tick()
+    buffer.add_data(q.get_all())
+    engine.stop()
+
+    n = scheduler.end_index - scheduler.start_index
+    session = buffer.ordered()[-n - (buffer.total_written - scheduler.end_index):][:n]
+    windows = scheduler.windows(args.fs, lag = 0.2)
+    fi, ff = sa.rep_forces(session[:, 1], windows)
+    result = sa.stiffness_from_forces(fi, ff, sim.h, sim.R, sim.v)
+    stats = engine.stats()
+    print(f"{stats['samples']} samples at {stats['fs']:.0f} Hz (nominal {args.fs:.0f}), "
+          f"dropped {stats['dropped_samples'] + stats['device_dropped']}, bad frames {stats['bad_frames']}")
+    print(f"E per rep {np.round(result['E'], 1)}, mean {result['E_mean']:.1f} Pa, true {args.E:.1f} Pa "
+          f"({100 * (result['E_mean'] / args.E - 1):+.2f}%)")
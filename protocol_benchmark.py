@@ -0,0 +1,46 @@
+import time
+import numpy as np
+import probe_protocol as pp
+
+
+# Parser benchmark: feeds the same samples through the ASCII and binary decoders,
+# in serial-sized chunks, and compares decode throughput.
+
+def make_streams(n_samples, num_channels = 2):
+    samples = np.column_stack([
+        np.random.randint(0, 4096, n_samples),
+        np.random.randint(-300000, -60000, n_samples),
+    ] + [np.random.randint(0, 4096, n_samples) for _ in range(num_channels - 2)]).astype(np.float64)
+    ascii_stream = "".join(",".join(f"{v:.0f}" for v in row) + "\n" for row in samples).encode("utf-8")
+    binary_stream = pp.encode_frames(samples)
+    return samples, ascii_stream, binary_stream
+
+
+def time_decoder(decoder, stream, chunk_size):
+    t0 = time.perf_counter()
+    blocks = []
+    for i in range(0, len(stream), chunk_size):
+        blocks.append(decoder.feed(stream[i:i + chunk_size]))
+    elapsed = time.perf_counter() - t0
+    return elapsed, np.concatenate(blocks)
+
+
+if __name__ == '__main__':
+    n_samples = 200000
+    num_channels = 2
+    samples, ascii_stream, binary_stream = make_streams(n_samples, num_channels)
+    print(f"{n_samples} samples: ascii {len(ascii_stream)} bytes, binary {len(binary_stream)} bytes")
+    print(f"{'chunk':>8} {'ascii (samples/s)':>18} {'binary (samples/s)':>19} {'speedup':>8}")
+    for chunk_size in [64, 512, 4096]:
+        t_ascii, out_ascii = time_decoder(pp.AsciiLineDecoder(num_channels), ascii_stream, chunk_size)
+        t_bin, out_bin = time_decoder(pp.BinaryFrameDecoder(num_channels), binary_stream, chunk_size)
+        assert np.array_equal(out_ascii, samples) and np.array_equal(out_bin, samples)
+        print(f"{chunk_size:>8} {n_samples / t_ascii:>18.0f} {n_samples / t_bin:>19.0f} {t_ascii / t_bin:>8.1f}")
+
+    # Corrupt a few bytes to check that the binary decoder resyncs
+    corrupt = bytearray(binary_stream)
+    for i in np.random.randint(0, len(corrupt), 20):
+        corrupt[i] ^= 0xFF
+    decoder = pp.BinaryFrameDecoder(num_channels)
+    _, out = time_decoder(decoder, bytes(corrupt), 4096)
+    print(f"corrupted stream: {len(out)} of {n_samples} frames recovered, {decoder.bad_frames} bad frames")
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class SparseTableMax:
+    """
+    Range maximum index over a fixed trace, by block decomposition. The trace is split
+    into blocks of block_size samples and a sparse table is built over the block maxima,
+    so the whole blocks inside a window [start, end) are answered by two overlapping
+    power-of-two runs of blocks in O(1), and only the partial blocks at either end are
+    scanned. The trace itself is referenced, not copied, so the index of a memory-mapped
+    session takes O(n / block_size * log n) memory and the samples stay on disk. A batch
+    of queries is one vectorized lookup.
+
+    check, if given, is called between chunks of the build and may raise to abandon it.
+    """
+
+    def __init__(self, values: np.ndarray, block_size: int = 1024, chunk_blocks: int = 1024, check = None):
+        self.values = np.asarray(values)
+        n = len(self.values)
+        self.n = n
+        self.block_size = block_size
+        num_blocks = -(-n // block_size)
+        full = n // block_size
+        block_max = np.empty(num_blocks, dtype=np.float64)
+        # chunk_blocks blocks at a time, so a memory-mapped trace is read in pieces
+        for start in range(0, full, chunk_blocks):
+            if check is not None:
+                check()
+            stop = min(full, start + chunk_blocks)
+            block_max[start:stop] = self.values[start * block_size:stop * block_size].reshape(-1, block_size).max(axis=1)
+        if num_blocks > full:
+            block_max[full] = self.values[full * block_size:].max()
+        levels = max(1, int(num_blocks).bit_length())
+        # table[k, i] = max(block_max[i:i + 2**k]), -inf where the run passes the end
+        self.table = np.full((levels, max(num_blocks, 1)), -np.inf)
+        self.table[0, :num_blocks] = block_max
+        for k in range(1, levels):
+            half = 1 << (k - 1)
+            width = num_blocks - (1 << k) + 1
+            if width <= 0:
+                break
+            np.maximum(self.table[k - 1, :width], self.table[k - 1, half:half + width], out=self.table[k, :width])
+
+    def _blocks(self, first, last) -> np.ndarray:
+        """ Maximum of blocks first to last - 1, -inf where there are none"""
+        lengths = last - first
+        empty = lengths <= 0
+        lengths = np.where(empty, 1, lengths)
+        first = np.where(empty, 0, first)
+        # Largest power of two that fits in each run, exact for integers unlike log2
+        k = (np.frexp(lengths)[1] - 1).astype(np.int64)
+        result = np.maximum(self.table[k, first], self.table[k, first + lengths - (1 << k)])
+        return np.where(empty, -np.inf, result)
+
+    def _scan(self, starts, ends) -> np.ndarray:
+        """ Maximum of values[start:end] for windows of at most block_size samples, -inf
+        where a window is empty"""
+        index = starts[..., None] + np.arange(self.block_size)
+        valid = index < ends[..., None]
+        samples = self.values[np.where(valid, index, 0)]
+        return np.where(valid, samples, -np.inf).max(axis=-1)
+
+    def query(self, starts, ends) -> np.ndarray:
+        """ Maximum of values[start:end] for each window. Bounds are clipped to the trace
+        and empty windows give nan"""
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, self.n)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), 0, self.n)
+        if self.n == 0:
+            return np.full(starts.shape, np.nan)
+        empty = ends <= starts
+        starts = np.where(empty, 0, starts)
+        ends = np.where(empty, 1, ends)
+        size = self.block_size
+        first = starts // size
+        last = (ends - 1) // size
+        # The partial block at each end, and the whole blocks between them
+        left = self._scan(starts, np.minimum(ends, (first + 1) * size))
+        right = self._scan(np.maximum(starts, last * size), ends)
+        result = np.maximum(np.maximum(left, right), self._blocks(first + 1, last))
+        return np.where(empty, np.nan, result)
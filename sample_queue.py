@@ -0,0 +1,91 @@
+import numpy as np
+import timing
+
+
+class SampleBlockQueue:
+    """
+    Single-producer/single-consumer queue of samples backed by a preallocated array.
+
+    The producer (the streaming thread) only ever advances the write counter and the
+    consumer (the GUI timer) only ever advances the read counter, and each counter is
+    published after the samples it covers have been copied, so no lock is needed.
+    Whole blocks go in with put() and everything waiting comes out as one contiguous
+    array with get_all(). When the queue is full the newest samples are dropped and
+    counted in self.dropped.
+
+    Each sample also carries the host time its block was put (timing.now() unless given)
+    and its device sequence number (-1 when the protocol has none), returned by
+    get_all_stamped().
+    """
+
+    def __init__(self, num_channels: int, capacity: int):
+        self.num_channels = num_channels
+        self.capacity = capacity
+        self._data = np.zeros((capacity, num_channels))
+        self._stamps = np.zeros(capacity)
+        self._seq = np.full(capacity, -1, dtype=np.int64)
+        # Total samples written and read, only ever increased by the producer and consumer
+        self._write_count = 0
+        self._read_count = 0
+        self.dropped = 0
+
+    def put(self, block, timestamp: float | None = None, seq = None) -> int:
+        """ Copies an (n, num_channels) block into the queue. Returns the number of samples kept"""
+        if timestamp is None:
+            timestamp = timing.now()
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block.reshape(1, -1)
+        free = self.capacity - (self._write_count - self._read_count)
+        n = len(block)
+        if n > free:
+            self.dropped += n - free
+            block = block[:free]
+            if seq is not None:
+                seq = seq[:free]
+            n = free
+        if n == 0:
+            return 0
+        i = self._write_count % self.capacity
+        first = min(n, self.capacity - i)
+        rest = n - first
+        self._data[i:i + first] = block[:first]
+        self._stamps[i:i + first] = timestamp
+        self._seq[i:i + first] = -1 if seq is None else seq[:first]
+        if rest:
+            self._data[:rest] = block[first:]
+            self._stamps[:rest] = timestamp
+            self._seq[:rest] = -1 if seq is None else seq[first:]
+        # Publish the samples only once they are in place
+        self._write_count += n
+        return n
+
+    def _take(self, source: np.ndarray, n: int, out: np.ndarray):
+        i = self._read_count % self.capacity
+        first = min(n, self.capacity - i)
+        out[:first] = source[i:i + first]
+        if n > first:
+            out[first:] = source[:n - first]
+        return out
+
+    def get_all(self) -> np.ndarray:
+        """ Removes and returns every waiting sample as one contiguous (n, num_channels) array"""
+        n = self._write_count - self._read_count
+        out = self._take(self._data, n, np.empty((n, self.num_channels)))
+        self._read_count += n
+        return out
+
+    def get_all_stamped(self):
+        """ Like get_all, but returns (samples, block timestamps, sequence numbers)"""
+        n = self._write_count - self._read_count
+        data = self._take(self._data, n, np.empty((n, self.num_channels)))
+        stamps = self._take(self._stamps, n, np.empty(n))
+        seq = self._take(self._seq, n, np.empty(n, dtype=np.int64))
+        self._read_count += n
+        return data, stamps, seq
+
+    def qsize(self) -> int:
+        return self._write_count - self._read_count
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
@@ -0,0 +1,234 @@
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+import serial
+import probe_protocol as pp
+import timing
+from sample_queue import SampleBlockQueue
+
+
+class SerialEngine:
+    """
+    Owns the probe's serial port on one I/O thread: opens it (and reopens it after a
+    disconnect, with exponential backoff), reads whatever bytes are waiting in bulk,
+    decodes them and puts whole blocks on a SampleBlockQueue, and writes queued commands
+    between reads so commands never contend with the reader for the port.
+
+    Where the port has a file descriptor (POSIX serial ports, ptys) the thread waits in a
+    selector on the port and a wake-up socket, so stop() and send_command() take effect
+    immediately. Otherwise (Windows COM ports, pyserial URLs such as loop://) it polls with
+    a short read timeout of poll_interval seconds.
+
+    port can be anything serial.serial_for_url accepts, so the engine can be tested
+    against a pty (os.openpty) or the loop:// stand-in instead of a probe, or a
+    probe_simulator.ProbeSimulator, which is opened in process.
+    Counters: bytes_read, reconnects, dropped_samples (queue full), and the decoder's
+    bad_frames. Every block is stamped with the host time it was read, with its device
+    sequence numbers in binary mode, and self.rate tracks the effective sample rate.
+    """
+
+    def __init__(self, port: str, baudrate: int = 115200, protocol: str = "ascii", num_channels: int = 2,
+                 poll_interval: float = 0.02, reconnect_interval: float = 0.5, max_backoff: float = 5.0,
+                 nominal_fs: float | None = None):
+        self.port = port
+        self.baudrate = baudrate
+        self.poll_interval = poll_interval
+        self.reconnect_interval = reconnect_interval
+        self.max_backoff = max_backoff
+        if protocol == "binary":
+            self.decoder = pp.BinaryFrameDecoder(num_channels)
+        else:
+            self.decoder = pp.AsciiLineDecoder(num_channels)
+        self.ser = None
+        self.io_thread = None
+        self.connected = False
+        self.running = False
+        self._commands = queue.Queue()
+        # Socket pair used to wake the selector when there is a command or on stop, made
+        # on every start and closed by the I/O thread when it exits
+        self._wake_r = self._wake_w = None
+        self.rate = timing.RateEstimator(nominal_fs)
+        self.bytes_read = 0
+        self.reconnects = 0
+        self.dropped_samples = 0
+
+    def start(self, out_queue: SampleBlockQueue):
+        self.out_queue = out_queue
+        self.running = True
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.io_thread = threading.Thread(target = self._run, daemon = True)
+        self.io_thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        """ Stops the I/O thread, which closes the port on its way out"""
+        self.running = False
+        self._wake()
+        if self.io_thread is None:
+            return
+        self.io_thread.join(timeout)
+        if self.io_thread.is_alive():
+            # Closing the port under a read in progress could crash it; the thread closes
+            # the port itself when the read returns
+            print(f"I/O thread for {self.port} did not stop within {timeout} s")
+            return
+        self.io_thread = None
+
+    def send_command(self, command: str):
+        """ Queues a command; the I/O thread writes it before its next read"""
+        self._commands.put(command.encode("utf-8") + b"\n")
+        self._wake()
+
+    def _wake(self):
+        if self._wake_w is None:
+            return
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _open(self) -> bool:
+        try:
+            if isinstance(self.port, str):
+                self.ser = serial.serial_for_url(self.port, self.baudrate, timeout = self.poll_interval)
+            else:
+                self.ser = self.port.open(timeout = self.poll_interval)
+        except (serial.SerialException, OSError, ValueError) as e:
+            print(f"Failed to connect to {self.port}: {e}")
+            return False
+        self.connected = True
+        print(f"Connected to {self.port}")
+        return True
+
+    def _close(self):
+        self.connected = False
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.ser = None
+
+    def _fileno(self):
+        try:
+            return self.ser.fileno()
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            return None
+
+    def _run(self):
+        wake = (self._wake_r, self._wake_w)
+        backoff = self.reconnect_interval
+        first = True
+        try:
+            while self.running:
+                if not self.connected:
+                    if not first:
+                        self.reconnects += 1
+                    first = False
+                    if not self._open():
+                        self._sleep(backoff)
+                        backoff = min(2 * backoff, self.max_backoff)
+                        continue
+                    backoff = self.reconnect_interval
+                try:
+                    self._serve()
+                except (serial.SerialException, OSError) as e:
+                    print(f"Lost connection to {self.port}: {e}")
+                    self._close()
+        finally:
+            # Only this thread touches the port, so it is closed here once no read can
+            # be in progress
+            self._close()
+            for sock in wake:
+                sock.close()
+
+    def _serve(self):
+        """ Reads and writes until the engine stops; raises if the port fails"""
+        fd = self._fileno()
+        if fd is None:
+            while self.running:
+                self._write_commands()
+                waiting = self.ser.in_waiting
+                # Blocks for at most poll_interval when nothing is waiting
+                self._handle(self.ser.read(max(1, waiting)))
+            return
+        self.ser.timeout = 0
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ, "port")
+            sel.register(self._wake_r, selectors.EVENT_READ, "wake")
+            while self.running:
+                self._write_commands()
+                for key, _ in sel.select(timeout = 1.0):
+                    if key.data == "wake":
+                        self._drain_wake()
+                    else:
+                        chunk = self.ser.read(max(1, self.ser.in_waiting))
+                        if not chunk:
+                            # Readable but empty means the device went away
+                            raise serial.SerialException("device disconnected")
+                        self._handle(chunk)
+
+    def _handle(self, chunk: bytes):
+        if not chunk:
+            return
+        timestamp = timing.now()
+        self.bytes_read += len(chunk)
+        block = self.decoder.feed(chunk)
+        if len(block):
+            seq = getattr(self.decoder, "last_seq", None)
+            self.rate.update(len(block), timestamp, seq)
+            kept = self.out_queue.put(block, timestamp, seq)
+            self.dropped_samples += len(block) - kept
+
+    def _write_commands(self):
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            self.ser.write(command)
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(64):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _sleep(self, seconds: float):
+        """ Sleeps between reconnect attempts, returning early on stop"""
+        deadline = time.monotonic() + seconds
+        while self.running and time.monotonic() < deadline:
+            time.sleep(min(0.05, deadline - time.monotonic()))
+
+    def stats(self) -> dict:
+        return {
+            **self.rate.stats(),
+            "connected": self.connected,
+            "bytes_read": self.bytes_read,
+            "reconnects": self.reconnects,
+            "dropped_samples": self.dropped_samples,
+            "bad_frames": self.decoder.bad_frames,
+            "queue_depth": self.out_queue.qsize(),
+        }
+
+
+if __name__ == '__main__':
+    # Loopback check against a pty: the master end plays the probe
+    import numpy as np
+    master, slave = os.openpty()
+    engine = SerialEngine(os.ttyname(slave), protocol = "binary")
+    q = SampleBlockQueue(2, 10000)
+    engine.start(q)
+    time.sleep(0.2)
+    os.write(master, pp.encode_frames(np.random.rand(1000, 2)))
+    engine.send_command("extend")
+    time.sleep(0.2)
+    print("received", len(q.get_all()), "samples, command echoed:", os.read(master, 64))
+    print(engine.stats())
+    t0 = time.monotonic()
+    engine.stop()
+    print(f"stopped in {1e3 * (time.monotonic() - t0):.1f} ms")
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import session_format as sf
+import stiffness_analysis as sa
+from analysis_cache import file_hash
+from batch_stiffness import analyze_file, find_sessions
+
+
+# SQLite catalog of the sessions in a data directory, so sessions can be found and
+# compared without opening them. Each row holds the file's metadata and its precomputed
+# per-rep stiffness. refresh() is incremental: files whose mtime and size are unchanged
+# are skipped, and files that changed on disk but not in content (by hash) are not
+# re-analysed.
+#
+#   python session_catalog.py data --search pig --order E_mean
+
+DEFAULT_CATALOG_NAME = "catalog.sqlite"
+SCHEMA_VERSION = 1
+ORDER_COLUMNS = ("name", "mtime", "created", "num_samples", "duration", "E_mean", "E_std", "probe_id")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    format TEXT,
+    fs REAL,
+    num_samples INTEGER,
+    duration REAL,
+    probe_id TEXT,
+    created TEXT,
+    stiffness TEXT,
+    E_mean REAL,
+    E_std REAL,
+    params TEXT,
+    error TEXT,
+    indexed REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_name ON sessions (name);
+CREATE INDEX IF NOT EXISTS sessions_mtime ON sessions (mtime);
+CREATE INDEX IF NOT EXISTS sessions_E_mean ON sessions (E_mean);
+CREATE INDEX IF NOT EXISTS sessions_hash ON sessions (hash);
+"""
+
+
+def summarize(path: str, params: dict, max_samples: int | None = None) -> dict:
+    """ Worker: the catalog row for one session, metadata and stiffness. Sessions longer
+    than max_samples are not analysed, since change point detection grows quadratically.
+    Never raises, errors go in the row"""
+    row = {"format": os.path.splitext(path)[1].lstrip(".")}
+    try:
+        session = sf.load_session(path)
+        header = session.header
+        row["fs"] = header.get("fs_measured") or header.get("fs")
+        row["num_samples"] = len(session.data)
+        row["duration"] = row["num_samples"] / row["fs"] if row["fs"] else None
+        row["probe_id"] = header.get("probe", {}).get("probe_id")
+        row["created"] = header.get("created") if path.endswith(sf.EXTENSION) else None
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+        return row
+    if max_samples is not None and row["num_samples"] > max_samples:
+        row["error"] = f"Not analysed, longer than {max_samples} samples"
+        return row
+    analysis = analyze_file(path, params)
+    if "error" in analysis:
+        row["error"] = analysis["error"]
+    else:
+        reps = sorted((key for key in analysis if key.startswith("E_rep")), key = lambda key: int(key[5:]))
+        row["stiffness"] = json.dumps([analysis[key] for key in reps])
+        row["E_mean"] = analysis["E_mean"]
+        row["E_std"] = analysis["E_std"]
+    return row
+
+
+class SessionCatalog:
+    """
+    The catalog database. Every method opens its own connection, so a catalog can be
+    refreshed on a worker thread while the GUI thread queries it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout = 10)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def refresh(self, data_dir: str, params: dict | None = None, recursive: bool = False, workers: int = 1,
+                max_samples: int | None = None, cancel = None) -> dict:
+        """ Brings the catalog up to date with the sessions in data_dir, analysing new and
+        changed files of up to max_samples samples with params (sa.DEFAULT_PARAMS where
+        missing). Sessions analysed with other settings are analysed again. Returns counts
+        of what was done"""
+        params = dict(params or {})
+        params_key = json.dumps({**sa.DEFAULT_PARAMS, **params, "max_samples": max_samples}, sort_keys = True)
+        paths = [os.path.abspath(path) for path in find_sessions(data_dir, recursive = recursive)]
+        counts = {"added": 0, "updated": 0, "touched": 0, "unchanged": 0, "removed": 0}
+        with self._connect() as db:
+            known = {row["path"]: row for row in db.execute("SELECT path, mtime, size, hash, params FROM sessions")}
+        todo = []
+        for path in paths:
+            if cancel is not None and cancel.is_set():
+                return counts
+            stat = os.stat(path)
+            row = known.get(path)
+            if row is not None and row["params"] == params_key and (row["mtime"], row["size"]) == (stat.st_mtime, stat.st_size):
+                counts["unchanged"] += 1
+                continue
+            digest = file_hash(path)
+            if row is not None and row["params"] == params_key and row["hash"] == digest:
+                # Touched or copied over with the same contents; the summary still holds
+                with self._connect() as db:
+                    db.execute("UPDATE sessions SET mtime = ?, size = ? WHERE path = ?", (stat.st_mtime, stat.st_size, path))
+                counts["touched"] += 1
+                continue
+            todo.append((path, stat, digest, row is None))
+
+        def store(path, stat, digest, new, summary):
+            record = {
+                "path": path, "name": os.path.basename(path), "mtime": stat.st_mtime, "size": stat.st_size,
+                "hash": digest, "params": params_key, "indexed": time.time(),
+                "format": None, "fs": None, "num_samples": None, "duration": None, "probe_id": None,
+                "created": None, "stiffness": None, "E_mean": None, "E_std": None, "error": None,
+            }
+            record.update(summary)
+            columns = ", ".join(record)
+            with self._connect() as db:
+                db.execute(f"INSERT OR REPLACE INTO sessions ({columns}) VALUES ({', '.join('?' * len(record))})",
+                           tuple(record.values()))
+            counts["added" if new else "updated"] += 1
+
+        if workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                futures = [(item, pool.submit(summarize, item[0], params, max_samples)) for item in todo]
+                for item, future in futures:
+                    if cancel is not None and cancel.is_set():
+                        for _, pending in futures:
+                            pending.cancel()
+                        return counts
+                    store(*item, future.result())
+        else:
+            for item in todo:
+                if cancel is not None and cancel.is_set():
+                    return counts
+                store(*item, summarize(item[0], params, max_samples))
+
+        # Forget sessions that were deleted (only under data_dir)
+        root = os.path.abspath(data_dir) + os.sep
+        present = set(paths)
+        with self._connect() as db:
+            gone = [path for path in known if path.startswith(root) and path not in present]
+            db.executemany("DELETE FROM sessions WHERE path = ?", [(path,) for path in gone])
+        counts["removed"] = len(gone)
+        return counts
+
+    def query(self, search: str = "", order_by: str = "mtime", descending: bool = True, min_E: float | None = None,
+              max_E: float | None = None, limit: int | None = None) -> list:
+        """ Sessions whose name or probe id contains search, with E_mean in [min_E, max_E],
+        as a list of dicts with stiffness decoded to a list"""
+        if order_by not in ORDER_COLUMNS:
+            raise ValueError(f"Cannot order by {order_by}")
+        sql = "SELECT * FROM sessions WHERE (name LIKE ? OR IFNULL(probe_id, '') LIKE ?)"
+        args = [f"%{search}%", f"%{search}%"]
+        if min_E is not None:
+            sql += " AND E_mean >= ?"
+            args.append(min_E)
+        if max_E is not None:
+            sql += " AND E_mean <= ?"
+            args.append(max_E)
+        sql += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self._connect() as db:
+            rows = [dict(row) for row in db.execute(sql, args)]
+        for row in rows:
+            row["stiffness"] = json.loads(row["stiffness"]) if row["stiffness"] else []
+        return rows
+
+    def get(self, path: str) -> dict | None:
+        """ The catalog row for one session, or None if it is not indexed"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM sessions WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        row["stiffness"] = json.loads(row["stiffness"]) if row["stiffness"] else []
+        return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Index the sessions in a directory and search them")
+    parser.add_argument("data_dir")
+    parser.add_argument("--catalog", help = f"catalog file (default <data_dir>/{DEFAULT_CATALOG_NAME})")
+    parser.add_argument("--search", default = "")
+    parser.add_argument("--order", default = "mtime", choices = ORDER_COLUMNS)
+    parser.add_argument("--ascending", action = "store_true")
+    parser.add_argument("--min-E", type = float)
+    parser.add_argument("--max-E", type = float)
+    parser.add_argument("--recursive", action = "store_true")
+    parser.add_argument("--workers", type = int, default = os.cpu_count())
+    args = parser.parse_args()
+
+    catalog = SessionCatalog(args.catalog or os.path.join(args.data_dir, DEFAULT_CATALOG_NAME))
+    t0 = time.perf_counter()
+    counts = catalog.refresh(args.data_dir, recursive = args.recursive, workers = args.workers)
+    print(f"Indexed in {time.perf_counter() - t0:.2f} s: " + ", ".join(f"{n} {what}" for what, n in counts.items()))
+    rows = catalog.query(args.search, args.order, not args.ascending, args.min_E, args.max_E)
+    print(f"{'session':<32} {'samples':>8} {'E mean':>10} {'E std':>10}  stiffness per rep")
+    for row in rows:
+        if row["error"]:
+            print(f"{row['name']:<32} {row['num_samples'] or '-':>8}  {row['error']}")
+            continue
+        reps = ", ".join(f"{E:.1f}" for E in row["stiffness"])
+        print(f"{row['name']:<32} {row['num_samples']:>8} {row['E_mean']:>10.1f} {row['E_std']:>10.1f}  {reps}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+
+# Binary session format (.cps):
+#   8 bytes   magic b"CPSESS01"
+#   4 bytes   little-endian uint32, length of the JSON header
+#   n bytes   JSON header (fs, channel names, dtype, calibration, probe geometry h/R/v),
+#             padded with spaces so the data starts on a 64 byte boundary
+#   data      C-ordered (num_samples, num_channels) array of the header's dtype
+#
+# The sample count is not stored, it follows from the file size, so a session being
+# recorded (or one cut short by a crash) can always be opened.
+
+MAGIC = b"CPSESS01"
+FORMAT_VERSION = 1
+EXTENSION = ".cps"
+DEFAULT_CHANNELS = ["position", "force"]
+ALIGNMENT = 64
+
+
+def make_header(fs: float, channels: list | None = None, dtype = np.float64, calibration: dict | None = None,
+                probe: dict | None = None, **extra) -> dict:
+    """ Builds a session header. probe holds the geometry, e.g. {"h": 0.004, "R": 0.0024052, "v": 0.5}"""
+    header = {
+        "format_version": FORMAT_VERSION,
+        "fs": fs,
+        "channels": list(channels or DEFAULT_CHANNELS),
+        "dtype": np.dtype(dtype).str,
+        "calibration": calibration,
+        "probe": probe or {},
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    header.update(extra)
+    return header
+
+
+def encode_header(header: dict) -> bytes:
+    """ Returns the magic, length and padded JSON header, ready to be followed by the data"""
+    text = json.dumps(header).encode("utf-8")
+    prefix = len(MAGIC) + 4
+    padded = -(-(prefix + len(text)) // ALIGNMENT) * ALIGNMENT - prefix
+    text = text.ljust(padded, b" ")
+    return MAGIC + len(text).to_bytes(4, "little") + text
+
+
+def read_header(path: str):
+    """ Returns (header, data offset) of a .cps file"""
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a probe session file")
+        length = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(length).decode("utf-8"))
+    if header.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} was written by a newer session format")
+    return header, len(MAGIC) + 4 + length
+
+
+class Session:
+    """
+    A loaded session: data is an (n, num_channels) array, memory-mapped for .cps and .npy
+    files, and header holds the metadata (defaults for formats that have none).
+    """
+
+    def __init__(self, path: str, data: np.ndarray, header: dict):
+        self.path = path
+        self.data = data
+        self.header = header
+
+    @property
+    def fs(self):
+        return self.header.get("fs")
+
+    @property
+    def channels(self):
+        return self.header.get("channels", DEFAULT_CHANNELS)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _cps_samples(path: str, header: dict, offset: int) -> int:
+    row_size = np.dtype(header["dtype"]).itemsize * len(header["channels"])
+    return (os.path.getsize(path) - offset) // row_size
+
+
+def open_session(path: str) -> Session:
+    """ Opens a .cps file with np.memmap. Nothing is read until the data is accessed"""
+    header, offset = read_header(path)
+    dtype = np.dtype(header["dtype"])
+    num_channels = len(header["channels"])
+    num_samples = _cps_samples(path, header, offset)
+    if num_samples == 0:
+        data = np.zeros((0, num_channels), dtype=dtype)
+    else:
+        data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(num_samples, num_channels))
+    return Session(path, data, header)
+
+
+def load_session(path: str, fs: float | None = None) -> Session:
+    """ Loads a session in any supported format: .cps and .npy are memory-mapped, anything
+    else is parsed as the original comma separated text"""
+    if path.endswith(EXTENSION):
+        return open_session(path)
+    if path.endswith(".npy"):
+        data = np.load(path, mmap_mode="r")
+    else:
+        data = np.loadtxt(path, delimiter=",", ndmin=2)
+    channels = DEFAULT_CHANNELS if data.shape[1] == 2 else [f"ch{i}" for i in range(data.shape[1])]
+    return Session(path, data, make_header(fs, channels, data.dtype))
+
+
+def num_samples(path: str) -> int:
+    """ Number of samples in a session file without loading it: from the header and the
+    file size for .cps, the array header for .npy, and the lines of text otherwise"""
+    if path.endswith(EXTENSION):
+        header, offset = read_header(path)
+        return _cps_samples(path, header, offset)
+    if path.endswith(".npy"):
+        return len(np.load(path, mmap_mode="r"))
+    count = 0
+    with open(path, "rb") as f:
+        for line in f:
+            count += bool(line.strip())
+    return count
+
+
+def save_session(path: str, data: np.ndarray, header: dict):
+    """ Writes a whole session to a .cps file"""
+    data = np.ascontiguousarray(data, dtype=np.dtype(header["dtype"]))
+    with open(path, "wb") as f:
+        f.write(encode_header(header))
+        f.write(data.tobytes())
+
+
+def convert_csv(csv_path: str, out_path: str | None = None, fs: float | None = None, probe: dict | None = None) -> str:
+    """ Converts an existing CSV session to .cps and returns the new path"""
+    if out_path is None:
+        out_path = os.path.splitext(csv_path)[0] + EXTENSION
+    data = np.loadtxt(csv_path, delimiter=",", ndmin=2)
+    channels = DEFAULT_CHANNELS if data.shape[1] == 2 else [f"ch{i}" for i in range(data.shape[1])]
+    header = make_header(fs, channels, probe=probe, converted_from=os.path.basename(csv_path))
+    save_session(out_path, data, header)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert CSV probe sessions to the binary .cps format")
+    parser.add_argument("csv_files", nargs="+")
+    parser.add_argument("--fs", type=float, default=80, help="sampling frequency of the recordings")
+    parser.add_argument("--h", type=float, default=0.004, help="indentation in meters")
+    parser.add_argument("--R", type=float, default=0.0024052, help="radius of the probe in meters")
+    parser.add_argument("--v", type=float, default=0.5, help="Poisson's ratio")
+    args = parser.parse_args()
+    probe = {"h": args.h, "R": args.R, "v": args.v}
+    for csv_path in args.csv_files:
+        out_path = convert_csv(csv_path, fs=args.fs, probe=probe)
+        print(f"{csv_path} -> {out_path}")
+
+
+if __name__ == '__main__':
+    main()
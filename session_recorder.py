@@ -0,0 +1,94 @@
+import threading
+import queue
+import time
+import numpy as np
+import session_format as sf
+
+
+class SessionRecorder:
+    """
+    Streams sample blocks to a .cps session file from a background writer thread.
+
+    write() only queues a copy of the block and stop() only queues the end of the
+    recording, so neither blocks the Qt event loop; the writer thread writes out what is
+    queued, closes the file and then calls the on_finished callback given to stop(). The
+    file grows while the stream runs, so a session can be as long as the disk allows. At
+    most max_pending blocks wait in memory; if the disk falls that far behind, further
+    blocks are dropped and counted in self.dropped_blocks. The header (see session_format)
+    is written up front and the file is flushed every flush_interval seconds, so it can be
+    opened at any time, even mid-recording.
+    """
+
+    def __init__(self, path: str, header: dict, max_pending: int = 1024, flush_interval: float = 1.0):
+        self.path = path
+        self.header = header
+        self.num_channels = len(header["channels"])
+        self.dtype = np.dtype(header["dtype"])
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.num_samples = 0
+        self.dropped_blocks = 0
+        self.recording = False
+        # Unbounded, so the end of recording can always be queued; write() holds the
+        # data blocks to max_pending
+        self._pending = queue.Queue()
+        self._on_finished = None
+
+    def start(self):
+        self._file = open(self.path, "wb")
+        self._file.write(sf.encode_header(self.header))
+        self._file.flush()
+        self.recording = True
+        self.writer_thread = threading.Thread(target = self._writer, daemon = True)
+        self.writer_thread.start()
+
+    def write(self, block: np.ndarray):
+        """ Queues a copy of an (n, num_channels) block for writing"""
+        if not self.recording or len(block) == 0:
+            return
+        if self._pending.qsize() >= self.max_pending:
+            self.dropped_blocks += 1
+            return
+        self._pending.put_nowait(np.array(block, dtype = self.dtype))
+
+    def _writer(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    block = self._pending.get(timeout = self.flush_interval)
+                except queue.Empty:
+                    block = ()
+                if block is None:
+                    break
+                if len(block):
+                    self._file.write(block.tobytes())
+                    self.num_samples += len(block)
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    self._file.flush()
+                    last_flush = time.monotonic()
+        finally:
+            self._file.close()
+            if self.dropped_blocks:
+                print(f"Recorder dropped {self.dropped_blocks} blocks")
+            if self._on_finished is not None:
+                self._on_finished(self)
+
+    def stop(self, on_finished = None):
+        """ Ends the recording without waiting for it: the writer thread writes out the
+        queued blocks, closes the file and then calls on_finished(recorder) from its own
+        thread. Use wait() to block until the file is closed"""
+        if not self.recording:
+            return
+        self.recording = False
+        if self.writer_thread.is_alive():
+            self._on_finished = on_finished
+            self._pending.put_nowait(None)
+        elif on_finished is not None:
+            # The writer already died (a disk error), so it will not call back
+            on_finished(self)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """ Waits for the writer thread to close the file. Returns whether it did"""
+        self.writer_thread.join(timeout)
+        return not self.writer_thread.is_alive()
@@ -0,0 +1,206 @@
+import json
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import probe_buffer as pb
+from calibration import Calibration
+
+
+# Layout of the shared memory segment, all little-endian:
+#   control   int64 x 8   seqlock counter, samples written, dropped samples, metadata
+#                         length, num_channels, bufsize, layout version, unused
+#   metadata  JSON, padded to META_SIZE bytes (fs, probe_id, calibration)
+#   samples   float64 (2 * bufsize, num_channels), mirrored ring as in ProbeBuffer
+#   times     float64 (2 * bufsize), host time of every sample, mirrored the same way
+CONTROL_SIZE = 64
+META_SIZE = 4096
+LAYOUT_VERSION = 1
+SEQ, TOTAL, DROPPED, META_LEN, CHANNELS, BUFSIZE, VERSION = range(7)
+
+
+def _segment_size(num_channels: int, bufsize: int) -> int:
+    return CONTROL_SIZE + META_SIZE + 8 * 2 * bufsize * (num_channels + 1)
+
+
+def _views(buf, num_channels: int, bufsize: int):
+    control = np.ndarray(8, dtype="<i8", buffer = buf)
+    offset = CONTROL_SIZE + META_SIZE
+    ring = np.ndarray((2 * bufsize, num_channels), dtype="<f8", buffer = buf, offset = offset)
+    offset += ring.nbytes
+    time_ring = np.ndarray(2 * bufsize, dtype="<f8", buffer = buf, offset = offset)
+    return control, ring, time_ring
+
+
+def unlink_segment(name: str) -> bool:
+    """ Removes the segment name if it exists, for a writer that died without closing it.
+    Returns whether there was one. Only call this when no writer is running"""
+    try:
+        shm = shared_memory.SharedMemory(name = name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    shm.unlink()
+    return True
+
+
+class SharedProbeBuffer(pb.ProbeBuffer):
+    """
+    A ring mode ProbeBuffer whose mirrored sample and time rings live in a named
+    multiprocessing.shared_memory segment, so other processes can read the calibrated
+    samples without copying them through a pipe.
+
+    There is a single writer (the acquisition process). Every add_data is bracketed by
+    a seqlock: the counter is odd while the rings are being written and is bumped back
+    to even once the new total is published, so readers never take a lock and can tell
+    whether what they read was overwritten under them. The writer owns the segment and
+    unlinks it on close().
+    """
+
+    def __init__(self, name: str, num_channels: int, fs: int, calibration: Calibration | None = None,
+                 probe_id: str = "default"):
+        super().__init__(num_channels, fs, mode = "ring", calibration = calibration, probe_id = probe_id)
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name = name, create = True,
+                                              size = _segment_size(num_channels, self.bufsize))
+        control, ring, time_ring = _views(self.shm.buf, num_channels, self.bufsize)
+        ring[:] = self._ring
+        time_ring[:] = self._time_ring
+        self._ring, self._time_ring, self._control = ring, time_ring, control
+        meta = json.dumps({"fs": fs, "probe_id": probe_id, "calibration": self.calibration.to_dict()}).encode()
+        if len(meta) > META_SIZE:
+            raise ValueError("Buffer metadata does not fit in the shared segment")
+        self.shm.buf[CONTROL_SIZE:CONTROL_SIZE + len(meta)] = meta
+        control[:] = 0
+        control[META_LEN] = len(meta)
+        control[CHANNELS] = num_channels
+        control[BUFSIZE] = self.bufsize
+        control[VERSION] = LAYOUT_VERSION
+
+    def add_data(self, data: np.ndarray, times: np.ndarray | None = None):
+        if len(data) == 0:
+            return
+        self._control[SEQ] += 1
+        super().add_data(data, times)
+        self._control[TOTAL] = self.total_written
+        self._control[SEQ] += 1
+
+    def set_dropped(self, dropped: int):
+        """ Publishes the number of samples dropped upstream of the buffer"""
+        self._control[DROPPED] = dropped
+
+    def close(self):
+        # Drop our views before the segment is closed, or the close fails
+        self._ring = self._ring.copy()
+        self._time_ring = self._time_ring.copy()
+        self._control = self._control.copy()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedBufferReader:
+    """
+    Attaches to a SharedProbeBuffer from any process. The accessors mirror ProbeBuffer
+    (ordered, times, latest, latest_times, total_written, bufsize, fs, calibration), so
+    the reader can stand in for a local buffer.
+
+    ordered() and times() are zero-copy views into the segment: the writer may overwrite
+    their oldest samples while they are in use, which only matters to code that needs an
+    exact copy. That code should use snapshot() or read_since(), which retry until they
+    have a copy no write overlapped, or bracket its own reads with begin() and valid().
+    """
+
+    def __init__(self, name: str, timeout: float = 5.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.shm = shared_memory.SharedMemory(name = name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        # Only the writer may unlink the segment; stop this process's resource tracker
+        # from removing it when the reader exits (POSIX only, Windows does not track it)
+        if os.name == "posix":
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = name
+        control = np.ndarray(8, dtype="<i8", buffer = self.shm.buf)
+        self.num_channels = int(control[CHANNELS])
+        self.bufsize = int(control[BUFSIZE])
+        meta = json.loads(bytes(self.shm.buf[CONTROL_SIZE:CONTROL_SIZE + int(control[META_LEN])]))
+        self.fs = meta["fs"]
+        self.probe_id = meta["probe_id"]
+        self.calibration = Calibration.from_dict(meta["calibration"])
+        self._control, self._ring, self._time_ring = _views(self.shm.buf, self.num_channels, self.bufsize)
+
+    @property
+    def total_written(self) -> int:
+        return int(self._control[TOTAL])
+
+    @property
+    def dropped(self) -> int:
+        return int(self._control[DROPPED])
+
+    def begin(self) -> int:
+        """ Waits for any write in progress to finish and returns the seqlock token"""
+        while True:
+            token = int(self._control[SEQ])
+            if token % 2 == 0:
+                return token
+            time.sleep(0)
+
+    def valid(self, token: int) -> bool:
+        """ True if nothing was written since begin() returned token"""
+        return int(self._control[SEQ]) == token
+
+    def _window(self, ring: np.ndarray, total: int) -> np.ndarray:
+        i = total % self.bufsize
+        return ring[i:i + self.bufsize]
+
+    def ordered(self) -> np.ndarray:
+        return self._window(self._ring, self.total_written)
+
+    def times(self) -> np.ndarray:
+        return self._window(self._time_ring, self.total_written)
+
+    def latest(self, n: int) -> np.ndarray:
+        n = min(n, self.bufsize)
+        return self.ordered()[self.bufsize - max(n, 0):]
+
+    def latest_times(self, n: int) -> np.ndarray:
+        n = min(n, self.bufsize)
+        return self.times()[self.bufsize - max(n, 0):]
+
+    def snapshot(self):
+        """ Returns consistent copies of (samples, times, total_written)"""
+        while True:
+            token = self.begin()
+            total = int(self._control[TOTAL])
+            data = self._window(self._ring, total).copy()
+            times = self._window(self._time_ring, total).copy()
+            if self.valid(token):
+                return data, times, total
+
+    def read_since(self, count: int):
+        """ Copies the samples written after the first count, oldest first. Returns
+        (samples, times, new count, missed), where missed is the number of samples that
+        were overwritten before this reader got to them"""
+        while True:
+            token = self.begin()
+            total = int(self._control[TOTAL])
+            n = total - count
+            missed = max(0, n - self.bufsize)
+            n = min(n, self.bufsize)
+            data = self._window(self._ring, total)[self.bufsize - n:].copy()
+            times = self._window(self._time_ring, total)[self.bufsize - n:].copy()
+            if self.valid(token):
+                return data, times, total, missed
+
+    def close(self):
+        self._control = self._ring = self._time_ring = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views handed out by ordered() are still alive; the mapping goes with the process
+            pass
@@ -0,0 +1,139 @@
+import numpy as np
+import changepoint as cp
+
+
+# Stiffness analysis shared by the GUI, the offline scripts and the batch tool.
+#
+# Each rep is an indentation: the force steps up when the probe extends and back down when
+# it retracts. Change point detection finds the 2 * num_reps steps; the force at each onset
+# is the initial force fi and the window maximum up to the retraction is the final force ff.
+
+DEFAULT_PARAMS = {
+    "trial_start": 350, # in indices, the deadzone before the first rep
+    "lag": 20, # in indices, how far before each detected onset to take fi
+    "num_reps": 3,
+    "model": "kernel_linear",
+    "h": 0.003, # indentation in meters
+    "R": 0.0024052, # radius of the probe in meters
+    "v": 0.5, # Poisson's ratio
+    "friction": 0.4, # friction force in newtons
+}
+
+
+def hertz_modulus(P, h, R, v):
+    """ Elastic modulus from the Hertz contact model for a spherical indenter.
+    P is the indentation force in newtons and may be an array"""
+    return (0.75 * np.asarray(P) * (1 - v**2)) / (R**0.5 * h**(3/2))
+
+
+def window_maxima(force: np.ndarray, starts, ends) -> np.ndarray:
+    """ Maximum of force[start:end] for every window, in one np.maximum.reduceat pass.
+
+    force is one trace of shape (L,) or a batch of equal length traces of shape (S, L).
+    starts and ends have shape (W,), applied to every trace, or (S, W). Returns (W,) or
+    (S, W). Bounds are clipped to the trace and empty windows give nan."""
+    force = np.asarray(force, dtype=np.float64)
+    single = force.ndim == 1
+    force = np.atleast_2d(force)
+    S, L = force.shape
+    starts = np.clip(np.broadcast_to(np.asarray(starts, dtype=np.int64), (S, np.shape(starts)[-1])), 0, L)
+    ends = np.clip(np.broadcast_to(np.asarray(ends, dtype=np.int64), starts.shape), 0, L)
+    empty = ends <= starts
+    # Lay the traces end to end and point every window at its own trace
+    offsets = (np.arange(S) * L)[:, None]
+    indices = np.empty((S, 2 * starts.shape[1]), dtype=np.int64)
+    indices[:, 0::2] = np.where(empty, 0, starts + offsets)
+    indices[:, 1::2] = np.where(empty, 1, ends + offsets)
+    flat = force.ravel()
+    if indices.max() >= len(flat):
+        # reduceat indices must be valid, so give windows ending at the very end a sentinel
+        flat = np.append(flat, -np.inf)
+    maxima = np.maximum.reduceat(flat, indices.ravel())[0::2].reshape(starts.shape)
+    maxima[empty] = np.nan
+    return maxima[0] if single else maxima
+
+
+def window_argmax(force: np.ndarray, starts, ends, maxima = None) -> np.ndarray:
+    """ Index of the first maximum of force[start:end] for every window of a single trace,
+    like np.argmax on each window but offset by start, without a loop over the windows.
+    maxima, if already computed with window_maxima, saves a pass. Empty windows give -1."""
+    force = np.asarray(force, dtype=np.float64)
+    L = len(force)
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, L)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, L)
+    if maxima is None:
+        maxima = window_maxima(force, starts, ends)
+    lengths = np.maximum(ends - starts, 0)
+    # Every sample of every window, tagged with its window, then the first one equal to
+    # the window's maximum (nan counts as the maximum, as in np.argmax)
+    window = np.repeat(np.arange(len(starts)), lengths)
+    positions = starts[window] + np.arange(len(window)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    values = force[positions]
+    peak = maxima[window]
+    hits = np.flatnonzero((values == peak) | (np.isnan(values) & np.isnan(peak)))
+    found, first = np.unique(window[hits], return_index = True)
+    result = np.full(len(starts), -1, dtype=np.int64)
+    result[found] = positions[hits[first]]
+    return result
+
+
+def rep_forces(force: np.ndarray, bounds, range_index = None):
+    """ Initial and final force of every rep from the detection window bounds.
+
+    bounds has shape (num_reps, 4) or (S, num_reps, 4), each row being
+    [f0_start, f0_end, ff_start, ff_end] like MainWindow.det_current_bound. Returns
+    (fi, ff), the window maxima, each of shape (num_reps,) or (S, num_reps).
+    A range_max.SparseTableMax built over a single force trace answers the windows in
+    O(1) each instead of scanning them."""
+    bounds = np.asarray(bounds)
+    starts = np.concatenate((bounds[..., 0], bounds[..., 2]), axis=-1)
+    ends = np.concatenate((bounds[..., 1], bounds[..., 3]), axis=-1)
+    if range_index is not None:
+        maxima = range_index.query(starts, ends)
+    else:
+        maxima = window_maxima(force, starts, ends)
+    num_reps = bounds.shape[-2]
+    return maxima[..., :num_reps], maxima[..., num_reps:]
+
+
+def stiffness_from_forces(fi, ff, h, R, v, friction: float = 0.0) -> dict:
+    """ Per-rep Hertz moduli and their mean and std, along the last axis"""
+    E = hertz_modulus(np.asarray(ff) - np.asarray(fi) - friction, h, R, v)
+    return {"E": E, "E_mean": np.mean(E, axis=-1), "E_std": np.std(E, axis=-1)}
+
+
+def find_breakpoints(signal: np.ndarray, n_bkps: int, model: str = "kernel_linear") -> np.ndarray:
+    """ Returns the change points of signal, ruptures style (the last one is len(signal)).
+    model names a backend in changepoint.BACKENDS"""
+    signal = np.asarray(signal, dtype=np.float64)
+    return cp.get_detector(model).detect(signal, n_bkps)
+
+
+def detect_reps(force: np.ndarray, trial_start: int = 350, lag: int = 20, num_reps: int = 3, model: str = "kernel_linear"):
+    """ Finds each rep's initial and final force. Returns (fi, fi_ind, ff, ff_ind), with the
+    indices relative to the start of force"""
+    trunc_force = np.asarray(force[trial_start:-1], dtype=np.float64)
+    try:
+        bkps = find_breakpoints(trunc_force, 2 * num_reps, model)
+    except cp.NotEnoughChangePoints as e:
+        raise ValueError(f"Could not find {num_reps} reps in the force trace: {e}") from None
+    onsets = bkps[0:2 * num_reps:2] - lag
+    offsets = bkps[1:2 * num_reps:2]
+    onsets = np.clip(onsets, 0, len(trunc_force) - 1)
+    fi = trunc_force[onsets]
+    ff = window_maxima(trunc_force, onsets, offsets)
+    ff_ind = window_argmax(trunc_force, onsets, offsets, ff)
+    return fi, onsets + trial_start, ff, ff_ind + trial_start
+
+
+def analyze_force(force: np.ndarray, **params) -> dict:
+    """ Runs rep detection and the Hertz model on a force trace. Missing params are taken
+    from DEFAULT_PARAMS. Returns the per-rep forces and moduli, and their mean and std"""
+    p = dict(DEFAULT_PARAMS)
+    p.update(params)
+    fi, fi_ind, ff, ff_ind = detect_reps(force, p["trial_start"], p["lag"], p["num_reps"], p["model"])
+    result = stiffness_from_forces(fi, ff, p["h"], p["R"], p["v"], p["friction"])
+    return {
+        "fi": fi, "fi_ind": fi_ind, "ff": ff, "ff_ind": ff_ind,
+        "E": result["E"], "E_mean": float(result["E_mean"]), "E_std": float(result["E_std"]),
+    }
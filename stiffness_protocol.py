@@ -0,0 +1,137 @@
+import numpy as np
+import timing
+
+
+class ProtocolStep:
+    """ A command and how long to wait after issuing it before the next step, in seconds"""
+
+    def __init__(self, command: str, dwell: float, rep: int | None = None):
+        self.command = command
+        self.dwell = dwell
+        # Rep the step belongs to, None for the steps around the reps
+        self.rep = rep
+
+    def __repr__(self):
+        return f"ProtocolStep({self.command}, dwell={self.dwell}, rep={self.rep})"
+
+
+class StiffnessProtocol:
+    """
+    The stiffness test as a declarative sequence: retract and settle, then for each rep
+    extend and hold, retract and rest, with a final release after the last rep.
+
+    The probe firmware takes no depth argument, so depth (the indentation h, in meters)
+    is recorded with the protocol for the analysis rather than sent with the commands.
+    """
+
+    def __init__(self, num_reps: int = 3, settle: float = 0.5, hold: float = 1.0, rest: float = 1.0,
+                 release: float = 0.5, depth: float | None = None):
+        self.num_reps = num_reps
+        self.settle = settle
+        self.hold = hold
+        self.rest = rest
+        self.release = release
+        self.depth = depth
+
+    def steps(self) -> list:
+        steps = [ProtocolStep("retract", self.settle)]
+        for rep in range(self.num_reps):
+            steps.append(ProtocolStep("extend", self.hold, rep))
+            last = rep == self.num_reps - 1
+            steps.append(ProtocolStep("retract", self.release if last else self.rest, rep))
+        return steps
+
+    @property
+    def duration(self) -> float:
+        return sum(step.dwell for step in self.steps())
+
+
+class IssuedCommand:
+    """ A step as it was run: the host time and the sample index when it was issued"""
+
+    def __init__(self, step: ProtocolStep, time: float, index: int):
+        self.step = step
+        self.time = time
+        self.index = index
+
+    def __repr__(self):
+        return f"IssuedCommand({self.step.command}, rep={self.step.rep}, time={self.time:.3f}, index={self.index})"
+
+
+class ProtocolScheduler:
+    """
+    Runs a protocol against the monotonic clock without sleeping.
+
+    Each step is due at the protocol start plus the dwell of every step before it, so
+    late ticks never accumulate into drift. tick() is called from a timer (the GUI's Qt
+    timer) and issues every step that has come due, tagging it with sample_index(), the
+    number of samples acquired so far. Once the last dwell has elapsed the scheduler
+    records the final sample index and calls on_finished(scheduler).
+    """
+
+    def __init__(self, protocol: StiffnessProtocol, send, sample_index, on_finished = None, clock = timing.now):
+        self.protocol = protocol
+        self.send = send
+        self.sample_index = sample_index
+        self.on_finished = on_finished
+        self.clock = clock
+        self.steps = protocol.steps()
+        # Due time of each step relative to the start, and of the end of the protocol
+        self.offsets = np.concatenate(([0.0], np.cumsum([step.dwell for step in self.steps])))
+        self.log = []
+        self.running = False
+        self.finished = False
+        self.start_index = None
+        self.end_index = None
+
+    def start(self):
+        self.log = []
+        self.finished = False
+        self.start_time = self.clock()
+        self.start_index = self.sample_index()
+        self.end_index = None
+        self.running = True
+        self.tick()
+
+    def stop(self):
+        """ Abandons the protocol; the remaining steps are not sent"""
+        self.running = False
+
+    def tick(self) -> list:
+        """ Issues every step that is due and returns the ones issued"""
+        if not self.running:
+            return []
+        elapsed = self.clock() - self.start_time
+        issued = []
+        while len(self.log) < len(self.steps) and elapsed >= self.offsets[len(self.log)]:
+            step = self.steps[len(self.log)]
+            self.send(step.command)
+            record = IssuedCommand(step, self.clock(), self.sample_index())
+            self.log.append(record)
+            issued.append(record)
+        if len(self.log) == len(self.steps) and elapsed >= self.offsets[-1]:
+            self.running = False
+            self.finished = True
+            self.end_index = self.sample_index()
+            if self.on_finished is not None:
+                self.on_finished(self)
+        return issued
+
+    def windows(self, fs: float, pre: float = 0.3, lag: float = 0.1) -> np.ndarray:
+        """ Detection windows for each rep, in samples from the protocol start, as rows of
+        [f0_start, f0_end, ff_start, ff_end].
+
+        The initial force window is the pre seconds before the extend command, and the
+        final force window runs from the extend command to lag seconds after the retract
+        (the probe's response time)."""
+        pre = int(round(pre * fs))
+        lag = int(round(lag * fs))
+        extends = {record.step.rep: record.index for record in self.log if record.step.command == "extend"}
+        retracts = {record.step.rep: record.index for record in self.log
+                    if record.step.command == "retract" and record.step.rep is not None}
+        rows = []
+        for rep in sorted(extends):
+            e = extends[rep] - self.start_index
+            r = retracts.get(rep, self.end_index) - self.start_index
+            rows.append([max(0, e - pre), e, e, r + lag])
+        return np.array(rows, dtype=np.int64).reshape(-1, 4)
@@ -0,0 +1,108 @@
+import numpy as np
+import scipy.signal as sps
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Causal filters for the live stream. Each filter works on (n, num_channels) blocks and
+# carries its state from one block to the next, so filtering a stream block by block gives
+# the same result as filtering it in one go, and the cost only depends on the new samples.
+
+
+class RunningMedian:
+    """ Causal running median over the last size samples (the live version of the
+    median_filter(size=5) in filter_testing.py)"""
+
+    def __init__(self, size: int = 5):
+        self.size = size
+        self._tail = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return np.array(block, dtype=np.float64)
+        if self._tail is None:
+            # Before the stream starts, assume the first sample was held
+            self._tail = np.repeat(block[:1], self.size - 1, axis=0).astype(np.float64)
+        extended = np.concatenate((self._tail, block))
+        windows = sliding_window_view(extended, self.size, axis=0)
+        out = np.median(windows, axis=-1)
+        self._tail = extended[len(extended) - (self.size - 1):]
+        return out
+
+
+class SosLowpass:
+    """ Butterworth low-pass in second order sections, with the sosfilt state carried
+    between blocks"""
+
+    def __init__(self, cutoff: float, fs: float, order: int = 4):
+        self.sos = sps.butter(order, cutoff, btype="low", fs=fs, output="sos")
+        self._zi = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return np.array(block, dtype=np.float64)
+        if self._zi is None:
+            # Start in steady state at the first sample, so there is no start-up transient
+            self._zi = sps.sosfilt_zi(self.sos)[:, :, None] * np.asarray(block[0], dtype=np.float64)
+        out, self._zi = sps.sosfilt(self.sos, block, axis=0, zi=self._zi)
+        return out
+
+
+class KalmanSmoother:
+    """
+    Steady-state Kalman filter for a slowly varying signal (random walk model) measured
+    with noise. With constant noise variances the Kalman gain converges to a constant K,
+    and the filter becomes y[n] = y[n-1] + K * (x[n] - y[n-1]), which is run as a first
+    order IIR with lfilter so a whole block is filtered at once.
+    process_var and measurement_var can be scalars or one value per channel.
+    """
+
+    def __init__(self, process_var, measurement_var):
+        Q = np.atleast_1d(np.asarray(process_var, dtype=np.float64))
+        R = np.atleast_1d(np.asarray(measurement_var, dtype=np.float64))
+        # Steady-state prior variance solves P = P * R / (P + R) + Q
+        P = (Q + np.sqrt(Q**2 + 4 * Q * R)) / 2
+        self.gain = P / (P + R)
+        self._state = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        block = np.asarray(block, dtype=np.float64)
+        if len(block) == 0:
+            return block.copy()
+        if self._state is None:
+            self._state = block[0].copy()
+        gain = np.broadcast_to(self.gain, self._state.shape)
+        out = np.empty_like(block)
+        for ch, K in enumerate(gain):
+            zi = [(1 - K) * self._state[ch]]
+            out[:, ch], _ = sps.lfilter([K], [1, -(1 - K)], block[:, ch], zi=zi)
+        self._state = out[-1].copy()
+        return out
+
+
+class FilterBank:
+    """
+    Applies a filter to each selected group of channels, e.g.
+
+        bank = FilterBank(2)
+        bank.add(RunningMedian(5), channels=[0])
+        bank.add(SosLowpass(10, fs=80), channels=[1])
+
+    Channels without a filter pass through unchanged.
+    """
+
+    def __init__(self, num_channels: int):
+        self.num_channels = num_channels
+        self.stages = []
+
+    def add(self, stream_filter, channels: list):
+        self.stages.append((stream_filter, list(channels)))
+        return self
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """ Returns the filtered block (the input is left unchanged)"""
+        out = np.array(block, dtype=np.float64)
+        if len(out) == 0:
+            return out
+        for stream_filter, channels in self.stages:
+            out[:, channels] = stream_filter.process(out[:, channels])
+        return out
@@ -0,0 +1,95 @@
+import time
+from collections import deque
+import numpy as np
+
+
+# Host clock used to stamp sample blocks: monotonic, with the highest available resolution
+now = time.perf_counter
+
+# Device sequence numbers are uint16 and wrap around
+SEQ_MODULUS = 65536
+
+
+def sample_times(block_stamps: np.ndarray, fs: float) -> np.ndarray:
+    """ Spreads block arrival stamps over the samples they cover.
+
+    block_stamps holds, for every sample, the host time its block was read. The last
+    sample of each block keeps that time and the earlier ones are placed 1 / fs apart
+    before it, which gives every sample its own time on a real time axis."""
+    stamps = np.asarray(block_stamps, dtype=np.float64)
+    n = len(stamps)
+    if n == 0:
+        return stamps.copy()
+    # Index of the last sample of the block each sample belongs to
+    ends = np.flatnonzero(np.append(stamps[1:] != stamps[:-1], True))
+    block_end = ends[np.searchsorted(ends, np.arange(n))]
+    return stamps - (block_end - np.arange(n)) / fs
+
+
+class RateEstimator:
+    """
+    Tracks the effective sample rate, the jitter of the sample arrival times, and the
+    samples dropped on the device side (from gaps in the sequence numbers, when the
+    protocol carries them).
+
+    The rate is the number of samples received over the last window seconds divided by
+    the time they took. Jitter is the RMS deviation of each block's per-sample interval
+    from 1 / rate, in seconds.
+    """
+
+    def __init__(self, nominal_fs: float | None = None, window: float = 2.0, alpha: float = 0.1):
+        self.nominal_fs = nominal_fs
+        self.window = window
+        self.alpha = alpha
+        self.count = 0
+        self.dropped = 0
+        self.blocks = 0
+        self._history = deque()
+        self._last_t = None
+        self._last_seq = None
+        self._dev_sq = 0.0
+
+    def update(self, n: int, t: float, seq = None):
+        """ Records a block of n samples read at host time t, with their sequence numbers"""
+        if n == 0:
+            return
+        if self._last_t is not None and t > self._last_t:
+            per_sample = (t - self._last_t) / n
+            fs = self.fs
+            if fs:
+                self._dev_sq += self.alpha * ((per_sample - 1 / fs)**2 - self._dev_sq)
+        self._last_t = t
+        self.count += n
+        self.blocks += 1
+        self._history.append((t, self.count))
+        while len(self._history) > 2 and t - self._history[0][0] > self.window:
+            self._history.popleft()
+        if seq is not None and len(seq):
+            seq = np.asarray(seq, dtype=np.int64)
+            gaps = (np.diff(seq) - 1) % SEQ_MODULUS
+            if self._last_seq is not None:
+                gaps = np.append(gaps, (seq[0] - self._last_seq - 1) % SEQ_MODULUS)
+            self.dropped += int(gaps.sum())
+            self._last_seq = int(seq[-1])
+
+    @property
+    def fs(self) -> float | None:
+        """ Effective sample rate, or the nominal rate until there is enough history"""
+        if len(self._history) >= 2:
+            (t0, c0), (t1, c1) = self._history[0], self._history[-1]
+            if t1 > t0:
+                # The samples counted at t0 arrived before the window starts
+                return (c1 - c0) / (t1 - t0)
+        return self.nominal_fs
+
+    @property
+    def jitter(self) -> float:
+        return self._dev_sq ** 0.5
+
+    def stats(self) -> dict:
+        return {
+            "fs": self.fs,
+            "jitter_ms": 1e3 * self.jitter,
+            "samples": self.count,
+            "device_dropped": self.dropped,
+        }